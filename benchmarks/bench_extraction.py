@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+# Extraction throughput (tweets/sec) and peak RSS of the browser path (headless Chrome on
+# a local fixture server, mode="dom" and mode="batch") and of the offline lxml path.
+# Every measurement runs in its own process so peak RSS is not shared between runs, and
+# results are appended to benchmarks/results.jsonl.
+#
+#   python -m benchmarks.bench_extraction --sizes 1000 10000 100000
+from datetime import datetime
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import psutil
+except ImportError:  # optional, only needed for the peak RSS of Chrome
+    psutil = None
+
+from benchmarks.common import REPO_ROOT, append_result, git_commit
+from benchmarks.fixture_server import serve_fixtures
+from benchmarks.timeline_fixtures import FIXTURE_SIZES, fixture_filename, write_fixture
+from tweet_record import encode
+
+
+# Wide enough for every fixture tweet, so the date checks run but filter nothing
+ALL_DATES = ("2000-01-01", "2100-01-01")
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024**2 if sys.platform == "darwin" else 1024)
+
+
+class RssSampler(threading.Thread):
+    # Peak RSS of a process tree (chromedriver and the Chrome processes under it)
+    def __init__(self, pid, interval=0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        root = psutil.Process(self.pid)
+        while not self._stop_event.wait(self.interval):
+            try:
+                processes = [root] + root.children(recursive=True)
+            except psutil.NoSuchProcess:
+                return
+            total = 0
+            for process in processes:
+                try:
+                    total += process.memory_info().rss
+                except psutil.NoSuchProcess:
+                    pass
+            self.peak_bytes = max(self.peak_bytes, total)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class RowCollector:
+    # The writer `fetch_tweets` sends rows to
+    def __init__(self):
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(row)
+
+    def flush(self):
+        pass
+
+
+def run_offline(filename, base_url, start_date, end_date):
+    from offline_extraction import OfflineExtractor
+
+    start = time.perf_counter()
+    rows = OfflineExtractor(base_url).extract(filename, start_date, end_date)
+    return rows, time.perf_counter() - start, None
+
+
+def run_browser(filename, base_url, start_date, end_date, mode):
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+
+    from twitter_data_ingestion import TwitterExtractor
+
+    class LocalExtractor(TwitterExtractor):
+        # Loads the fixture server instead of twitter.com, with no auth cookie
+        def _start_chrome(self, headless):
+            options = Options()
+            if headless:
+                options.add_argument("--headless=new")
+            self._add_lean_options(options)
+            return webdriver.Chrome(options=options)
+
+        def set_token(self, auth_token=None):
+            pass
+
+    extractor = LocalExtractor(auth_token=None)
+    # Once the fixture is exhausted, the first timeout ends the crawl
+    extractor.max_stalls = 0
+    sampler = None
+    if psutil is not None:
+        sampler = RssSampler(extractor.driver.service.process.pid)
+        sampler.start()
+    collector = RowCollector()
+    page_url = base_url + os.path.basename(filename)
+    try:
+        start = time.perf_counter()
+        extractor.fetch_tweets(
+            page_url, start_date, end_date, mode=mode, writer=collector, export=None
+        )
+        elapsed = time.perf_counter() - start
+    finally:
+        if sampler:
+            sampler.stop()
+        extractor.driver.quit()
+    # The wait that detects the end of the fixture is not extraction time
+    elapsed = max(elapsed - extractor._wait_timeout(), 1e-9)
+    browser_rss_mb = sampler.peak_bytes / 1024**2 if sampler else None
+    return collector.rows, elapsed, browser_rss_mb
+
+
+def worker(args):
+    # Runs one measurement and prints its result (and rows, for the parity check) as JSON
+    if args.path == "offline":
+        rows, elapsed, browser_rss_mb = run_offline(
+            args.fixture, args.base_url, args.start_date, args.end_date
+        )
+    else:
+        rows, elapsed, browser_rss_mb = run_browser(
+            args.fixture, args.base_url, args.start_date, args.end_date, args.path
+        )
+    if args.rows_output:
+        with open(args.rows_output, "wb") as file:
+            for row in rows:
+                file.write(encode(row))
+    peak_rss_mb = _peak_rss_mb()
+    print(
+        json.dumps(
+            {
+                "num_tweets": len(rows),
+                "seconds": round(elapsed, 3),
+                "tweets_per_second": round(len(rows) / elapsed, 1),
+                "peak_rss_mb": round(peak_rss_mb, 1),
+                "browser_peak_rss_mb": (
+                    round(browser_rss_mb, 1) if browser_rss_mb is not None else None
+                ),
+            }
+        )
+    )
+
+
+def _measure(path, filename, base_url, start_date, end_date, rows_output):
+    command = [
+        sys.executable, "-m", "benchmarks.bench_extraction", "--worker", path,
+        "--fixture", filename, "--base-url", base_url,
+        "--start-date", start_date, "--end-date", end_date,
+        "--rows-output", rows_output,
+    ]
+    result = subprocess.run(
+        command, cwd=REPO_ROOT, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def _same_rows(filename, other_filename):
+    with open(filename, encoding="utf-8") as file, open(
+        other_filename, encoding="utf-8"
+    ) as other_file:
+        return file.read() == other_file.read()
+
+
+def main(args):
+    server, base_url = serve_fixtures(args.fixture_dir)
+    run_id = datetime.now().isoformat(timespec="seconds")
+    commit = git_commit()
+    try:
+        for size in args.sizes:
+            filename = fixture_filename(args.fixture_dir, size)
+            # Fixtures are deterministic, so they are only generated once
+            if not os.path.exists(filename):
+                write_fixture(filename, size)
+
+            paths = ["offline"]
+            if args.browser and size <= args.browser_max:
+                paths += args.browser_modes
+            rows_outputs = {}
+            for path in paths:
+                rows_outputs[path] = os.path.join(
+                    args.fixture_dir, f"rows_{size}_{path}.jsonl"
+                )
+                result = _measure(
+                    path, filename, base_url, ALL_DATES[0], ALL_DATES[1], rows_outputs[path]
+                )
+                result.update(
+                    {"run": run_id, "commit": commit, "path": path, "fixture_size": size}
+                )
+                if path != "offline":
+                    result["matches_offline"] = _same_rows(
+                        rows_outputs[path], rows_outputs["offline"]
+                    )
+                append_result(args.results, result)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark tweet extraction.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=FIXTURE_SIZES)
+    parser.add_argument("--fixture-dir", default="benchmarks/fixtures")
+    parser.add_argument("--results", default="benchmarks/results.jsonl")
+    parser.add_argument(
+        "--no-browser", dest="browser", action="store_false",
+        help="Only benchmark the offline path (no Chrome needed).",
+    )
+    parser.add_argument("--browser-modes", nargs="+", default=["dom", "batch"])
+    parser.add_argument(
+        "--browser-max", type=int, default=10_000,
+        help="Largest fixture to load in Chrome (the browser path is slow on big pages).",
+    )
+    # Internal: a single measurement in a subprocess
+    parser.add_argument("--worker", dest="path")
+    parser.add_argument("--fixture")
+    parser.add_argument("--base-url")
+    parser.add_argument("--start-date")
+    parser.add_argument("--end-date")
+    parser.add_argument("--rows-output")
+    args = parser.parse_args()
+    if args.path:
+        worker(args)
+    else:
+        main(args)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+# Encoder backends against each other: images/sec (embed_images), text queries/sec
+# (encode_queries, one query per forward pass and batched) and startup time (imports and
+# model load, in a fresh process) of each backend, and the parity of the ONNX backends
+# with the first one (torch): cosine drift of the image and text embeddings, and
+# recall@k of text-to-image search, with both sides from the backend and with backend
+# queries against reference image embeddings (an index embedded with the other backend).
+# Results are appended to benchmarks/results.jsonl.
+#
+#   python onnx_encoder.py
+#   python -m benchmarks.bench_onnx_encoder --folder downloaded_images --num-images 1000
+from datetime import datetime
+import argparse
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from benchmarks.common import append_result, git_commit
+from embedding_store import normalize
+from image_search import (
+    BACKENDS,
+    DEFAULT_MODEL,
+    embed_images,
+    encode_queries,
+    list_image_files,
+    load_model,
+)
+from vector_index import top_k_indices
+
+
+DEFAULT_QUERIES = [
+    "black cat",
+    "a dog running on the beach",
+    "sunset over the sea",
+    "screenshot of a chart",
+    "anime girl with blue hair",
+    "bowl of ramen",
+    "city skyline at night",
+    "mountain covered in snow",
+    "a person holding a phone",
+    "meme with text",
+    "黑猫",
+    "夕焼けの海",
+    "猫と犬",
+    "手机截图",
+    "gato negro",
+    "Katze auf dem Sofa",
+    "red sports car",
+    "cherry blossoms",
+    "birthday cake",
+    "map of the world",
+]
+
+
+def _startup_seconds(model_name, backend, num_threads):
+    # Imports and model load in a fresh process, the cost paid by every new worker
+    code = (
+        "import time; start = time.perf_counter(); from image_search import load_model; "
+        f"load_model({model_name!r}, {backend!r}, {num_threads!r}); "
+        "print(time.perf_counter() - start)"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.split()[-1])
+
+
+def _queries_per_second(queries, model, processor, batch_size):
+    start_time = time.perf_counter()
+    encode_queries(queries, model, processor, batch_size=batch_size)
+    return len(queries) / (time.perf_counter() - start_time)
+
+
+def _cosine_drift(embeddings, reference):
+    drift = 1 - np.sum(normalize(embeddings) * normalize(reference), axis=1)
+    return round(float(drift.mean()), 6), round(float(drift.max()), 6)
+
+
+def _recall(query_embeddings, image_embeddings, expected, top_k):
+    found, _ = top_k_indices(normalize(query_embeddings) @ normalize(image_embeddings).T, top_k)
+    hits = [len(set(row) & set(expected_row)) for row, expected_row in zip(found, expected)]
+    return round(sum(hits) / expected.size, 4)
+
+
+def run_backend(backend, file_paths, queries, args):
+    model, processor = load_model(args.model, backend, args.num_threads)
+    # Warm-up: the first forward pass pays for allocations and kernel selection
+    embed_images(file_paths[: args.batch_size], model, processor, batch_size=args.batch_size)
+    encode_queries(queries[:1], model, processor)
+
+    start_time = time.perf_counter()
+    image_embeddings, embedded_paths = embed_images(
+        file_paths,
+        model,
+        processor,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+    )
+    images_per_second = len(embedded_paths) / (time.perf_counter() - start_time)
+    result = {
+        "backend": backend,
+        "images": len(embedded_paths),
+        "queries": len(queries),
+        "images_per_second": round(images_per_second, 1),
+        "queries_per_second_batch_1": round(
+            _queries_per_second(queries, model, processor, 1), 1
+        ),
+        f"queries_per_second_batch_{args.query_batch_size}": round(
+            _queries_per_second(queries, model, processor, args.query_batch_size), 1
+        ),
+        "startup_seconds": round(_startup_seconds(args.model, backend, args.num_threads), 2),
+    }
+    text_embeddings = encode_queries(queries, model, processor)
+    return result, dict(zip(embedded_paths, image_embeddings)), text_embeddings
+
+
+def main(args):
+    run_id = datetime.now().isoformat(timespec="seconds")
+    commit = git_commit()
+    file_paths = list_image_files(args.folder)[: args.num_images]
+    queries = DEFAULT_QUERIES
+    if args.queries_file:
+        with open(args.queries_file, encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+
+    reference = None
+    for backend in args.backends:
+        result, image_embeddings, text_embeddings = run_backend(
+            backend, file_paths, queries, args
+        )
+        if reference is None:
+            reference = (backend, image_embeddings, text_embeddings)
+        else:
+            reference_backend, reference_images, reference_texts = reference
+            # Images both backends could read, in the same order
+            paths = [path for path in image_embeddings if path in reference_images]
+            images = np.stack([image_embeddings[path] for path in paths])
+            expected_images = np.stack([reference_images[path] for path in paths])
+            top_k = min(args.top_k, len(paths))
+            expected, _ = top_k_indices(
+                normalize(reference_texts) @ normalize(expected_images).T, top_k
+            )
+            image_drift = _cosine_drift(images, expected_images)
+            text_drift = _cosine_drift(text_embeddings, reference_texts)
+            result.update(
+                {
+                    "reference": reference_backend,
+                    "image_cosine_drift_mean": image_drift[0],
+                    "image_cosine_drift_max": image_drift[1],
+                    "text_cosine_drift_mean": text_drift[0],
+                    "text_cosine_drift_max": text_drift[1],
+                    "recall_at_k": _recall(text_embeddings, images, expected, top_k),
+                    "recall_at_k_reference_images": _recall(
+                        text_embeddings, expected_images, expected, top_k
+                    ),
+                }
+            )
+        result.update(
+            {
+                "run": run_id,
+                "commit": commit,
+                "benchmark": "onnx_encoder",
+                "model": args.model,
+                "dataset": args.folder,
+                "top_k": args.top_k,
+                "num_threads": args.num_threads,
+            }
+        )
+        append_result(args.results, result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the encoder backends.")
+    parser.add_argument("--folder", default="downloaded_images")
+    parser.add_argument("--num-images", type=int, default=512)
+    parser.add_argument("--queries-file", help="One query per line (default: built-in queries).")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        choices=BACKENDS,
+        default=["torch", "onnx", "onnx-float32"],
+        help="The first one is the reference of the parity check.",
+    )
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--query-batch-size", type=int, default=64)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--num-threads", type=int, default=None)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--results", default="benchmarks/results.jsonl")
+    main(parser.parse_args())
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# Recall@k and query latency of the approximate vector indexes against the exact scan,
+# on synthetic clustered embeddings or on the embeddings of an image folder, unfiltered
+# and restricted to random candidate sets (metadata filters) of each --selectivity.
+# Results are appended to benchmarks/results.jsonl.
+#
+#   python -m benchmarks.bench_vector_index --sizes 100000 1000000 --nprobe 8 16 32 64
+#   python -m benchmarks.bench_vector_index --selectivity 0.001 0.01 0.1 0.5
+#   python -m benchmarks.bench_vector_index --folder downloaded_images
+from datetime import datetime
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.common import append_result, git_commit
+from embedding_store import EmbeddingIndex, EmbeddingMatrix, normalize, quantize
+from vector_index import ExactIndex, HNSWIndex, IVFIndex, hnswlib, recall_at_k
+
+
+def synthetic_embeddings(size, dim=256, dtype="float16", cluster_size=100, seed=0):
+    # Normalized vectors around size / cluster_size random centers, roughly how image
+    # embeddings cluster by topic
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, size // cluster_size), dim)).astype(np.float32)
+    vectors = centers[rng.integers(len(centers), size=size)]
+    vectors += rng.normal(scale=0.7, size=vectors.shape).astype(np.float32)
+    vectors, scales = quantize(normalize(vectors), dtype)
+    return EmbeddingMatrix(
+        vectors, scales, np.arange(size), [f"image_{i}.jpg" for i in range(size)]
+    )
+
+
+def _queries(embeddings, num_queries, seed=1):
+    # Stored vectors plus noise: queries land near the data, but not on it
+    rng = np.random.default_rng(seed)
+    queries = embeddings.vectors_of(rng.choice(len(embeddings), num_queries, replace=False))
+    return normalize(queries + rng.normal(scale=0.05, size=queries.shape).astype(np.float32))
+
+
+def _latencies_ms(index, queries, top_k, candidates=None):
+    latencies = []
+    for query in queries:
+        start_time = time.perf_counter()
+        index.search(query, top_k, candidates)
+        latencies.append((time.perf_counter() - start_time) * 1000)
+    return latencies
+
+
+def _filtered_recall(index, exact_index, queries, top_k, candidates):
+    expected, _ = exact_index.search(queries, top_k, candidates)
+    found, _ = index.search(queries, top_k, candidates)
+    hits = [len(set(row) & set(expected_row)) for row, expected_row in zip(found, expected)]
+    return sum(hits) / expected.size
+
+
+def _measure(index, exact_index, queries, top_k, build_seconds, candidates=None):
+    latencies = _latencies_ms(index, queries, top_k, candidates)
+    if candidates is None:
+        recall = recall_at_k(index, exact_index, queries, top_k)
+    else:
+        recall = _filtered_recall(index, exact_index, queries, top_k, candidates)
+    return {
+        "backend": index.name,
+        "recall_at_k": round(recall, 4),
+        "latency_ms_mean": round(float(np.mean(latencies)), 3),
+        "latency_ms_p99": round(float(np.percentile(latencies, 99)), 3),
+        "build_seconds": round(build_seconds, 2),
+    }
+
+
+def _timed(build):
+    start_time = time.perf_counter()
+    index = build()
+    return index, time.perf_counter() - start_time
+
+
+def _candidate_sets(size, selectivities, seed=2):
+    # (selectivity, sorted random file indices), with (None, None) for the unfiltered search
+    rng = np.random.default_rng(seed)
+    candidate_sets = [(None, None)]
+    for selectivity in selectivities:
+        num_candidates = max(1, int(selectivity * size))
+        candidates = np.sort(rng.choice(size, num_candidates, replace=False))
+        candidate_sets.append((selectivity, candidates))
+    return candidate_sets
+
+
+def _measure_all(index, exact_index, queries, args, build_seconds, candidate_sets, options):
+    for selectivity, candidates in candidate_sets:
+        result = _measure(index, exact_index, queries, args.top_k, build_seconds, candidates)
+        result.update(options)
+        if selectivity is not None:
+            result["selectivity"] = selectivity
+        yield result
+
+
+def benchmark(embeddings, args):
+    queries = _queries(embeddings, min(args.num_queries, len(embeddings)))
+    exact_index = ExactIndex(embeddings)
+    candidate_sets = _candidate_sets(len(embeddings), args.selectivity)
+    yield from _measure_all(exact_index, exact_index, queries, args, 0, candidate_sets, {})
+
+    ivf_index, build_seconds = _timed(lambda: IVFIndex.build(embeddings, nlist=args.nlist))
+    for nprobe in args.nprobe:
+        ivf_index.nprobe = nprobe
+        options = {"nlist": ivf_index.nlist, "nprobe": nprobe}
+        yield from _measure_all(
+            ivf_index, exact_index, queries, args, build_seconds, candidate_sets, options
+        )
+
+    if hnswlib is None:
+        return
+    hnsw_index, build_seconds = _timed(lambda: HNSWIndex.build(embeddings, M=args.M))
+    for ef in args.ef:
+        hnsw_index.ef = ef
+        options = {"M": args.M, "ef": ef}
+        yield from _measure_all(
+            hnsw_index, exact_index, queries, args, build_seconds, candidate_sets, options
+        )
+
+
+def main(args):
+    run_id = datetime.now().isoformat(timespec="seconds")
+    commit = git_commit()
+    if args.folder:
+        datasets = [(args.folder, lambda: EmbeddingIndex.open(args.folder).load())]
+    else:
+        datasets = [
+            (f"synthetic_{size}", lambda size=size: synthetic_embeddings(size, args.dim, args.dtype))
+            for size in args.sizes
+        ]
+    for dataset, load in datasets:
+        embeddings = load()
+        for result in benchmark(embeddings, args):
+            result.update(
+                {
+                    "run": run_id,
+                    "commit": commit,
+                    "benchmark": "vector_index",
+                    "dataset": dataset,
+                    "size": len(embeddings),
+                    "dtype": str(embeddings.vectors.dtype),
+                    "top_k": args.top_k,
+                }
+            )
+            append_result(args.results, result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the vector indexes.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000])
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--dtype", choices=["float32", "float16", "int8"], default="float16")
+    parser.add_argument(
+        "--folder", help="Benchmark the embeddings of this image folder instead."
+    )
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[8, 16, 32, 64])
+    parser.add_argument("--M", type=int, default=16)
+    parser.add_argument("--ef", type=int, nargs="+", default=[32, 64, 128])
+    parser.add_argument(
+        "--selectivity",
+        type=float,
+        nargs="*",
+        default=[],
+        help="Also search random candidate sets with these fractions of the images.",
+    )
+    parser.add_argument("--results", default="benchmarks/results.jsonl")
+    main(parser.parse_args())
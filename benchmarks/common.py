@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# What every benchmark result row shares: the commit it was measured at, and the JSONL
+# file of results it is appended to (benchmarks/results.jsonl by default).
+import json
+import os
+import subprocess
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def git_commit():
+    # Short hash of HEAD, None outside a git checkout
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def append_result(filename, result):
+    # Printed as it is measured, so a long run shows progress
+    print(json.dumps(result), flush=True)
+    with open(filename, "a", encoding="utf-8") as file:
+        file.write(json.dumps(result) + "\n")
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Serves the fixture directory over HTTP so headless Chrome can load the timelines.
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import threading
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_fixtures(directory, host="127.0.0.1", port=0):
+    # Serves in a daemon thread, returns the server (call shutdown() when done) and
+    # its base URL. port=0 picks a free port.
+    server = ThreadingHTTPServer((host, port), partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve timeline fixtures over HTTP.")
+    parser.add_argument("--directory", default="benchmarks/fixtures")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    server, base_url = serve_fixtures(args.directory, port=args.port)
+    print(f"Serving {args.directory} at {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Synthetic timeline pages with the markup TwitterExtractor relies on (data-testid
+# attributes, aria-labels, <time datetime>), newest tweet first.
+from datetime import datetime, timedelta
+import argparse
+import html
+import os
+import random
+
+
+WORDS = (
+    "llama index agents retrieval vector search embeddings model release open source "
+    "benchmark paper thread today new demo dataset training inference gpu latency"
+).split()
+LANGS = ["en", "en", "en", "fr", "ja", "es"]
+FIXTURE_SIZES = [1_000, 10_000, 100_000]
+
+PAGE_HEADER = (
+    '<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>Likes</title></head>'
+    '<body><main><div aria-label="Timeline: Likes">\n'
+)
+PAGE_FOOTER = "</div></main></body></html>\n"
+
+
+def _count_group(num_reply, num_retweet, num_like):
+    return (
+        '<div role="group">'
+        f'<div data-testid="reply" aria-label="{num_reply} Replies. Reply"></div>'
+        f'<div data-testid="retweet" aria-label="{num_retweet} reposts. Repost"></div>'
+        f'<div data-testid="like" aria-label="{num_like} Likes. Like"></div>'
+        "</div>"
+    )
+
+
+def make_tweet_html(rng, index, created_at):
+    handle = f"user_{rng.randrange(500)}"
+    tweet_id = 1_760_000_000_000_000_000 + index
+    words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 40)))
+    link = ""
+    if rng.random() < 0.3:
+        link = f' <a href="https://t.co/{index:x}">https://t.co/{index:x}</a>'
+    social_context = ""
+    if rng.random() < 0.1:
+        social_context = f"<div>{html.escape(handle)} Retweeted</div>"
+    media = ""
+    roll = rng.random()
+    if roll < 0.35:
+        media = "".join(
+            f'<div data-testid="tweetPhoto"><img alt="Image" '
+            f'src="https://pbs.twimg.com/media/F{index}x{i}?format=jpg&amp;name=small"></div>'
+            for i in range(rng.randint(1, 4))
+        )
+    elif roll < 0.45:
+        media = '<div data-testid="videoPlayer"><video preload="none"></video></div>'
+    return (
+        '<article data-testid="tweet" tabindex="0">'
+        f"{social_context}"
+        '<div data-testid="User-Name">'
+        f'<div><a href="/{handle}"><span>{handle.replace("_", " ").title()}</span></a></div>'
+        f'<div><a href="/{handle}"><span>@{handle}</span></a></div>'
+        f'<div><a href="/{handle}/status/{tweet_id}">'
+        f'<time datetime="{created_at.strftime("%Y-%m-%dT%H:%M:%S.000Z")}">'
+        f'{created_at.strftime("%b %d")}</time></a></div>'
+        "</div>"
+        f'<div data-testid="tweetText" lang="{rng.choice(LANGS)}"><span>{words}</span>{link}</div>'
+        f"{media}"
+        f"{_count_group(rng.randrange(200), rng.randrange(1000), rng.randrange(50_000))}"
+        "</article>\n"
+    )
+
+
+def write_fixture(filename, num_tweets, seed=0, newest=datetime(2024, 3, 31, 23)):
+    # Tweets are spread one per ~5 minutes going back from `newest`; returns the date
+    # range (YYYY-MM-DD) covering all of them
+    rng = random.Random(seed)
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    created_at = newest
+    with open(filename, "w", encoding="utf-8") as file:
+        file.write(PAGE_HEADER)
+        for index in range(num_tweets):
+            file.write(make_tweet_html(rng, index, created_at))
+            created_at -= timedelta(seconds=rng.randint(60, 540))
+        file.write(PAGE_FOOTER)
+    return created_at.strftime("%Y-%m-%d"), newest.strftime("%Y-%m-%d")
+
+
+def fixture_filename(directory, num_tweets):
+    return os.path.join(directory, f"timeline_{num_tweets}.html")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic timeline fixtures.")
+    parser.add_argument("--output-dir", default="benchmarks/fixtures")
+    parser.add_argument("--sizes", type=int, nargs="+", default=FIXTURE_SIZES)
+    args = parser.parse_args()
+    for size in args.sizes:
+        filename = fixture_filename(args.output_dir, size)
+        print(filename, *write_fixture(filename, size))
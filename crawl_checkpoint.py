@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# Per-URL crawl checkpoints, so that incremental runs only scroll through new items and
+# interrupted runs resume instead of starting over.
+from datetime import datetime
+import json
+import logging
+import os
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+PROCESS, SKIP, STOP = "process", "skip", "stop"
+
+
+class CrawlCheckpoints:
+    # Checkpoints of every crawled URL, stored in a single JSON file:
+    # {page_url: {"head_urls": [...], "completed_at": ..., "partial": {...} or None}}
+    def __init__(self, filename="data/crawl_checkpoints.json"):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._state = {}
+        if os.path.exists(filename):
+            with open(filename, encoding="utf-8") as file:
+                self._state = json.load(file)
+
+    def get(self, page_url):
+        with self._lock:
+            return json.loads(json.dumps(self._state.get(page_url, {})))
+
+    def update(self, page_url, checkpoint):
+        with self._lock:
+            self._state[page_url] = checkpoint
+            # Write-then-rename so a crash never leaves a truncated checkpoint file
+            tmp_filename = f"{self.filename}.tmp"
+            with open(tmp_filename, "w", encoding="utf-8") as file:
+                json.dump(self._state, file, indent=1)
+            os.replace(tmp_filename, self.filename)
+
+
+class IncrementalCrawl:
+    # Tracks one crawl of `page_url` against its checkpoint. Timelines are walked newest
+    # first, so the run stops at the newest tweets of the last completed run (its head
+    # URLs), and skips the ranges already covered by interrupted runs.
+    def __init__(self, checkpoints, page_url, num_head_urls=20, save_every=20):
+        self.checkpoints = checkpoints
+        self.page_url = page_url
+        self.num_head_urls = num_head_urls
+        self.save_every = save_every
+
+        checkpoint = checkpoints.get(page_url)
+        self._previous_heads = checkpoint.get("head_urls", [])
+        self._known_heads = set(self._previous_heads)
+        partial = checkpoint.get("partial") or {}
+        self._pending_ranges = partial.get("ranges", [])
+        self.output_filename = partial.get("output")
+
+        self._run_urls = []
+        self._last_url = None
+        self._skip_until = None
+        self._consecutive_known = 0
+        self._num_recorded = 0
+        # Called before progress is saved, e.g. to flush buffered output
+        self.on_save = None
+
+    def check(self, url):
+        if not url:
+            return PROCESS
+        if url in self._known_heads:
+            # Two in a row, so that a pinned tweet on a profile does not end the run
+            self._consecutive_known += 1
+            if self._consecutive_known >= min(2, len(self._known_heads)):
+                logger.info(f"Reached already ingested content at {url}, stopping.")
+                return STOP
+            return SKIP
+        self._consecutive_known = 0
+
+        if self._skip_until:
+            if url == self._skip_until:
+                self._skip_until = None
+            self._last_url = url
+            return SKIP
+        for covered in self._pending_ranges:
+            if url in covered["head_urls"]:
+                logger.info(f"Skipping tweets ingested by an interrupted run, up to {covered['last_url']}.")
+                self._pending_ranges.remove(covered)
+                if url != covered["last_url"]:
+                    self._skip_until = covered["last_url"]
+                self._last_url = url
+                return SKIP
+        return PROCESS
+
+    def record(self, row):
+        # Only tweets that were written become head URLs: one skipped by the date range
+        # must not stop a later run that covers its date
+        if len(self._run_urls) < self.num_head_urls:
+            self._run_urls.append(row.url)
+        self._last_url = row.url
+        self._num_recorded += 1
+        if self._num_recorded % self.save_every == 0:
+            self.interrupt()
+
+    def interrupt(self):
+        # Saves the progress of this run as a covered range, to be skipped on resume
+        if self.on_save:
+            self.on_save()
+        ranges = list(self._pending_ranges)
+        if self._last_url:
+            ranges.insert(0, {"head_urls": self._run_urls, "last_url": self._last_url})
+        checkpoint = self.checkpoints.get(self.page_url)
+        checkpoint["partial"] = {
+            "ranges": ranges,
+            "output": self.output_filename,
+            "updated_at": datetime.now().isoformat(timespec="seconds"),
+        }
+        self.checkpoints.update(self.page_url, checkpoint)
+
+    def complete(self):
+        head_urls = list(dict.fromkeys(self._run_urls + self._previous_heads))
+        self.checkpoints.update(
+            self.page_url,
+            {
+                "head_urls": head_urls[: self.num_head_urls],
+                "completed_at": datetime.now().isoformat(timespec="seconds"),
+                "partial": None,
+            },
+        )
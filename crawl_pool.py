@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+# Crawls many profile/likes timelines in parallel, one Chrome process per worker.
+from collections import namedtuple
+from datetime import datetime
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+from config import TWITTER_AUTH_TOKEN
+from crawl_checkpoint import CrawlCheckpoints
+from rate_limit import TokenBucket
+from seen_index import SeenIndex
+from tweet_store import TweetStore
+from tweet_writer import TweetWriter, read_records
+from twitter_data_ingestion import TwitterExtractor
+
+
+logger = logging.getLogger(__name__)
+
+# start_date / end_date in YYYY-MM-DD format, like `TwitterExtractor.fetch_tweets`
+CrawlJob = namedtuple("CrawlJob", ["page_url", "start_date", "end_date"])
+
+
+class SharedTweetStore:
+    # Thread-safe JSONL store shared by all workers, deduplicated on the tweet ID as rows
+    # arrive. Pass a persistent SeenIndex to also dedup across runs and processes.
+    def __init__(self, filename, writer_options=None, seen_index=None):
+        self.filename = filename
+        if seen_index is None:
+            seen_index = SeenIndex(":memory:", use_bloom_filter=False)
+        self.seen_index = seen_index
+        self.num_saved = 0
+        self.num_duplicates = 0
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            for record in read_records(filename):
+                self.seen_index.add(record.tweet_id)
+            self.seen_index.commit()
+        self._writer = TweetWriter(
+            filename, on_flush=self.seen_index.commit, **(writer_options or {})
+        )
+
+    def add(self, row):
+        if not self.seen_index.add(row.tweet_id):
+            with self._lock:
+                self.num_duplicates += 1
+            return False
+        with self._lock:
+            self.num_saved += 1
+        self._writer.write(row)
+        return True
+
+    def flush(self):
+        self._writer.flush()
+
+    def close(self):
+        self._writer.close()
+
+    def __len__(self):
+        return self.num_saved
+
+
+class CrawlWorker(threading.Thread):
+    def __init__(
+        self,
+        name,
+        jobs,
+        store,
+        rate_limiter,
+        auth_token=TWITTER_AUTH_TOKEN,
+        mode="dom",
+        checkpoints=None,
+        max_attempts=3,
+        backoff_base=5,
+        backoff_max=300,
+        extractor_kwargs=None,
+        metrics=None,
+    ):
+        # With `checkpoints`, every job is crawled incrementally (see crawl_checkpoint.py).
+        # metrics: an IngestMetrics shared by the workers, finished by the pool.
+        super().__init__(name=name, daemon=True)
+        self.jobs = jobs
+        self.store = store
+        self.rate_limiter = rate_limiter
+        self.auth_token = auth_token
+        self.mode = mode
+        self.checkpoints = checkpoints
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.extractor_kwargs = extractor_kwargs or {}
+        self.metrics = metrics
+        self.num_saved = 0
+        # The worker's Chrome could not be started
+        self.failed = False
+        self._consecutive_reload_errors = 0
+
+    def run(self):
+        # The extractor skips tweets the shared store has already seen
+        extractor_kwargs = dict(self.extractor_kwargs)
+        if self.metrics is not None:
+            extractor_kwargs["metrics"] = self.metrics
+        try:
+            extractor = TwitterExtractor(
+                auth_token=self.auth_token,
+                seen_index=self.store.seen_index,
+                **extractor_kwargs,
+            )
+        except Exception as e:
+            # The jobs stay queued for the other workers
+            self.failed = True
+            logger.error(f"[{self.name}] Could not start the browser: {e}")
+            return
+        extractor.on_reload_error = self._backoff
+        try:
+            while True:
+                try:
+                    job, attempt = self.jobs.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    self._crawl(extractor, job)
+                except Exception as e:
+                    logger.error(f"[{self.name}] Failed {job.page_url} (attempt {attempt}): {e}")
+                    if attempt < self.max_attempts:
+                        self.jobs.put((job, attempt + 1))
+                finally:
+                    self.jobs.task_done()
+        finally:
+            extractor.driver.quit()
+
+    def _crawl(self, extractor, job):
+        logger.info(f"[{self.name}] Crawling {job.page_url} ({job.start_date} - {job.end_date})")
+        # One token per page load and per tweet, shared by all workers
+        self.rate_limiter.acquire()
+        extractor.fetch_tweets(
+            job.page_url,
+            job.start_date,
+            job.end_date,
+            mode=self.mode,
+            writer=self,
+            incremental=self.checkpoints is not None,
+            checkpoints=self.checkpoints,
+            # The pool summarizes the metrics of all its jobs once they are done
+            finish_metrics=False,
+        )
+
+    # Workers are the writers `fetch_tweets` sends rows to
+    def write(self, row):
+        self._consecutive_reload_errors = 0
+        self.rate_limiter.acquire()
+        if self.store.add(row):
+            self.num_saved += 1
+
+    def flush(self):
+        self.store.flush()
+
+    def _backoff(self, reload_errors):
+        # Exponential backoff with jitter on repeated 'Try reloading' errors in this worker
+        self._consecutive_reload_errors += 1
+        delay = min(
+            self.backoff_max,
+            self.backoff_base * 2 ** (self._consecutive_reload_errors - 1),
+        )
+        delay *= random.uniform(0.5, 1.0)
+        logger.info(f"[{self.name}] 'Try reloading' error, backing off {delay:.1f}s.")
+        time.sleep(delay)
+
+
+class CrawlPool:
+    def __init__(
+        self,
+        num_workers=4,
+        auth_tokens=None,
+        max_tweets_per_second=10,
+        output_filename=None,
+        mode="dom",
+        incremental=False,
+        writer_options=None,
+        seen_index=None,
+        tweet_store=None,
+        metrics=None,
+        **worker_kwargs,
+    ):
+        # auth_tokens: optional list of tokens, assigned to workers round-robin.
+        # metrics: an IngestMetrics shared by all workers, summarized once per run.
+        self.num_workers = num_workers
+        self.auth_tokens = auth_tokens or [TWITTER_AUTH_TOKEN]
+        self.rate_limiter = TokenBucket(max_tweets_per_second)
+        self.output_filename = (
+            output_filename
+            or f"data/crawl_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json"
+        )
+        self.writer_options = writer_options
+        self.seen_index = seen_index
+        self.tweet_store = tweet_store if tweet_store is not None else TweetStore()
+        self.store = None
+        self.mode = mode
+        # One checkpoint file shared by all workers
+        self.checkpoints = CrawlCheckpoints() if incremental else None
+        self.metrics = metrics
+        self.worker_kwargs = worker_kwargs
+
+    def run(self, jobs, export="parquet"):
+        # export: "parquet" (append to the tweet store), "excel" or None
+        self.store = SharedTweetStore(
+            self.output_filename, self.writer_options, self.seen_index
+        )
+        job_queue = queue.Queue()
+        for job in jobs:
+            job_queue.put((CrawlJob(*job), 1))
+
+        workers = [
+            CrawlWorker(
+                f"worker-{i}",
+                job_queue,
+                self.store,
+                self.rate_limiter,
+                auth_token=self.auth_tokens[i % len(self.auth_tokens)],
+                mode=self.mode,
+                checkpoints=self.checkpoints,
+                metrics=self.metrics,
+                **self.worker_kwargs,
+            )
+            for i in range(min(self.num_workers, job_queue.qsize()))
+        ]
+        start_time = time.monotonic()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.store.close()
+
+        elapsed = time.monotonic() - start_time
+        num_failed = sum(worker.failed for worker in workers)
+        logger.info(
+            f"Crawled {len(self.store)} unique tweets ({self.store.num_duplicates} duplicates skipped) "
+            f"in {elapsed:.0f}s with {len(workers) - num_failed} workers."
+        )
+        summary = self.metrics.finish() if self.metrics is not None else None
+        if summary:
+            logger.info(
+                f"Saved {summary['tweets']} tweets in {summary['elapsed_seconds']:.0f}s "
+                f"({summary['tweets_per_second']:.1f} tweets/s across the pool)."
+            )
+        # Workers drain the queue until it is empty, so jobs are only left when every
+        # worker failed to start
+        if not job_queue.empty():
+            raise RuntimeError(
+                f"{job_queue.qsize()} jobs were not crawled: {num_failed} of {len(workers)} "
+                "workers could not start their browser."
+            )
+        if export == "parquet" and len(self.store):
+            self.tweet_store.append_jsonl(self.output_filename)
+        elif export == "excel" and len(self.store):
+            TwitterExtractor._save_to_excel(
+                json_filename=self.output_filename,
+                output_filename=self.output_filename.split(".json")[0] + ".xlsx",
+                drop_duplicates=False,
+            )
+        return self.output_filename
+
+
+if __name__ == "__main__":
+    pool = CrawlPool(num_workers=2, max_tweets_per_second=5)
+    pool.run(
+        [
+            ("https://twitter.com/elonmusk/likes", "2024-03-01", "2024-03-02"),
+            ("https://twitter.com/ilyasut/likes", "2024-03-01", "2024-03-02"),
+        ]
+    )  # YYYY-MM-DD format
@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+# Incremental image embedding index. Rows of the matrix are appended, never rewritten; the
+# index maps each image (path relative to the folder) to its size, mtime, content hash,
+# perceptual hashes, row and tweet ID, so only new or changed images are embedded again.
+#
+# Embeddings are stored L2-normalized as a raw row-major matrix of `dtype`, float32,
+# float16 or int8 (with a float32 scale per row in a second file), and loaded with
+# np.memmap: loading is instant and every session and process shares the page cache.
+import hashlib
+import json
+import logging
+import os
+import uuid
+
+import numpy as np
+
+from image_dedup import (
+    DEFAULT_MAX_DISTANCE,
+    NearDuplicateIndex,
+    hash_files,
+    hash_from_hex,
+    hash_to_hex,
+)
+from image_downloader import sha256_file, tweet_id_from_image_id
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = "embedding_index.json"
+FORMAT_VERSION = 2
+MATRIX_SUFFIXES = {"float32": "f32", "float16": "f16", "int8": "i8"}
+# Rows converted to float32 at a time when computing similarities
+SIMILARITY_CHUNK_ROWS = 16384
+
+
+def normalize(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def quantize(embeddings, dtype):
+    # (vectors, scales): int8 is symmetric per row, vector * scale restores the float
+    if dtype != "int8":
+        return embeddings.astype(dtype), None
+    scales = np.abs(embeddings).max(axis=1) / 127
+    scales[scales == 0] = 1
+    vectors = np.rint(embeddings / scales[:, None]).astype(np.int8)
+    return vectors, scales.astype(np.float32)
+
+
+def _tweet_id(file_path):
+    return tweet_id_from_image_id(os.path.splitext(os.path.basename(file_path))[0])
+
+
+def _append(filename, array):
+    with open(filename, "ab") as f:
+        f.write(np.ascontiguousarray(array).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _set_hashes(entry, hashes):
+    # Hex strings in the JSON index, None for images that cannot be decoded
+    entry["phash"] = hash_to_hex(hashes[0]) if hashes is not None else None
+    entry["dhash"] = hash_to_hex(hashes[1]) if hashes is not None else None
+
+
+class EmbeddingMatrix:
+    # Read-only view of an index: vectors[rows[i]] (times scales[rows[i]] for int8) is the
+    # normalized embedding of file_paths[i], and tweet_ids[i] the tweet of the image (-1
+    # when the file name does not follow image_downloader's naming). Rows not referenced
+    # by any file are garbage left for `EmbeddingIndex.compact`.
+    def __init__(self, vectors, scales, rows, file_paths, tweet_ids=None):
+        self.vectors = vectors
+        self.scales = scales
+        self.rows = rows
+        self.file_paths = file_paths
+        if tweet_ids is None:
+            tweet_ids = np.full(len(file_paths), -1, dtype=np.int64)
+        self.tweet_ids = tweet_ids
+        self._group_sizes = None
+
+    def group_sizes(self):
+        # Number of files sharing the row of each file: its identical and near-duplicate
+        # copies, itself included
+        if self._group_sizes is None:
+            self._group_sizes = np.bincount(self.rows)[self.rows] if len(self.rows) else self.rows
+        return self._group_sizes
+
+    def similarities(self, query_embeddings):
+        # Cosine similarities of the files to each query, (num_files,) for a single query
+        # and (num_queries, num_files) for several
+        queries = normalize(query_embeddings)
+        single = queries.ndim == 1
+        queries = queries.reshape(-1, self.vectors.shape[1])
+        scores = np.empty((len(self.vectors), len(queries)), dtype=np.float32)
+        for start in range(0, len(self.vectors), SIMILARITY_CHUNK_ROWS):
+            chunk = np.asarray(self.vectors[start : start + SIMILARITY_CHUNK_ROWS], dtype=np.float32)
+            scores[start : start + len(chunk)] = chunk @ queries.T
+        if self.scales is not None:
+            scores *= self.scales[:, None]
+        scores = scores[self.rows].T
+        return scores[0] if single else scores
+
+    def vectors_of(self, indices):
+        # Normalized float32 embeddings of the files at `indices`
+        rows = self.rows[indices]
+        vectors = self.vectors[rows].astype(np.float32, copy=False)
+        if self.scales is not None:
+            vectors *= self.scales[rows, None]
+        return vectors
+
+    def fingerprint(self):
+        # Identifies the files and rows, e.g. to tell whether an index built on this
+        # matrix is stale
+        matrix_filename = getattr(self.vectors, "filename", None) or ""
+        digest = hashlib.sha1(os.path.basename(matrix_filename).encode("utf-8"))
+        digest.update(self.rows.tobytes())
+        digest.update("\0".join(self.file_paths).encode("utf-8"))
+        return digest.hexdigest()
+
+    @property
+    def dim(self):
+        return self.vectors.shape[1]
+
+    def __len__(self):
+        return len(self.file_paths)
+
+
+class EmbeddingIndex:
+    # The index is tied to one model, dtype and encoder backend (see image_search.BACKENDS,
+    # the ONNX embeddings drift slightly from PyTorch's): opened with other settings it is
+    # empty, and the existing embeddings are only replaced once `update` saves the index
+    # with the new settings (`replaces` holds those they were made with until then).
+    # Identical files (same sha256) share a row, and so do near-duplicates (perceptual
+    # hashes within `max_hash_distance` bits, see image_dedup; None turns that off), so
+    # only one image of each group is embedded. Rows of deleted or changed files stay in
+    # the matrix until `compact`, which runs once they exceed `max_garbage_ratio`.
+    # Any number of readers can `load` while one process updates the index.
+    def __init__(
+        self,
+        folder_path,
+        model_name,
+        dtype="float16",
+        backend="torch",
+        max_garbage_ratio=0.5,
+        max_hash_distance=DEFAULT_MAX_DISTANCE,
+    ):
+        if dtype not in MATRIX_SUFFIXES:
+            raise ValueError(f"Unknown embedding dtype: {dtype}")
+        self.folder_path = os.path.abspath(folder_path)
+        self.model_name = model_name
+        self.dtype = dtype
+        self.backend = backend
+        self.max_garbage_ratio = max_garbage_ratio
+        self.max_hash_distance = max_hash_distance
+        self.index_filename = os.path.join(self.folder_path, INDEX_FILENAME)
+        self.matrix_name = None
+        self.dim = None
+        self.num_rows = 0
+        self.files = {}
+        self.replaces = None
+        # Entries of the images returned by `update`, completed by `add`
+        self._pending = {}
+        # Representative file path -> [(file path, entry)] of its near-duplicates among
+        # the pending images, which get its row once it is added
+        self._duplicates = {}
+        self._load_index()
+
+    @classmethod
+    def open(cls, folder_path, **kwargs):
+        # The existing index of a folder, with the model, dtype and backend it was built with
+        with open(os.path.join(folder_path, INDEX_FILENAME), encoding="utf-8") as f:
+            index = json.load(f)
+        return cls(
+            folder_path,
+            index["model"],
+            index.get("dtype", "float32"),
+            index.get("backend", "torch"),
+            **kwargs,
+        )
+
+    @property
+    def matrix_filename(self):
+        return os.path.join(self.folder_path, self.matrix_name)
+
+    @property
+    def scales_filename(self):
+        return f"{self.matrix_filename}.scales"
+
+    def version(self):
+        # Changes whenever the index is saved, e.g. as a cache key for `load`
+        if not os.path.exists(self.index_filename):
+            return None
+        return os.stat(self.index_filename).st_mtime_ns
+
+    def _new_matrix_name(self):
+        return f"embeddings-{uuid.uuid4().hex[:8]}.{MATRIX_SUFFIXES[self.dtype]}"
+
+    def _load_index(self):
+        index = None
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename, encoding="utf-8") as f:
+                index = json.load(f)
+        # Indexes saved before the backend was recorded were all embedded with PyTorch
+        if index is None or (
+            index.get("version"),
+            index["model"],
+            index.get("dtype"),
+            index.get("backend", "torch"),
+        ) != (FORMAT_VERSION, self.model_name, self.dtype, self.backend):
+            if index is not None:
+                self.replaces = {
+                    "model": index["model"],
+                    "dtype": index.get("dtype", "float32"),
+                    "backend": index.get("backend", "torch"),
+                    "matrix": index["matrix"],
+                }
+                logger.info(
+                    f"Embeddings were made with {index['model']} ({self.replaces['dtype']}, "
+                    f"{self.replaces['backend']}), not {self.model_name} ({self.dtype}, "
+                    f"{self.backend}): the images need to be embedded again."
+                )
+            self.matrix_name = self._new_matrix_name()
+            return
+        self.matrix_name = index["matrix"]
+        self.dim = index["dim"]
+        self.num_rows = index["num_rows"]
+        self.files = index["files"]
+
+    def _truncate(self):
+        # Rows appended by a run that crashed before saving the index are dropped
+        if not self.dim:
+            return
+        for filename, row_size in (
+            (self.matrix_filename, self.dim * np.dtype(self.dtype).itemsize),
+            (self.scales_filename, 4),
+        ):
+            if os.path.exists(filename) and os.path.getsize(filename) > self.num_rows * row_size:
+                os.truncate(filename, self.num_rows * row_size)
+
+    def _remove_matrix(self, matrix_name):
+        matrix_filename = os.path.join(self.folder_path, matrix_name)
+        for filename in (matrix_filename, f"{matrix_filename}.scales"):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def _save_index(self):
+        # Atomic, and the only place that points the index at a matrix file. The matrix of
+        # embeddings made with other settings is removed once nothing points at it.
+        tmp_filename = f"{self.index_filename}.tmp"
+        with open(tmp_filename, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "version": FORMAT_VERSION,
+                    "model": self.model_name,
+                    "dtype": self.dtype,
+                    "backend": self.backend,
+                    "matrix": self.matrix_name,
+                    "dim": self.dim,
+                    "num_rows": self.num_rows,
+                    "files": self.files,
+                },
+                f,
+            )
+        os.replace(tmp_filename, self.index_filename)
+        if self.replaces is not None:
+            self._remove_matrix(self.replaces["matrix"])
+            self.replaces = None
+
+    def update(self, file_paths):
+        # Syncs the index with the images on disk and returns those that need embedding.
+        # Unchanged size and mtime means an unchanged file; otherwise the file is hashed,
+        # and a known hash reuses its row. The remaining images are matched by perceptual
+        # hash against the index and each other, and only one image per group is returned.
+        self._truncate()
+        rows_by_hash = {entry["sha256"]: entry["row"] for entry in self.files.values()}
+        current = {
+            os.path.relpath(file_path, self.folder_path): file_path
+            for file_path in file_paths
+        }
+        files, to_embed = {}, []
+        self._pending, self._duplicates = {}, {}
+        for relative_path, file_path in current.items():
+            stat = os.stat(file_path)
+            entry = self.files.get(relative_path)
+            if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+                # Entries written before tweet IDs were recorded
+                entry.setdefault("tweet_id", _tweet_id(file_path))
+                files[relative_path] = entry
+                continue
+            entry = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "sha256": sha256_file(file_path),
+                "tweet_id": _tweet_id(file_path),
+            }
+            if entry["sha256"] in rows_by_hash:
+                entry["row"] = rows_by_hash[entry["sha256"]]
+                files[relative_path] = entry
+            else:
+                self._pending[file_path] = entry
+                to_embed.append(file_path)
+        num_removed = len(set(self.files) - set(current))
+        self.files = files
+        num_up_to_date, num_duplicates = len(files), 0
+        if to_embed and self.max_hash_distance is not None:
+            to_embed, num_duplicates = self._group_near_duplicates(to_embed)
+        self._save_index()
+        if self.garbage_ratio() > self.max_garbage_ratio:
+            self.compact()
+        logger.info(
+            f"{num_up_to_date} images up to date, {len(to_embed)} to embed, "
+            f"{num_duplicates} near-duplicates, {num_removed} removed."
+        )
+        return to_embed
+
+    def _group_near_duplicates(self, file_paths):
+        # (the file paths to embed, number of near-duplicates). Near-duplicates of an
+        # indexed image get its row now, those of a pending image wait for it in `add`.
+        # Indexed images that have no perceptual hashes yet are hashed first.
+        unhashed = [
+            relative_path for relative_path, entry in self.files.items() if "phash" not in entry
+        ]
+        hashes = hash_files(
+            file_paths
+            + [os.path.join(self.folder_path, relative_path) for relative_path in unhashed]
+        )
+        for relative_path, file_hashes in zip(unhashed, hashes[len(file_paths) :]):
+            _set_hashes(self.files[relative_path], file_hashes)
+
+        # Keys are rows for indexed images and file paths for pending ones
+        index = NearDuplicateIndex(self.max_hash_distance)
+        for entry in self.files.values():
+            if entry["row"] not in index and entry["phash"] is not None:
+                index.add(
+                    entry["row"], (hash_from_hex(entry["phash"]), hash_from_hex(entry["dhash"]))
+                )
+        to_embed, num_duplicates = [], 0
+        for file_path, file_hashes in zip(file_paths, hashes):
+            entry = self._pending[file_path]
+            _set_hashes(entry, file_hashes)
+            match = index.find(file_hashes) if file_hashes is not None else None
+            if match is None:
+                if file_hashes is not None:
+                    index.add(file_path, file_hashes)
+                to_embed.append(file_path)
+                continue
+            num_duplicates += 1
+            del self._pending[file_path]
+            if isinstance(match, str):
+                self._duplicates.setdefault(match, []).append((file_path, entry))
+            else:
+                entry["row"] = match
+                self.files[os.path.relpath(file_path, self.folder_path)] = entry
+        return to_embed, num_duplicates
+
+    def add(self, file_paths, embeddings):
+        # Appends the embeddings of (some of) the images returned by `update`
+        if not len(file_paths):
+            return
+        embeddings = normalize(embeddings)
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+        elif embeddings.shape[1] != self.dim:
+            raise ValueError(
+                f"Expected {self.dim}-dimensional embeddings, got {embeddings.shape[1]}."
+            )
+        vectors, scales = quantize(embeddings, self.dtype)
+        _append(self.matrix_filename, vectors)
+        if scales is not None:
+            _append(self.scales_filename, scales)
+        for offset, file_path in enumerate(file_paths):
+            entry = self._pending.pop(file_path)
+            entry["row"] = self.num_rows + offset
+            self.files[os.path.relpath(file_path, self.folder_path)] = entry
+            for duplicate_path, duplicate_entry in self._duplicates.pop(file_path, ()):
+                duplicate_entry["row"] = entry["row"]
+                self.files[os.path.relpath(duplicate_path, self.folder_path)] = duplicate_entry
+        self.num_rows += len(file_paths)
+        self._save_index()
+        if self.garbage_ratio() > self.max_garbage_ratio:
+            self.compact()
+
+    def garbage_ratio(self):
+        if not self.num_rows:
+            return 0.0
+        used_rows = {entry["row"] for entry in self.files.values()}
+        return 1 - len(used_rows) / self.num_rows
+
+    def _matrix(self):
+        # (vectors, scales) memory-mapped, scales is None unless the dtype is int8
+        if not self.num_rows:
+            return np.empty((0, self.dim or 0), dtype=self.dtype), None
+        vectors = np.memmap(
+            self.matrix_filename, dtype=self.dtype, mode="r", shape=(self.num_rows, self.dim)
+        )
+        scales = None
+        if self.dtype == "int8":
+            scales = np.memmap(
+                self.scales_filename, dtype=np.float32, mode="r", shape=(self.num_rows,)
+            )
+        return vectors, scales
+
+    def load(self):
+        # EmbeddingMatrix of the indexed images, sorted by path. Nothing is read until
+        # the matrix is used.
+        relative_paths = sorted(self.files)
+        rows = np.array(
+            [self.files[relative_path]["row"] for relative_path in relative_paths],
+            dtype=np.int64,
+        )
+        tweet_ids = np.array(
+            [
+                -1 if self.files[relative_path].get("tweet_id") is None
+                else self.files[relative_path]["tweet_id"]
+                for relative_path in relative_paths
+            ],
+            dtype=np.int64,
+        )
+        vectors, scales = self._matrix()
+        return EmbeddingMatrix(
+            vectors,
+            scales,
+            rows,
+            [os.path.join(self.folder_path, relative_path) for relative_path in relative_paths],
+            tweet_ids,
+        )
+
+    def compact(self):
+        # Writes the used rows to a new matrix file and switches the index to it
+        old_rows = sorted({entry["row"] for entry in self.files.values()})
+        new_rows = {old_row: new_row for new_row, old_row in enumerate(old_rows)}
+        vectors, scales = self._matrix()
+        old_matrix_name = self.matrix_name
+        self.matrix_name = self._new_matrix_name()
+        _append(self.matrix_filename, vectors[old_rows])
+        if scales is not None:
+            _append(self.scales_filename, scales[old_rows])
+        del vectors, scales
+        for entry in self.files.values():
+            entry["row"] = new_rows[entry["row"]]
+        logger.info(f"Compacted embeddings from {self.num_rows} to {len(old_rows)} rows.")
+        self.num_rows = len(old_rows)
+        self._save_index()
+        self._remove_matrix(old_matrix_name)
+
+    def __len__(self):
+        return len(self.files)
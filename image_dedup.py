@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+# Near-duplicate images (reposts, retweets, recompressed or resized copies): every image
+# gets a 64-bit pHash (DCT of a 32x32 grayscale copy) and dHash (gradient of a 9x8 copy),
+# and two images are near-duplicates when both hashes are within `max_distance` bits.
+# NearDuplicateIndex finds them with a multi-index hash table instead of comparing every
+# pair. EmbeddingIndex uses it to embed one image per group.
+#
+#   python image_dedup.py downloaded_images
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import itertools
+import json
+import logging
+
+import numpy as np
+from PIL import Image
+
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+# Up to 6 of 64 bits differ between JPEG re-encodings and resizes of the same picture,
+# while unrelated images differ by about half
+DEFAULT_MAX_DISTANCE = 6
+_DCT_SIZE = 32
+
+
+def _dct_matrix(size):
+    # Orthonormal DCT-II: _DCT @ x is the DCT of x
+    k = np.arange(size)[:, None]
+    matrix = np.cos(np.pi * (2 * np.arange(size)[None, :] + 1) * k / (2 * size))
+    matrix[0] /= np.sqrt(2)
+    return matrix * np.sqrt(2 / size)
+
+
+_DCT = _dct_matrix(_DCT_SIZE)
+
+
+def _bits_to_int(bits):
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def _grayscale(image, size):
+    return np.asarray(image.convert("L").resize(size, Image.BILINEAR), dtype=np.float32)
+
+
+def phash(image):
+    # The 8x8 lowest frequencies of the DCT (without the DC term), above or below median
+    pixels = _grayscale(image, (_DCT_SIZE, _DCT_SIZE))
+    frequencies = (_DCT @ pixels @ _DCT.T)[:8, :8].ravel()
+    return _bits_to_int(frequencies > np.median(frequencies[1:]))
+
+
+def dhash(image):
+    # Whether each pixel of a 9x8 copy is brighter than its right neighbor
+    pixels = _grayscale(image, (9, 8))
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def image_hashes(path):
+    # (phash, dhash) of an image file, None when it cannot be read
+    try:
+        with Image.open(path) as image:
+            # JPEGs are decoded at a reduced scale, the hashes only need a few pixels
+            image.draft("RGB", (64, 64))
+            return phash(image), dhash(image)
+    except Exception as e:
+        logger.warning(f"Cannot hash {path}: {e}")
+        return None
+
+
+def hash_files(file_paths, num_workers=8):
+    # [(phash, dhash) or None] in the order of file_paths
+    with ThreadPoolExecutor(num_workers) as executor:
+        return list(executor.map(image_hashes, file_paths))
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+class MultiIndexHash:
+    # Hamming-radius search over 64-bit hashes. Each hash is split into `num_chunks`
+    # chunks with one table per chunk. Two hashes within max_distance bits differ by at
+    # most max_distance // num_chunks bits in at least one chunk (pigeonhole), so only
+    # the keys stored under those nearby chunk values are compared.
+    def __init__(self, max_distance=DEFAULT_MAX_DISTANCE, num_chunks=4):
+        self.max_distance = max_distance
+        self.num_chunks = num_chunks
+        self.chunk_bits = HASH_BITS // num_chunks
+        self._chunk_mask = (1 << self.chunk_bits) - 1
+        self._tables = [{} for _ in range(num_chunks)]
+        # XOR masks of every chunk value within max_distance // num_chunks bits
+        radius = max_distance // num_chunks
+        self._flips = [
+            sum(1 << bit for bit in bits)
+            for distance in range(radius + 1)
+            for bits in itertools.combinations(range(self.chunk_bits), distance)
+        ]
+        self._hashes = {}
+
+    def _chunks(self, hash_value):
+        return [
+            (hash_value >> (i * self.chunk_bits)) & self._chunk_mask
+            for i in range(self.num_chunks)
+        ]
+
+    def add(self, key, hash_value):
+        self._hashes[key] = hash_value
+        for table, chunk in zip(self._tables, self._chunks(hash_value)):
+            table.setdefault(chunk, []).append(key)
+
+    def query(self, hash_value):
+        # [(key, distance)] of the hashes within max_distance, closest first
+        candidates = set()
+        for table, chunk in zip(self._tables, self._chunks(hash_value)):
+            for flip in self._flips:
+                candidates.update(table.get(chunk ^ flip, ()))
+        matches = [(key, hamming(hash_value, self._hashes[key])) for key in candidates]
+        return sorted(
+            (match for match in matches if match[1] <= self.max_distance),
+            key=lambda match: match[1],
+        )
+
+    def __len__(self):
+        return len(self._hashes)
+
+
+class NearDuplicateIndex:
+    # Keys (e.g. file paths) of images by their (phash, dhash). The pHash table finds the
+    # candidates, the dHash confirms them, which keeps apart different images that
+    # happen to have close pHashes (e.g. screenshots of text).
+    def __init__(self, max_distance=DEFAULT_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self._phashes = MultiIndexHash(max_distance)
+        self._dhashes = {}
+
+    def add(self, key, hashes):
+        self._phashes.add(key, hashes[0])
+        self._dhashes[key] = hashes[1]
+
+    def find(self, hashes):
+        # Key of the closest near-duplicate, None when there is none
+        for key, distance in self._phashes.query(hashes[0]):
+            if hamming(hashes[1], self._dhashes[key]) <= self.max_distance:
+                return key
+        return None
+
+    def __contains__(self, key):
+        return key in self._dhashes
+
+    def __len__(self):
+        return len(self._dhashes)
+
+
+def group_near_duplicates(file_paths, max_distance=DEFAULT_MAX_DISTANCE, num_workers=8):
+    # Groups of near-duplicate files, each led by its first file; unreadable files are
+    # left out
+    index = NearDuplicateIndex(max_distance)
+    groups = {}
+    for file_path, hashes in zip(file_paths, hash_files(file_paths, num_workers)):
+        if hashes is None:
+            continue
+        representative = index.find(hashes)
+        if representative is None:
+            index.add(file_path, hashes)
+            groups[file_path] = [file_path]
+        else:
+            groups[representative].append(file_path)
+    return list(groups.values())
+
+
+def hash_to_hex(hash_value):
+    return f"{hash_value:016x}"
+
+
+def hash_from_hex(value):
+    return int(value, 16)
+
+
+if __name__ == "__main__":
+    from image_search import list_image_files
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    parser = argparse.ArgumentParser(description="Report near-duplicate images.")
+    parser.add_argument("folder_path")
+    parser.add_argument("--max-distance", type=int, default=DEFAULT_MAX_DISTANCE)
+    parser.add_argument("--num-workers", type=int, default=8)
+    parser.add_argument("--show", type=int, default=10, help="Print the largest groups.")
+    args = parser.parse_args()
+
+    file_paths = list_image_files(args.folder_path)
+    groups = group_near_duplicates(file_paths, args.max_distance, args.num_workers)
+    num_images = sum(len(group) for group in groups)
+    logger.info(
+        f"{num_images} images in {len(groups)} groups: embedding one image per group saves "
+        f"{1 - len(groups) / max(num_images, 1):.1%} of the embeddings."
+    )
+    for group in sorted(groups, key=len, reverse=True)[: args.show]:
+        if len(group) > 1:
+            print(json.dumps({"size": len(group), "files": group}))
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+# Downloads tweet images concurrently over pooled keep-alive connections, rate-limited per
+# host, and resumable: a manifest records every verified file, so reruns only fetch what
+# is missing. An image URL is fetched once: the tweets that share it (e.g. retweets) get a
+# hard link to the same file.
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import argparse
+import hashlib
+import logging
+import os
+import random
+import shutil
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from rate_limit import TokenBucket
+from tweet_record import dumps, loads
+
+
+logger = logging.getLogger(__name__)
+
+# image_id is `{twitter_name}__{tweet_id}_{i}` (i from 1), which the webapp maps back
+# to the tweet
+DownloadTask = namedtuple("DownloadTask", ["image_id", "url", "path"])
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def image_tasks(tweets, output_dir="downloaded_images"):
+    # tweets: (tweet url, images urls) pairs, e.g. zip(df["url"], df["images_urls"])
+    for tweet_url, images_urls in tweets:
+        if images_urls is None or not len(images_urls):
+            continue
+        path_parts = urlparse(tweet_url).path.split("/")
+        twitter_name, tweet_id = path_parts[1], path_parts[-1]
+        for i, image_url in enumerate(images_urls, start=1):
+            image_id = f"{twitter_name}__{tweet_id}_{i}"
+            yield DownloadTask(
+                image_id, image_url, os.path.join(output_dir, f"{image_id}.jpg")
+            )
+
+
+def tweet_id_from_image_id(image_id):
+    # The inverse of image_tasks: the integer tweet ID of `{twitter_name}__{tweet_id}_{i}`,
+    # None for other names. Twitter names can contain "__", the tweet ID is after the last.
+    try:
+        return int(image_id.rsplit("__", 1)[1].split("_")[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def sha256_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DownloadManifest:
+    # Append-only JSONL of {image_id, url, path, size, sha256}, the last entry of an
+    # image_id wins
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.entries_by_url = {}
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename, "rb") as file:
+                for line in file:
+                    if line.strip():
+                        entry = loads(line)
+                        self.entries[entry["image_id"]] = entry
+                        self.entries_by_url[entry["url"]] = entry
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(filename, "ab")
+
+    def get(self, image_id):
+        return self.entries.get(image_id)
+
+    def get_by_url(self, url):
+        # The last entry downloaded from url, under any image_id
+        return self.entries_by_url.get(url)
+
+    def add(self, entry):
+        with self._lock:
+            self.entries[entry["image_id"]] = entry
+            self.entries_by_url[entry["url"]] = entry
+            self._file.write(dumps(entry) + b"\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ImageDownloader:
+    # verify: "size" checks that a file listed in the manifest still has the recorded
+    # size, "sha256" also re-hashes it. Files on disk that the manifest does not know
+    # (e.g. from an older download) are kept when a HEAD request reports the same size, and
+    # downloaded again otherwise (also when the server rejects HEAD). `close` (or a with
+    # block) closes the connections and the manifest.
+    def __init__(
+        self,
+        output_dir="downloaded_images",
+        manifest_filename=None,
+        num_workers=8,
+        requests_per_second=5,
+        burst=None,
+        max_attempts=4,
+        backoff_base=1,
+        backoff_max=30,
+        timeout=(5, 30),
+        verify="size",
+        chunk_size=64 * 1024,
+    ):
+        if verify not in ("size", "sha256"):
+            raise ValueError(f"Unknown verify mode: {verify}")
+        self.output_dir = output_dir
+        self.manifest = DownloadManifest(
+            manifest_filename or os.path.join(output_dir, "manifest.jsonl")
+        )
+        self.num_workers = num_workers
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.verify = verify
+        self.chunk_size = chunk_size
+        self.stats = {"downloaded": 0, "linked": 0, "skipped": 0, "failed": 0, "bytes": 0}
+        self._host_buckets = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._sessions = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _session(self):
+        # One keep-alive session per worker thread
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._local.session = session
+            with self._lock:
+                self._sessions.append(session)
+        return session
+
+    def _throttle(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            bucket = self._host_buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(self.requests_per_second, self.burst)
+                self._host_buckets[host] = bucket
+        bucket.acquire()
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def download(self, tasks):
+        os.makedirs(self.output_dir, exist_ok=True)
+        start_time = time.monotonic()
+        # The first task of each URL runs first, so the others can link to its file
+        urls, later_tasks = set(), []
+
+        def first_of_url(tasks):
+            for task in tasks:
+                if task.url in urls:
+                    later_tasks.append(task)
+                else:
+                    urls.add(task.url)
+                    yield task
+
+        with ThreadPoolExecutor(self.num_workers) as executor:
+            for _ in executor.map(self._download_task, first_of_url(tasks)):
+                pass
+            for _ in executor.map(self._download_task, later_tasks):
+                pass
+        elapsed = time.monotonic() - start_time
+        logger.info(
+            f"Downloaded {self.stats['downloaded']} images ({self.stats['bytes'] / 1e6:.1f} MB) "
+            f"in {elapsed:.0f}s, linked {self.stats['linked']} already downloaded, "
+            f"skipped {self.stats['skipped']}, failed {self.stats['failed']}."
+        )
+        return dict(self.stats)
+
+    def download_df(self, df):
+        # df with the `url` and `images_urls` columns of the tweet data
+        return self.download(
+            image_tasks(zip(df["url"], df["images_urls"]), self.output_dir)
+        )
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            session.close()
+        self.manifest.close()
+
+    def _download_task(self, task):
+        try:
+            if self._is_verified(task):
+                self._count("skipped")
+                return
+            if self._link_same_url(task):
+                self._count("linked")
+                return
+            self._download(task)
+            self._count("downloaded")
+        except Exception as e:
+            self._count("failed")
+            logger.error(f"Error downloading image {task.image_id} from {task.url}: {e}")
+
+    def _is_verified(self, task):
+        entry = self.manifest.get(task.image_id)
+        if not os.path.exists(task.path):
+            return False
+        size = os.path.getsize(task.path)
+        if entry is not None:
+            if entry["url"] != task.url or entry["size"] != size:
+                return False
+            return self.verify == "size" or sha256_file(task.path) == entry["sha256"]
+        # Not downloaded by us: keep it if the server reports the same size. Many CDNs
+        # reject HEAD, in which case the file is downloaded again.
+        try:
+            response = self._request("head", task.url)
+        except requests.RequestException as e:
+            logger.debug(f"Cannot check {task.path} against {task.url}, downloading it: {e}")
+            return False
+        response.close()
+        content_length = response.headers.get("Content-Length")
+        if content_length is None or int(content_length) != size:
+            return False
+        self._add_to_manifest(task, size, sha256_file(task.path))
+        return True
+
+    def _link_same_url(self, task):
+        # Reuses the verified file of another image with the same URL
+        entry = self.manifest.get_by_url(task.url)
+        if entry is None or entry["image_id"] == task.image_id:
+            return False
+        if not os.path.exists(entry["path"]) or os.path.getsize(entry["path"]) != entry["size"]:
+            return False
+        if os.path.exists(task.path):
+            os.remove(task.path)
+        try:
+            os.link(entry["path"], task.path)
+        except OSError:
+            # Filesystems without hard links
+            shutil.copyfile(entry["path"], task.path)
+        self._add_to_manifest(task, entry["size"], entry["sha256"])
+        return True
+
+    def _download(self, task):
+        tmp_path = f"{task.path}.part"
+        response = self._request("get", task.url, stream=True)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, "wb") as file:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    file.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            response.close()
+        # A partial download never ends up under the final name
+        os.replace(tmp_path, task.path)
+        self._count("bytes", size)
+        self._add_to_manifest(task, size, digest.hexdigest())
+
+    def _add_to_manifest(self, task, size, sha256):
+        self.manifest.add(
+            {
+                "image_id": task.image_id,
+                "url": task.url,
+                "path": task.path,
+                "size": size,
+                "sha256": sha256,
+            }
+        )
+
+    def _request(self, method, url, **kwargs):
+        # Retries connection errors, 429 and 5xx with exponential backoff and full jitter,
+        # honouring Retry-After. Other errors (e.g. 404) fail right away.
+        for attempt in range(1, self.max_attempts + 1):
+            self._throttle(url)
+            retry_after = None
+            try:
+                response = self._session().request(
+                    method, url, timeout=self.timeout, **kwargs
+                )
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return response
+                retry_after = response.headers.get("Retry-After")
+                response.close()
+                error = requests.HTTPError(f"{response.status_code} for {url}")
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if attempt == self.max_attempts:
+                raise error
+            delay = random.uniform(
+                0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+            )
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, min(self.backoff_max, int(retry_after)))
+            logger.info(f"{error}, retrying in {delay:.1f}s (attempt {attempt}/{self.max_attempts}).")
+            time.sleep(delay)
+
+
+if __name__ == "__main__":
+    from tweet_store import TweetStore
+    from tweet_writer import read_records
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    parser = argparse.ArgumentParser(description="Download the images of crawled tweets.")
+    parser.add_argument(
+        "data", help="JSON output of a crawl, or the Parquet tweet store folder."
+    )
+    parser.add_argument("--output-dir", default="downloaded_images")
+    parser.add_argument("--num-workers", type=int, default=8)
+    parser.add_argument("--requests-per-second", type=float, default=5)
+    parser.add_argument("--verify", choices=["size", "sha256"], default="size")
+    args = parser.parse_args()
+
+    if os.path.isdir(args.data):
+        df = TweetStore(args.data).read(columns=["url", "images_urls"])
+        tweets = zip(df["url"], df["images_urls"])
+    else:
+        tweets = ((record.url, record.images_urls) for record in read_records(args.data))
+    with ImageDownloader(
+        args.output_dir,
+        num_workers=args.num_workers,
+        requests_per_second=args.requests_per_second,
+        verify=args.verify,
+    ) as downloader:
+        downloader.download(image_tasks(tweets, args.output_dir))
@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+# Image embedding and search backend of the webapp, also usable headless:
+#
+#   python image_search.py embed downloaded_images --batch-size 64 --num-workers 8
+#   python image_search.py search downloaded_images queries.txt --output results.jsonl
+#   python image_search.py embed downloaded_images --backend onnx  (see onnx_encoder.py)
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import logging
+import os
+import threading
+import time
+import unicodedata
+
+import numpy as np
+from PIL import Image
+
+from embedding_store import EmbeddingIndex
+from tweet_record import dumps
+from vector_index import open_index
+
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+# Searches that collapse duplicates first fetch this many times top_k hits
+DUPLICATE_OVERFETCH = 4
+DEFAULT_MODEL = "unum-cloud/uform-vl-multilingual-v2"
+# torch: uform's PyTorch model; onnx / onnx-float32: the model exported by onnx_encoder.py
+# with int8 / float32 weights, run by ONNX Runtime without importing torch
+BACKENDS = ("torch", "onnx", "onnx-float32")
+
+
+def list_image_files(folder_path):
+    folder_path = os.path.abspath(folder_path)
+    return [
+        os.path.join(folder_path, file)
+        for file in sorted(os.listdir(folder_path))
+        if file.endswith(IMAGE_EXTENSIONS)
+    ]
+
+
+def load_model(model_name=DEFAULT_MODEL, backend="torch", num_threads=None, onnx_dir=None):
+    # (model, processor) of the backend. num_threads: intra-op threads (default: the
+    # library's, one per core)
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+    if backend != "torch":
+        import onnx_encoder
+
+        return onnx_encoder.load_model(
+            model_name, onnx_dir, quantized=backend == "onnx", num_threads=num_threads
+        )
+    import torch
+    import uform
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    return uform.get_model(model_name)
+
+
+def _is_onnx(model):
+    return getattr(model, "backend", "torch") == "onnx"
+
+
+def model_backend(model):
+    # The BACKENDS name of a loaded model: int8 and float32 ONNX encoders differ too
+    if not _is_onnx(model):
+        return "torch"
+    return "onnx" if model.quantized else "onnx-float32"
+
+
+def _encode_images(model, batch):
+    # (len(batch), dim) float32 embeddings of preprocessed images
+    if _is_onnx(model):
+        embeddings = model.encode_image(np.concatenate(batch))
+    else:
+        import torch
+
+        with torch.inference_mode():
+            embeddings = model.encode_image(torch.cat(batch), return_features=False)
+        embeddings = embeddings.cpu().numpy()
+    return embeddings.reshape(len(batch), -1).astype(np.float32, copy=False)
+
+
+def _encode_texts(model, processor, texts):
+    # (len(texts), dim) float32 embeddings
+    if _is_onnx(model):
+        embeddings = model.encode_text(processor.preprocess_text(texts))
+    else:
+        import torch
+
+        with torch.inference_mode():
+            embeddings = model.encode_text(
+                processor.preprocess_text(texts), return_features=False
+            )
+        embeddings = embeddings.cpu().numpy()
+    return embeddings.reshape(len(texts), -1).astype(np.float32, copy=False)
+
+
+def _load_image(file_path, processor, max_size):
+    # Runs in the decode threads: decode, resize and preprocess one image
+    image = Image.open(file_path)
+    # JPEGs are decoded directly at a reduced scale when that still covers max_size
+    image.draft("RGB", max_size)
+    image = image.convert("RGB").resize(max_size)
+    image_data = processor.preprocess_image(image)
+    if image_data.ndim == 3:
+        image_data = image_data[None]
+    return image_data
+
+
+def _prefetch(executor, function, items, window):
+    # Like executor.map, but with at most `window` items in flight, so decoded images
+    # never pile up when the model is the slower side
+    pending = deque()
+    for item in items:
+        pending.append((item, executor.submit(function, item)))
+        if len(pending) >= window:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+
+def embed_images(
+    file_paths,
+    model,
+    processor,
+    max_size=(224, 224),
+    batch_size=32,
+    num_workers=4,
+    prefetch_batches=2,
+    progress=None,
+    progress_interval=0.5,
+):
+    # Decode threads stay `prefetch_batches` batches ahead of the model, which embeds
+    # `batch_size` images per forward pass. progress(done, total) is called at most every
+    # `progress_interval` seconds, and once at the end. Images that cannot be read are
+    # skipped, so the returned paths are the ones that were embedded.
+    total = len(file_paths)
+    embeddings, embedded_paths = [], []
+    batch, batch_paths = [], []
+    done = 0
+    last_progress = time.monotonic()
+
+    def encode_batch():
+        embeddings.append(_encode_images(model, batch))
+        embedded_paths.extend(batch_paths)
+        batch.clear()
+        batch_paths.clear()
+
+    with ThreadPoolExecutor(num_workers) as executor:
+        load = lambda file_path: _load_image(file_path, processor, max_size)
+        for file_path, future in _prefetch(
+            executor, load, file_paths, prefetch_batches * batch_size
+        ):
+            try:
+                batch.append(future.result())
+                batch_paths.append(file_path)
+            except Exception as e:
+                logger.warning(f"Skipping {file_path}: {e}")
+            done += 1
+            if len(batch) == batch_size:
+                encode_batch()
+            if progress and time.monotonic() - last_progress >= progress_interval:
+                progress(done, total)
+                last_progress = time.monotonic()
+        if batch:
+            encode_batch()
+    if progress:
+        progress(done, total)
+
+    if not embeddings:
+        return np.empty((0, 0), dtype=np.float32), embedded_paths
+    return np.concatenate(embeddings), embedded_paths
+
+
+def normalize_query(query):
+    # Queries that only differ in Unicode form or whitespace share an embedding
+    return " ".join(unicodedata.normalize("NFC", query).split())
+
+
+class QueryEmbeddingCache:
+    # Thread-safe LRU cache of text embeddings, keyed by (model name, backend, normalized
+    # query): each backend's encoder gives slightly different embeddings
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._embeddings = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model_name, backend, query):
+        key = (model_name, backend, normalize_query(query))
+        with self._lock:
+            embedding = self._embeddings.get(key)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._embeddings.move_to_end(key)
+            return embedding
+
+    def put(self, model_name, backend, query, embedding):
+        key = (model_name, backend, normalize_query(query))
+        with self._lock:
+            self._embeddings[key] = embedding
+            self._embeddings.move_to_end(key)
+            while len(self._embeddings) > self.max_size:
+                self._embeddings.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._embeddings),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def __len__(self):
+        return len(self._embeddings)
+
+
+def encode_queries(queries, model, processor, cache=None, model_name=None, batch_size=256):
+    # (len(queries), dim) float32 text embeddings. Queries missing from the cache are
+    # deduplicated and encoded `batch_size` at a time, one forward pass per batch.
+    backend = model_backend(model)
+    embeddings = [
+        cache.get(model_name, backend, query) if cache is not None else None
+        for query in queries
+    ]
+    missing = list(
+        dict.fromkeys(
+            normalize_query(query)
+            for query, embedding in zip(queries, embeddings)
+            if embedding is None
+        )
+    )
+    encoded = {}
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start : start + batch_size]
+        text_embeddings = _encode_texts(model, processor, batch)
+        for query, embedding in zip(batch, text_embeddings):
+            encoded[query] = embedding
+            if cache is not None:
+                cache.put(model_name, backend, query, embedding)
+    return np.stack(
+        [
+            embedding if embedding is not None else encoded[normalize_query(query)]
+            for query, embedding in zip(queries, embeddings)
+        ]
+    )
+
+
+def collapse_duplicates(embeddings, indices, scores, top_k):
+    # The best hit of each group of files sharing an embedding row (identical and
+    # near-duplicate images score the same), at most top_k of them
+    _, first = np.unique(embeddings.rows[indices], return_index=True)
+    keep = np.sort(first)[:top_k]
+    return indices[keep], scores[keep]
+
+
+def search_index(index, query_embeddings, top_k, candidates=None, collapse=True):
+    # (indices, similarities) per query of a vector_index search. With `collapse`, each
+    # group of duplicate images takes one of the top_k places; the search is widened
+    # while some query comes up short because of them. The indexes hold one entry per
+    # file rather than per embedding row, because the candidates of a metadata filter
+    # are files: a group can match through any of its files' tweets.
+    if not collapse:
+        return index.search(query_embeddings, top_k, candidates)
+    size = len(candidates) if candidates is not None else len(index.embeddings)
+    fetch_k = top_k * DUPLICATE_OVERFETCH
+    while True:
+        top_indices, similarities = index.search(query_embeddings, fetch_k, candidates)
+        results = [
+            collapse_duplicates(index.embeddings, indices, scores, top_k)
+            for indices, scores in zip(top_indices, similarities)
+        ]
+        if fetch_k >= size or all(len(indices) == top_k for indices, _ in results):
+            return [indices for indices, _ in results], [scores for _, scores in results]
+        fetch_k *= DUPLICATE_OVERFETCH
+
+
+def batch_search_indices(
+    queries,
+    index,
+    model,
+    processor,
+    top_k=7,
+    cache=None,
+    model_name=None,
+    candidates=None,
+    collapse=True,
+):
+    # (indices into index.file_paths, similarities) per query; all queries are scored by
+    # the index at once. candidates: only search these file indices (see
+    # metadata_filter.MetadataIndex.candidates). collapse: one hit per group of duplicates
+    query_embeddings = encode_queries(queries, model, processor, cache, model_name)
+    return search_index(index, query_embeddings, top_k, candidates, collapse)
+
+
+def batch_search(
+    queries, index, model, processor, top_k=7, cache=None, model_name=None, candidates=None
+):
+    # [(file paths, similarities)] per query
+    top_indices, similarities = batch_search_indices(
+        queries, index, model, processor, top_k, cache, model_name, candidates
+    )
+    return [
+        ([index.file_paths[i] for i in indices], scores)
+        for indices, scores in zip(top_indices, similarities)
+    ]
+
+
+def search_images(
+    query, index, model, processor, top_k=7, cache=None, model_name=None, candidates=None
+):
+    # index: a vector_index index over the EmbeddingMatrix of an EmbeddingIndex
+    return batch_search(
+        [query], index, model, processor, top_k, cache, model_name, candidates
+    )[0]
+
+
+def _log_progress(done, total):
+    logger.info(f"Embedded {done}/{total} images.")
+
+
+def _embed(args):
+    index = EmbeddingIndex(args.folder_path, args.model, args.dtype, args.backend or "torch")
+    file_paths = index.update(list_image_files(args.folder_path))
+    if not file_paths:
+        logger.info(f"All {len(index)} images are already embedded.")
+        open_index(index.load(), args.folder_path, args.index)
+        return
+    model, processor = load_model(args.model, index.backend, args.num_threads, args.onnx_dir)
+    start_time = time.monotonic()
+    embeddings, file_paths = embed_images(
+        file_paths,
+        model,
+        processor,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        progress=_log_progress,
+        progress_interval=10,
+    )
+    elapsed = time.monotonic() - start_time
+    index.add(file_paths, embeddings)
+    logger.info(
+        f"Embedded {len(file_paths)} images in {elapsed:.0f}s "
+        f"({len(file_paths) / max(elapsed, 1e-9):.1f} images/s), {len(index)} in the index."
+    )
+    open_index(index.load(), args.folder_path, args.index)
+
+
+def _search(args):
+    # One query per line of the queries file, one JSON line of results per query
+    embedding_index = EmbeddingIndex.open(args.folder_path)
+    index = open_index(embedding_index.load(), args.folder_path, args.index)
+    backend = args.backend or embedding_index.backend
+    if backend != embedding_index.backend:
+        logger.warning(
+            f"The images were embedded with the {embedding_index.backend} backend, the "
+            f"{backend} query embeddings drift slightly from them."
+        )
+    model, processor = load_model(
+        embedding_index.model_name, backend, args.num_threads, args.onnx_dir
+    )
+    with open(args.queries_file, encoding="utf-8") as f:
+        queries = [line.strip() for line in f if line.strip()]
+    cache = QueryEmbeddingCache()
+    start_time = time.monotonic()
+    with open(args.output, "wb") as output:
+        for start in range(0, len(queries), args.batch_size):
+            batch = queries[start : start + args.batch_size]
+            results = batch_search(
+                batch, index, model, processor, args.top_k, cache, embedding_index.model_name
+            )
+            for query, (file_paths, similarities) in zip(batch, results):
+                matches = [
+                    {"file_path": file_path, "similarity": round(float(similarity), 4)}
+                    for file_path, similarity in zip(file_paths, similarities)
+                ]
+                output.write(dumps({"query": query, "results": matches}) + b"\n")
+    elapsed = time.monotonic() - start_time
+    logger.info(
+        f"Ran {len(queries)} queries in {elapsed:.1f}s "
+        f"({len(queries) / max(elapsed, 1e-9):.0f} queries/s), cache: {cache.stats()}."
+    )
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    parser = argparse.ArgumentParser(description="Embed and search images.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    embed_parser = subparsers.add_parser(
+        "embed", help="Embed the new and changed images of a folder."
+    )
+    embed_parser.add_argument("folder_path")
+    embed_parser.add_argument("--model", default=DEFAULT_MODEL)
+    embed_parser.add_argument(
+        "--dtype",
+        choices=["float32", "float16", "int8"],
+        default="float16",
+        help="Storage precision of the embeddings.",
+    )
+    embed_parser.add_argument("--batch-size", type=int, default=32)
+    embed_parser.add_argument("--num-workers", type=int, default=4)
+    search_parser = subparsers.add_parser(
+        "search", help="Run the queries of a file (one per line) against embedded images."
+    )
+    search_parser.add_argument("folder_path")
+    search_parser.add_argument("queries_file")
+    search_parser.add_argument("--output", default="search_results.jsonl")
+    search_parser.add_argument("--top-k", type=int, default=10)
+    search_parser.add_argument(
+        "--batch-size", type=int, default=256, help="Queries encoded per forward pass."
+    )
+    for subparser in (embed_parser, search_parser):
+        subparser.add_argument(
+            "--index",
+            choices=["auto", "exact", "ivf", "hnsw"],
+            default="auto",
+            help="Vector index used for the search (auto: exact up to 20k images).",
+        )
+        subparser.add_argument(
+            "--backend",
+            choices=BACKENDS,
+            default=None,
+            help=(
+                "Encoder backend (default: torch to embed, the one of the embeddings to "
+                "search); onnx needs `python onnx_encoder.py` first."
+            ),
+        )
+        subparser.add_argument(
+            "--onnx-dir", default=None, help="Exported model (default: onnx_models/<model>)."
+        )
+        subparser.add_argument(
+            "--num-threads", type=int, default=None, help="Intra-op threads of the encoder."
+        )
+    args = parser.parse_args()
+    if args.command == "embed":
+        _embed(args)
+    else:
+        _search(args)
+
+if __name__ == "__main__":
+    main()
@@ -1,205 +1,38 @@
-import os
-import numpy as np
-from PIL import Image
+import base64
 import streamlit as st
-import uform
-from simsimd import cosine
-import pickle
-import pandas as pd
-import requests
 import streamlit.components.v1 as components
+from metadata_filter import MetadataFilter
+from image_search import BACKENDS
+from search_service import SearchClient, SearchService
+from thumbnail_cache import thumbnail_data_uri
 
 
 # Backend
-def load_embeddings(folder_path):
-    embedding_path = os.path.join(folder_path, "embeddings.pkl")
-    file_paths_path = os.path.join(folder_path, "file_paths.pkl")
-    if os.path.exists(embedding_path) and os.path.exists(file_paths_path):
-        with open(embedding_path, "rb") as f:
-            embeddings = pickle.load(f)
-        with open(file_paths_path, "rb") as f:
-            file_paths = pickle.load(f)
-        return embeddings, file_paths
-    return None, None
+@st.cache_resource(max_entries=4)
+def get_search_service(folder_path, model_name, dtype, backend="torch"):
+    # Without a service URL, one in-process service per folder, shared by all sessions:
+    # the model, the index and the tweet table are loaded once
+    return SearchService(folder_path, model_name=model_name, dtype=dtype, backend=backend)
 
-def save_embeddings(folder_path, embeddings, file_paths):
-    embedding_path = os.path.join(folder_path, "embeddings.pkl")
-    file_paths_path = os.path.join(folder_path, "file_paths.pkl")
-    with open(embedding_path, "wb") as f:
-        pickle.dump(embeddings, f)
-    with open(file_paths_path, "wb") as f:
-        pickle.dump(file_paths, f)
 
-def embed_images(folder_path, model, processor, max_size=(224, 224)):
-    embeddings = []
-    file_paths = []
-    folder_path = os.path.abspath(folder_path)
-   
-    image_files = [file for file in os.listdir(folder_path) if file.endswith((".jpg", ".jpeg", ".png"))]
-    total_files = len(image_files)
-    progress_bar = st.progress(0, text=f"Embedding images... (0/{total_files})")
-   
-    for index, file in enumerate(image_files, start=1):
-        file_path = os.path.join(folder_path, file)
-        image = Image.open(file_path).resize(max_size)
-        image_data = processor.preprocess_image(image)
-        image_embedding = model.encode_image(image_data, return_features=False).detach().numpy()
-        image_embedding = np.squeeze(image_embedding)  # Remove extra dimensions
-        embeddings.append(image_embedding)
-        file_paths.append(file_path)
-        progress_bar.progress(index / total_files, text=f"Embedding images... ({index}/{total_files})")
-   
-    return np.array(embeddings), file_paths
-
-def search_images(query, embeddings, file_paths, model, processor, top_k=7):
-    text_data = processor.preprocess_text(query)
-    text_embedding = model.encode_text(text_data, return_features=False).detach().numpy()
-   
-    if embeddings.ndim > 2:
-        embeddings = embeddings.reshape(embeddings.shape[0], -1)
-   
-    if text_embedding.ndim == 1:
-        text_embedding = text_embedding.reshape(1, -1)
-    elif text_embedding.ndim != 2:
-        raise ValueError("Text embedding must be a 1D or 2D numpy array.")
-   
-    # Normalize the embeddings
-    embeddings_norm = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
-    text_embedding_norm = text_embedding / np.linalg.norm(text_embedding, axis=1, keepdims=True)
-   
-    # Calculate the cosine similarity
-    similarities = np.dot(embeddings_norm, text_embedding_norm.T).flatten()
-   
-    top_indices = similarities.argsort()[-top_k:][::-1]
-    return [file_paths[i] for i in top_indices], similarities[top_indices]
-
-
-def display_slideshow(images_urls):
-    if len(images_urls) > 1:        # Display slideshow for multiple images
-        components.html(
-            f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta name="viewport" content="width=device-width, initial-scale=1">
-                <style>
-                    /* CSS styles for the slideshow */
-                    .mySlides {{display: none;}}
-                    img {{vertical-align: middle;}}
-                    .slideshow-container {{
-                        max-width: 800px;
-                        position: relative;
-                        margin: auto;
-                    }}                    .prev, .next {{
-                        cursor: pointer;
-                        position: absolute;
-                        top: 50%;
-                        width: auto;
-                        padding: 16px;
-                        margin-top: -22px;
-                        color: white;
-                        font-weight: bold;
-                        font-size: 18px;
-                        transition: 0.6s ease;
-                        border-radius: 0 3px 3px 0;
-                        user-select: none;
-                    }}
-                    .next {{
-                        right: 0;
-                        border-radius: 3px 0 0 3px;
-                    }}
-                    .prev:hover, .next:hover {{
-                        background-color: rgba(0,0,0,0.8);
-                    }}
-                    .numbertext {{
-                        color: #f2f2f2;
-                        font-size: 12px;
-                        padding: 8px 12px;
-                        position: absolute;
-                        top: 0;
-                    }}
-                    .dot {{
-                        cursor: pointer;
-                        height: 15px;
-                        width: 15px;
-                        margin: 0 2px;
-                        background-color: #bbb;
-                        border-radius: 50%;                        display: inline-block;
-                        transition: background-color 0.6s ease;
-                    }}
-                    .active, .dot:hover {{
-                        background-color: #717171;                    }}
-                </style>
-            </head>
-            <body>
-                <div class="slideshow-container">
-                    {''.join([f'<div class="mySlides"><div class="numbertext">{i+1} / {len(images_urls)}</div><img src="{url}" style="width:100%"></div>' for i, url in enumerate(images_urls)])}
-                    <a class="prev" onclick="plusSlides(-1)">&#10094;</a>
-                    <a class="next" onclick="plusSlides(1)">&#10095;</a>
-                </div>
-                <br>
-                <div style="text-align:center">
-                    {''.join([f'<span class="dot" onclick="currentSlide({i+1})"></span>' for i in range(len(images_urls))])}
-                </div>
-                <script>
-                    let slideIndex = 1;
-                    showSlides(slideIndex);
-                    function plusSlides(n) {{
-                        showSlides(slideIndex += n);
-                    }}
-                    function currentSlide(n) {{
-                        showSlides(slideIndex = n);
-                    }}
-                    function showSlides(n) {{
-                        let i;
-                        let slides = document.getElementsByClassName("mySlides");
-                        let dots = document.getElementsByClassName("dot");
-                        if (n > slides.length) {{slideIndex = 1}}
-                        if (n < 1) {{slideIndex = slides.length}}
-                        for (i = 0; i < slides.length; i++) {{
-                            slides[i].style.display = "none";
-                        }}
-                        for (i = 0; i < dots.length; i++) {{
-                            dots[i].className = dots[i].className.replace(" active", "");
-                        }}
-                        slides[slideIndex-1].style.display = "block";
-                        dots[slideIndex-1].className += " active";
-                    }}                </script>
-            </body>
-            </html>
-            """,
-            height=400,
-        )
-    elif len(images_urls) == 1:
-        # Display single image
-        try:
-            image = Image.open(requests.get(images_urls[0], stream=True).raw)
-            image.thumbnail((800, 800))            
-            st.image(image)
-        except Exception as e:
-            st.warning(f"Error loading image: {str(e)}")
+def get_search_client(service_url, folder_path, model_name, dtype, backend="torch"):
+    # A running search_service.py, which keeps its own model and index
+    if service_url:
+        return SearchClient(service_url)
+    return get_search_service(folder_path, model_name, dtype, backend)
 
 
-def display_tweet(tweet_data):
-    with st.expander(f"Tweet by {tweet_data['author_name']}", expanded=True):
-        col1, col2 = st.columns([4, 2])
-        with col1:
-            if tweet_data['images_urls'] is not None and len(tweet_data['images_urls']) > 0:
-                display_slideshow(tweet_data['images_urls'])
-        with col2:
-            st.write(f"**Author:** [{tweet_data['author_name']}]({tweet_data['url']})")
-            st.write(f"**Date:** {tweet_data['date'].strftime('%Y-%m-%d')}")
-            st.write(tweet_data['text'])
-            st.write(f"**Likes:** {tweet_data['num_like']} | **Retweets:** {tweet_data['num_retweet']} | **Replies:** {tweet_data['num_reply']}")
-
-
-def load_data_df(file_path):
-    df = pd.read_json(file_path, lines=True)
-    df['date'] = pd.to_datetime(df['date'], format='%d/%m/%Y')
-    return df
+def to_data_uri(thumbnail):
+    # A search service over HTTP returns data: URIs, an in-process one local paths
+    if thumbnail.startswith("data:"):
+        return thumbnail
+    return thumbnail_data_uri(thumbnail)
 
 
-def display_slideshow(images_urls):
+def display_slideshow(thumbnail_paths):
+    images_urls = [to_data_uri(path) for path in thumbnail_paths if path is not None]
+    if len(images_urls) < len(thumbnail_paths):
+        st.warning(f"Could not load {len(thumbnail_paths) - len(images_urls)} image(s).")
     if len(images_urls) > 1:
         # Display slideshow for multiple images
         components.html(
@@ -303,22 +136,18 @@ def display_slideshow(images_urls):
         )
     elif len(images_urls) == 1:
         # Display single image
-        try:
-            image = Image.open(requests.get(images_urls[0], stream=True).raw)
-            image.thumbnail((800, 800))
-            st.image(image)
-        except Exception as e:
-            st.warning(f"Error loading image: {str(e)}")
+        st.image(base64.b64decode(images_urls[0].split(",", 1)[1]))
 
-def display_tweet(tweet_data):
+
+def display_tweet(tweet_data, thumbnail_paths):
     with st.expander(f"Tweet by {tweet_data['author_name']}", expanded=True):
         col1, col2 = st.columns([4, 2])
         with col1:
-            if tweet_data['images_urls'] is not None and len(tweet_data['images_urls']) > 0:
-                display_slideshow(tweet_data['images_urls'])
+            if thumbnail_paths:
+                display_slideshow(thumbnail_paths)
         with col2:
             st.write(f"**Author:** [{tweet_data['author_name']}]({tweet_data['url']})")
-            st.write(f"**Date:** {tweet_data['date'].strftime('%Y-%m-%d')}")
+            st.write(f"**Date:** {tweet_data['date']}")
             st.write(tweet_data['text'])
             st.write(f"**Likes:** {tweet_data['num_like']} | **Retweets:** {tweet_data['num_retweet']} | **Replies:** {tweet_data['num_reply']}")
 
@@ -351,80 +180,107 @@ def main():
             )        
         st.markdown("Quick PoC to search images based on text query using tiny multi-language image embedding model. \n\nMake sure download images and tweet data before searching.")
 
-        if 'embeddings' not in st.session_state:
-            st.session_state.embeddings = None
-        if 'file_paths' not in st.session_state:
-            st.session_state.file_paths = None
-        if 'model' not in st.session_state:
-            st.session_state.model = None
-        if 'processor' not in st.session_state:
-            st.session_state.processor = None
-        if 'data_df' not in st.session_state:
-            st.session_state.data_df = None
-
         with st.expander("Instructions", expanded=True):
             folder_path = st.text_input("Enter the folder path containing images:", value="downloaded_images")
-            data_file_path = st.text_input("Enter the path to the tweet data file:", value="data/sample_output_json.json")
+            data_file_path = st.text_input("Enter the path to the tweet data file (or Parquet tweet store folder):", value="data/sample_output_json.json")
             model_name = st.selectbox("Select the UForm model:", ["unum-cloud/uform-vl-multilingual-v2", "unum-cloud/uform-vl-english-large"])
+            dtype = st.selectbox("Embedding precision (int8 and float16 use 4x and 2x less memory):", ["float16", "int8", "float32"])
+            backend = st.selectbox("Encoder backend (onnx needs `python onnx_encoder.py` first):", BACKENDS)
+            service_url = st.text_input("Search service URL (e.g. http://127.0.0.1:8765, leave empty to search in this process):", value="")
             top_k = st.number_input("Enter the number of top results to display:", min_value=1, value=6)
 
+            if not folder_path and not service_url:
+                st.warning("Please enter a folder path.")
+                st.stop()
+            client = get_search_client(service_url, folder_path, model_name, dtype, backend)
+            embedded_with = client.stats().get("embedded_with")
+            if embedded_with:
+                # Nothing is deleted until "Embed Images" re-embeds with the selected settings
+                st.info(f"The images were embedded with {embedded_with['model']} ({embedded_with['dtype']}, {embedded_with['backend']}). Select those settings, or click \"Embed Images\" to re-embed them with the selected ones.")
+
             if st.button("Load Tweet Data"):
                 if not data_file_path:
                     st.warning("Please enter the path to the tweet data file.")
                 else:
-                    st.session_state.data_df = load_data_df(data_file_path)
-                    st.success(f"Loaded {len(st.session_state.data_df)} tweets.")
+                    # Loaded once by the service for all sessions
+                    stats = client.reload(data_file_path)
+                    st.success(f"Loaded {stats['tweets']} tweets.")
         
             if st.button("Embed Images"):
-                if not folder_path:
-                    st.warning("Please enter a folder path.")
+                # Only new and changed images are embedded, everything is re-embedded when the model, precision or backend changes
+                with st.spinner("Embedding images..."):
+                    result = client.embed()
+                if result["embedded"]:
+                    st.success(f"Embedded {result['embedded']} new images.")
                 else:
-                    st.session_state.model, st.session_state.processor = uform.get_model(model_name)
-                    st.session_state.embeddings, st.session_state.file_paths = load_embeddings(folder_path)
-                    if st.session_state.embeddings is None or st.session_state.file_paths is None:
-                        st.session_state.embeddings, st.session_state.file_paths = embed_images(folder_path, st.session_state.model, st.session_state.processor)
-                        save_embeddings(folder_path, st.session_state.embeddings, st.session_state.file_paths)
-                        st.success(f"Embedded {len(st.session_state.file_paths)} images.")
-                    else:
-                        st.info("Using previously embedded images.")
+                    st.info("Using previously embedded images.")
         
-        query = st.text_input("Enter a search query:", key="query_input", on_change=lambda: st.session_state.update(search_button=True))
-        st.session_state.search_button = False
-    
-        if st.button("Search") or st.session_state.search_button:
+        with st.form("search_form"):
+            query = st.text_input("Enter a search query:", key="query_input")
+            search_mode = st.radio("Search:", ["Images", "Images and tweet text", "Tweet text"], horizontal=True)
+            st.caption('Put the query in "double quotes" to only find tweets with all of its words (no image search).')
+            with st.expander("Filters"):
+                # Only the images of matching tweets are searched, so top-k is always filled when enough tweets match
+                filter_cols = st.columns(3)
+                with filter_cols[0]:
+                    authors = st.text_input("Authors (handles, comma-separated):")
+                    langs = st.text_input("Languages (e.g. en, ja):")
+                with filter_cols[1]:
+                    date_from = st.date_input("From date:", value=None)
+                    date_to = st.date_input("To date:", value=None)
+                with filter_cols[2]:
+                    retweets = st.selectbox("Retweets:", ["Any", "Exclude retweets", "Only retweets"])
+                    min_likes = st.number_input("Minimum likes:", min_value=0, value=0)
+            # Enter in the text box and the button both submit the form, which runs one search
+            search_submitted = st.form_submit_button("Search")
+
+        if search_submitted:
+            stats = client.stats()
+            mode = {"Images": "image", "Images and tweet text": "hybrid", "Tweet text": "text"}[search_mode]
             if query is None or query.strip() == "":
                 st.warning("Please enter a search query.")
-            elif st.session_state.file_paths is None:
-                st.warning("Please provide file_paths first.")
-            elif st.session_state.embeddings is None:
-                st.warning("Please embed the images first.")
-            elif st.session_state.data_df is None:
+            elif mode == "image" and not stats["images"]:
+                if stats.get("embedded_with"):
+                    st.warning("The images were embedded with other settings, please embed them with the selected ones first.")
+                else:
+                    st.warning("Please embed the images first.")
+            elif stats["tweets"] is None:
                 st.warning("Please load the tweet data first.")
             else:
-                top_files, similarities = search_images(query, st.session_state.embeddings, st.session_state.file_paths, st.session_state.model, st.session_state.processor, top_k)
-            
+                # Batched with the queries of other sessions, thumbnails are loaded by the service
+                metadata_filter = MetadataFilter(
+                    authors=[author.strip() for author in authors.split(",") if author.strip()] or None,
+                    langs=[lang.strip() for lang in langs.split(",") if lang.strip()] or None,
+                    is_retweet={"Any": None, "Exclude retweets": False, "Only retweets": True}[retweets],
+                    date_from=date_from,
+                    date_to=date_to,
+                    min_likes=min_likes or None,
+                )
+                hits = client.search([query], top_k, thumbnails=True, metadata_filter=metadata_filter, mode=mode)[0]["hits"]
+                st.caption(f"Query cache hit rate: {client.stats()['query_cache']['hit_rate']:.0%}")
+
                 st.subheader(f"Top {top_k} Results:")
                 st.write("Sometimes one tweet conatins more than one images, click on the images to view more.")
-                unique_tweet_urls = set()
+                results, displayed_tweets = [], set()
+                for i, hit in enumerate(hits):
+                    # Skip tweets that are not loaded or have already been displayed
+                    tweet_data = hit["tweet"]
+                    if tweet_data is not None and tweet_data['url'] not in displayed_tweets:
+                        results.append((i, hit))
+                        displayed_tweets.add(tweet_data['url'])
                 cols = st.columns(3)
-                for i, (file, similarity) in enumerate(zip(top_files, similarities)):
-                    image_id = os.path.splitext(os.path.basename(file))[0]
-                    twitter_name = image_id.split("__")[0]
-                    tweet_id = image_id.split("__")[1].split("_")[0]
-                    tweet_url = f"https://twitter.com/{twitter_name}/status/{tweet_id}"
-                
-                    # Check if the tweet URL exists in the data_df and has not been displayed yet
-                    if st.session_state.data_df['url'].isin([tweet_url]).any() and tweet_url not in unique_tweet_urls:
-                        tweet_data = st.session_state.data_df[st.session_state.data_df['url'] == tweet_url].iloc[0]
-                    
-                        with cols[i % 3]:
-                            try:
-                                display_tweet(tweet_data)
-                                st.write(f"**Similarity:** {similarity:.3f}")
-                            except Exception as e:
-                                st.warning(f"Error displaying tweet: {str(e)}")
-
-                        unique_tweet_urls.add(tweet_url)
+                for i, hit in results:
+                    with cols[i % 3]:
+                        try:
+                            display_tweet(hit["tweet"], hit.get("thumbnails"))
+                            if hit['similarity'] is not None:
+                                st.write(f"**Similarity:** {hit['similarity']:.3f}")
+                            if hit.get('text_score') is not None:
+                                st.write(f"**Keyword score:** {hit['text_score']:.2f}")
+                            if hit.get('duplicates'):
+                                st.caption(f"The same image appears {hit['duplicates']} more time(s).")
+                        except Exception as e:
+                            st.warning(f"Error displaying tweet: {str(e)}")
 
     # Add footer
     footer="""
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+# Counters and per-stage latency histograms for crawls. `NullMetrics` is the default and
+# does nothing, so instrumented code costs next to nothing when metrics are off.
+from collections import defaultdict, deque
+from contextlib import contextmanager, nullcontext
+import bisect
+import json
+import os
+import threading
+import time
+
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-quantile
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum_seconds": round(self.sum, 6),
+            "mean_seconds": round(self.sum / self.count, 6) if self.count else 0.0,
+            "p50_seconds": self.quantile(0.5),
+            "p95_seconds": self.quantile(0.95),
+            "max_seconds": round(self.max, 6),
+        }
+
+
+class IngestMetrics:
+    # Stages are timed into `ingest_stage_seconds{stage=...}`, events are counted in
+    # `ingest_events_total{event=...}`. The Prometheus text file (if any) is rewritten
+    # at most every `export_interval` seconds, the JSON summary is written by `finish`.
+    def __init__(
+        self,
+        summary_filename=None,
+        prometheus_filename=None,
+        export_interval=15,
+        rate_window=60,
+    ):
+        self.summary_filename = summary_filename
+        self.prometheus_filename = prometheus_filename
+        self.export_interval = export_interval
+        self.rate_window = rate_window
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.start_time = time.monotonic()
+        self._tweet_times = deque()
+        self._num_tweets = 0
+        self._last_export = self.start_time
+        self._lock = threading.Lock()
+
+    def inc(self, event, value=1):
+        with self._lock:
+            self.counters[event] += value
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            self.histograms[stage].observe(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def tweet_done(self):
+        now = time.monotonic()
+        with self._lock:
+            self._num_tweets += 1
+            self._tweet_times.append(now)
+            while self._tweet_times[0] < now - self.rate_window:
+                self._tweet_times.popleft()
+            # Claimed under the lock, so only one of the threads sharing the metrics exports
+            export = (
+                self.prometheus_filename is not None
+                and now - self._last_export >= self.export_interval
+            )
+            if export:
+                self._last_export = now
+        if export:
+            self.export_prometheus()
+
+    def tweets_per_second(self):
+        # Rolling rate over the last `rate_window` seconds
+        now = time.monotonic()
+        with self._lock:
+            while self._tweet_times and self._tweet_times[0] < now - self.rate_window:
+                self._tweet_times.popleft()
+            window = min(self.rate_window, now - self.start_time)
+            return len(self._tweet_times) / window if window > 0 else 0.0
+
+    def summary(self):
+        tweets_per_second = self.tweets_per_second()
+        elapsed = time.monotonic() - self.start_time
+        with self._lock:
+            return {
+                "elapsed_seconds": round(elapsed, 3),
+                "tweets": self._num_tweets,
+                "tweets_per_second": round(self._num_tweets / elapsed, 3) if elapsed else 0.0,
+                "rolling_tweets_per_second": round(tweets_per_second, 3),
+                "events": dict(self.counters),
+                "stages": {
+                    stage: histogram.summary()
+                    for stage, histogram in sorted(self.histograms.items())
+                },
+            }
+
+    def export_prometheus(self):
+        lines = [
+            "# TYPE ingest_tweets_total counter",
+            f"ingest_tweets_total {self._num_tweets}",
+            "# TYPE ingest_tweets_per_second gauge",
+            f"ingest_tweets_per_second {self.tweets_per_second():.6f}",
+            "# TYPE ingest_events_total counter",
+        ]
+        with self._lock:
+            self._last_export = time.monotonic()
+            for event, value in sorted(self.counters.items()):
+                lines.append(f'ingest_events_total{{event="{event}"}} {value}')
+            lines.append("# TYPE ingest_stage_seconds histogram")
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(
+                        f'ingest_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}'
+                    )
+                lines.append(
+                    f'ingest_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}'
+                )
+                lines.append(f'ingest_stage_seconds_sum{{stage="{stage}"}} {histogram.sum:.6f}')
+                lines.append(f'ingest_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+        _write_atomic(self.prometheus_filename, "\n".join(lines) + "\n")
+
+    def finish(self):
+        if self.prometheus_filename:
+            self.export_prometheus()
+        summary = self.summary()
+        if self.summary_filename:
+            _write_atomic(self.summary_filename, json.dumps(summary, indent=2))
+        return summary
+
+
+class NullMetrics:
+    _context = nullcontext()
+
+    def inc(self, event, value=1):
+        pass
+
+    def observe(self, stage, seconds):
+        pass
+
+    def time(self, stage):
+        return self._context
+
+    def tweet_done(self):
+        pass
+
+    def finish(self):
+        return None
+
+
+def _write_atomic(filename, content):
+    # Scrapers (e.g. node_exporter's textfile collector) never see a half-written file
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # One temporary file per thread, several threads can export at once (e.g. `finish`)
+    tmp_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_filename, "w", encoding="utf-8") as file:
+        file.write(content)
+    os.replace(tmp_filename, filename)
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# Filtered image search without post-filtering: MetadataIndex holds the tweet fields of
+# every image of an EmbeddingMatrix as per-value bitmaps (author_handle, lang, is_retweet)
+# and sorted columns (date, num_like), built once when the tweet table is loaded. A
+# MetadataFilter resolves to the sorted indices of the matching images, and only those are
+# scored (see the `candidates` argument of the vector_index searches).
+from collections import namedtuple
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from tweet_lookup import TweetLookup
+
+
+BITMAP_COLUMNS = ("author_handle", "lang", "is_retweet")
+RANGE_COLUMNS = ("date", "num_like")
+FILTER_COLUMNS = BITMAP_COLUMNS + RANGE_COLUMNS
+
+
+# authors/langs: any of the values (or a single value); date_from/date_to: "YYYY-MM-DD"
+# or dates, inclusive; min_likes/max_likes: inclusive. None means no condition.
+class MetadataFilter(
+    namedtuple(
+        "MetadataFilter",
+        ["authors", "langs", "is_retweet", "date_from", "date_to", "min_likes", "max_likes"],
+        defaults=[None] * 7,
+    )
+):
+    __slots__ = ()
+
+    @classmethod
+    def from_json(cls, value):
+        # From a JSON object with the same keys, e.g. the "filter" of a search request
+        if not value:
+            return cls()
+        unknown = set(value) - set(cls._fields)
+        if unknown:
+            raise ValueError(f"Unknown filter fields: {', '.join(sorted(unknown))}")
+        return cls(**value)
+
+    def to_json(self):
+        return {
+            field: value.isoformat() if isinstance(value, date) else value
+            for field, value in self._asdict().items()
+            if value is not None
+        }
+
+    def key(self):
+        # Hashable, equal for equal filters (e.g. to group the queries of a batch)
+        return tuple(
+            tuple(sorted(_values(value)))
+            if isinstance(value, (list, tuple, set, str))
+            else str(value)
+            for value in self
+        )
+
+    def __bool__(self):
+        return any(value is not None for value in self)
+
+    def matches(self, tweet):
+        # Checks one tweet (a mapping with the FILTER_COLUMNS, `date` as a date or
+        # "YYYY-MM-DD"), for results that do not come from a MetadataIndex
+        if self.authors is not None:
+            authors = {_normalize_handle(author) for author in _values(self.authors)}
+            if _normalize_handle(tweet.get("author_handle") or "") not in authors:
+                return False
+        if self.langs is not None and tweet.get("lang") not in _values(self.langs):
+            return False
+        if self.is_retweet is not None and tweet.get("is_retweet") != bool(self.is_retweet):
+            return False
+        if self.date_from is not None or self.date_to is not None:
+            if tweet.get("date") is None:
+                return False
+            day = _day(tweet["date"])
+            if self.date_from is not None and day < _day(self.date_from):
+                return False
+            if self.date_to is not None and day > _day(self.date_to):
+                return False
+        if self.min_likes is not None or self.max_likes is not None:
+            num_like = tweet.get("num_like")
+            if num_like is None:
+                return False
+            if self.min_likes is not None and num_like < self.min_likes:
+                return False
+            if self.max_likes is not None and num_like > self.max_likes:
+                return False
+        return True
+
+
+def _values(value):
+    return [value] if isinstance(value, str) else list(value)
+
+
+def _normalize_handle(handle):
+    # "@user" and "user" are the same author, handles are case-insensitive
+    return handle.lstrip("@").lower()
+
+
+def _day(value):
+    # Days since the epoch
+    return int(np.datetime64(pd.Timestamp(value).date(), "D").astype(np.int64))
+
+
+class MetadataIndex:
+    # Columns are aligned with the files of the EmbeddingMatrix it was built for; images
+    # without a loaded tweet match no condition.
+    def __init__(self, size, bitmaps, sorted_columns):
+        self.size = size
+        # column -> {value: packed bitmap of the images with that value}
+        self.bitmaps = bitmaps
+        # column -> (sorted values, image indices in that order)
+        self.sorted_columns = sorted_columns
+
+    @classmethod
+    def build(cls, embeddings, tweets, tweet_lookup=None):
+        # tweets: the tweet table, with the FILTER_COLUMNS that are present
+        if tweet_lookup is None:
+            tweet_lookup = TweetLookup.from_df(tweets)
+        size = len(embeddings)
+        rows = tweet_lookup.rows(embeddings.tweet_ids)
+        images = np.flatnonzero(rows >= 0)
+        rows = rows[images]
+
+        bitmaps = {}
+        for column in BITMAP_COLUMNS:
+            if column not in tweets:
+                continue
+            values = tweets[column].to_numpy()[rows]
+            known = ~pd.isna(values)
+            if column == "author_handle":
+                values = np.array(
+                    [_normalize_handle(value) for value in values[known]], dtype=object
+                )
+            else:
+                values = values[known]
+            codes, uniques = pd.factorize(values)
+            known_images = images[known]
+            order = np.argsort(codes, kind="stable")
+            bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+            bitmaps[column] = {
+                value: _bitmap(known_images[order[bounds[i] : bounds[i + 1]]], size)
+                for i, value in enumerate(uniques.tolist())
+            }
+
+        sorted_columns = {}
+        for column in RANGE_COLUMNS:
+            if column not in tweets:
+                continue
+            values = tweets[column]
+            if column == "date":
+                values = pd.to_datetime(values).dt.normalize()
+                known = values.notna().to_numpy()[rows]
+                values = values.to_numpy().astype("datetime64[D]").astype(np.int64)[rows]
+            else:
+                known = values.notna().to_numpy()[rows]
+                values = values.fillna(0).to_numpy(dtype=np.int64)[rows]
+            order = np.argsort(values[known], kind="stable")
+            sorted_columns[column] = (values[known][order], images[known][order])
+        return cls(size, bitmaps, sorted_columns)
+
+    def candidates(self, metadata_filter):
+        # Sorted indices of the matching images, None when the filter has no condition
+        if not metadata_filter:
+            return None
+        bitmaps = []
+        if metadata_filter.authors is not None:
+            authors = _values(metadata_filter.authors)
+            authors = [_normalize_handle(author) for author in authors]
+            bitmaps.append(self._any_of("author_handle", authors))
+        if metadata_filter.langs is not None:
+            bitmaps.append(self._any_of("lang", _values(metadata_filter.langs)))
+        if metadata_filter.is_retweet is not None:
+            bitmaps.append(self._any_of("is_retweet", [bool(metadata_filter.is_retweet)]))
+        if metadata_filter.date_from is not None or metadata_filter.date_to is not None:
+            date_from, date_to = metadata_filter.date_from, metadata_filter.date_to
+            bitmaps.append(
+                self._between(
+                    "date",
+                    _day(date_from) if date_from is not None else None,
+                    _day(date_to) if date_to is not None else None,
+                )
+            )
+        if metadata_filter.min_likes is not None or metadata_filter.max_likes is not None:
+            bitmaps.append(
+                self._between("num_like", metadata_filter.min_likes, metadata_filter.max_likes)
+            )
+        bitmap = np.bitwise_and.reduce(bitmaps) if len(bitmaps) > 1 else bitmaps[0]
+        return np.flatnonzero(np.unpackbits(bitmap, count=self.size))
+
+    def _any_of(self, column, values):
+        if column not in self.bitmaps:
+            raise ValueError(f"The tweet table has no {column} column to filter on.")
+        bitmap = _bitmap([], self.size)
+        for value in values:
+            value_bitmap = self.bitmaps[column].get(value)
+            if value_bitmap is not None:
+                bitmap |= value_bitmap
+        return bitmap
+
+    def _between(self, column, low, high):
+        # Images with low <= value <= high, from two binary searches in the sorted column
+        if column not in self.sorted_columns:
+            raise ValueError(f"The tweet table has no {column} column to filter on.")
+        values, images = self.sorted_columns[column]
+        start = np.searchsorted(values, low, "left") if low is not None else 0
+        end = np.searchsorted(values, high, "right") if high is not None else len(values)
+        return _bitmap(images[start:end], self.size)
+
+    def values(self, column):
+        # The values of a bitmap column, e.g. to offer them in a UI
+        return sorted(self.bitmaps.get(column, {}), key=str)
+
+    def date_range(self):
+        # (first, last) date of the images with a tweet, None when there is none
+        values, _ = self.sorted_columns.get("date", ((), None))
+        if not len(values):
+            return None
+        first, last = np.array([values[0], values[-1]]).astype("datetime64[D]").tolist()
+        return first, last
+
+    def __len__(self):
+        return self.size
+
+
+def _bitmap(indices, size):
+    bits = np.zeros(size, dtype=bool)
+    bits[np.asarray(indices, dtype=np.int64)] = True
+    return np.packbits(bits)
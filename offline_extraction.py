@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# Runs the TwitterExtractor extraction code (`_process_tweet` and its helpers, unchanged)
+# over saved timeline HTML with lxml, so it can be benchmarked and regression-tested
+# without a browser.
+import re
+from urllib.parse import urljoin
+
+from lxml import etree
+from lxml import html as lxml_html
+from selenium.common.exceptions import NoSuchElementException
+from selenium.webdriver.common.by import By
+
+from ingest_metrics import NullMetrics
+from tweet_record import epoch_day
+from twitter_data_ingestion import TwitterExtractor
+
+
+TWEET_XPATH = "//article[@data-testid='tweet']"
+
+# Elements WebDriver renders on their own line(s) in `.text`
+BLOCK_TAGS = {
+    "address", "article", "aside", "blockquote", "dd", "div", "dl", "dt", "fieldset",
+    "figcaption", "figure", "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6",
+    "header", "hr", "li", "main", "nav", "ol", "p", "pre", "section", "table", "tr",
+    "ul",
+}
+INVISIBLE_TAGS = {"head", "noscript", "script", "style", "template", "title"}
+# Selenium's get_attribute returns these as resolved (absolute) URLs
+URL_ATTRIBUTES = {"href", "src"}
+
+# The CSS selectors the extractor uses are all `tag` or `tag[attribute='value']`
+_SIMPLE_CSS_SELECTOR = re.compile(r"^([\w-]+)(?:\[([\w-]+)='([^']*)'\])?$")
+
+
+def css_to_xpath(selector):
+    match = _SIMPLE_CSS_SELECTOR.match(selector.strip())
+    if not match:
+        raise ValueError(f"Unsupported CSS selector: {selector}")
+    tag, attribute, value = match.groups()
+    if attribute:
+        return f".//{tag}[@{attribute}='{value}']"
+    return f".//{tag}"
+
+
+def inner_text(element):
+    # Approximates WebDriver's visible text: whitespace is collapsed, block elements
+    # start a new line (without adding empty ones), <br> always breaks the line.
+    lines = [""]
+
+    def new_line(force=False):
+        if force or lines[-1].strip():
+            lines.append("")
+
+    def add_text(text):
+        if text:
+            lines[-1] += re.sub(r"\s+", " ", text)
+
+    def walk(node):
+        tag = node.tag if isinstance(node.tag, str) else None
+        if tag is None or tag in INVISIBLE_TAGS or node.get("hidden") is not None:
+            return
+        if tag == "br":
+            new_line(force=True)
+            return
+        is_block = tag in BLOCK_TAGS
+        if is_block:
+            new_line()
+        add_text(node.text)
+        for child in node:
+            walk(child)
+            add_text(child.tail)
+        if is_block:
+            new_line()
+
+    walk(element)
+    stripped = [line.strip() for line in lines]
+    return "\n".join(stripped).strip("\n")
+
+
+class HtmlElement:
+    # The part of Selenium's WebElement the extraction code uses, over an lxml element
+    def __init__(self, element, base_url):
+        self._element = element
+        self.base_url = base_url
+
+    def find_elements(self, by, selector):
+        if by == By.CSS_SELECTOR:
+            selector = css_to_xpath(selector)
+        elif by != By.XPATH:
+            raise ValueError(f"Unsupported locator strategy: {by}")
+        return [
+            HtmlElement(element, self.base_url)
+            for element in self._element.xpath(selector)
+            if isinstance(element, etree.ElementBase)
+        ]
+
+    def find_element(self, by, selector):
+        elements = self.find_elements(by, selector)
+        if not elements:
+            raise NoSuchElementException(f"Unable to locate element: {selector}")
+        return elements[0]
+
+    @property
+    def text(self):
+        return inner_text(self._element)
+
+    def get_attribute(self, name):
+        value = self._element.get(name)
+        if value is not None and name in URL_ATTRIBUTES:
+            return urljoin(self.base_url, value)
+        return value
+
+    def __repr__(self):
+        return f"<HtmlElement {self._element.tag} {dict(self._element.attrib)}>"
+
+
+class OfflineExtractor(TwitterExtractor):
+    # No Chrome is started: only the extraction helpers of TwitterExtractor are used.
+    # base_url resolves relative links the way the browser would for the saved page.
+    def __init__(self, base_url="https://twitter.com", metrics=None):
+        self.base_url = base_url
+        self.metrics = metrics if metrics is not None else NullMetrics()
+
+    def iter_tweets(self, source):
+        # source: a filename or file object with the saved page, or its HTML as a string
+        if isinstance(source, (str, bytes)) and source.lstrip()[:1] in ("<", b"<"):
+            document = lxml_html.fromstring(source)
+        else:
+            document = lxml_html.parse(source).getroot()
+        for article in document.xpath(TWEET_XPATH):
+            yield HtmlElement(article, self.base_url)
+
+    def iter_rows(self, source, start_date=None, end_date=None):
+        # Same date handling as `fetch_tweets` (dates in YYYY-MM-DD format): the timeline
+        # is newest first, so stop at the first tweet older than start_date
+        start_day = epoch_day(start_date) if start_date else None
+        end_day = epoch_day(end_date) if end_date else None
+        for tweet in self.iter_tweets(source):
+            with self.metrics.time("process_tweet"):
+                row = self._process_tweet(tweet)
+            if row.day is not None:
+                if start_day is not None and row.day < start_day:
+                    return
+                elif end_day is not None and row.day > end_day:
+                    continue
+            self.metrics.tweet_done()
+            yield row
+
+    def extract(self, source, start_date=None, end_date=None):
+        return list(self.iter_rows(source, start_date, end_date))
+
+
+if __name__ == "__main__":
+    import sys
+
+    from tweet_record import encode
+
+    # e.g. python offline_extraction.py data/timeline_snapshot.html
+    for row in OfflineExtractor().iter_rows(sys.argv[1]):
+        sys.stdout.buffer.write(encode(row))
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+# CPU inference of the UForm encoders with ONNX Runtime instead of PyTorch. `export` runs
+# once on a machine with torch and uform: it writes the image and text encoders as ONNX
+# graphs with a dynamic batch axis, dynamically quantized to int8 weights by default, plus
+# the tokenizer and the preprocessing settings. `load_model` then returns an
+# (encoder, processor) pair that works like uform.get_model's, on numpy arrays, without
+# importing torch. benchmarks/bench_onnx_encoder.py compares both backends.
+#
+#   python onnx_encoder.py --model unum-cloud/uform-vl-multilingual-v2
+#   python image_search.py embed downloaded_images --backend onnx
+import argparse
+import json
+import logging
+import os
+import shutil
+import threading
+
+import numpy as np
+from PIL import Image
+
+try:
+    import onnxruntime
+except ImportError:  # optional, only needed for the "onnx" backend
+    onnxruntime = None
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:  # installed with uform
+    Tokenizer = None
+
+
+logger = logging.getLogger(__name__)
+
+ONNX_MODELS_DIR = "onnx_models"
+CONFIG_FILENAME = "encoder.json"
+TOKENIZER_FILENAME = "tokenizer.json"
+TEXT_INPUTS = ("input_ids", "attention_mask")
+# Normalization of the CLIP-style image preprocessing of UForm; export checks that the
+# numpy preprocessing matches the model's processor
+IMAGE_MEAN = (0.48145466, 0.4578275, 0.40821073)
+IMAGE_STD = (0.26862954, 0.26130258, 0.27577711)
+# Inputs traced by the export and compared between the two backends
+_PROBE_TEXTS = ["a black cat on a sofa", "夕焼けの海", "长上下文", "#AI", ""]
+
+
+def model_dir(model_name, root=ONNX_MODELS_DIR):
+    return os.path.join(root, model_name.replace("/", "--"))
+
+
+def _encoder_filename(modality, quantized):
+    return f"{modality}_encoder{'.int8' if quantized else ''}.onnx"
+
+
+def _probe_image(size=256, seed=0):
+    pixels = np.random.default_rng(seed).integers(0, 256, (size, size + 32, 3), dtype=np.uint8)
+    return Image.fromarray(pixels)
+
+
+class OnnxProcessor:
+    # Numpy version of the uform processor: preprocess_image gives a (1, 3, size, size)
+    # float32 array, preprocess_text a dict of (len(texts), context_length) int64 arrays
+    def __init__(self, config, tokenizer):
+        self.image_size = config["image_size"]
+        self.context_length = config["context_length"]
+        self.pad_token_id = config["pad_token_id"]
+        self._mean = np.array(config["image_mean"], dtype=np.float32)
+        self._std = np.array(config["image_std"], dtype=np.float32)
+        self._tokenizer = tokenizer
+        self._tokenizer.no_padding()
+        self._tokenizer.no_truncation()
+
+    def preprocess_image(self, image):
+        # Resize the short side (bicubic), center crop, scale to [0, 1] and normalize
+        image = image.convert("RGB")
+        scale = self.image_size / min(image.size)
+        width = max(self.image_size, round(image.width * scale))
+        height = max(self.image_size, round(image.height * scale))
+        image = image.resize((width, height), Image.BICUBIC)
+        left, top = (width - self.image_size) // 2, (height - self.image_size) // 2
+        image = image.crop((left, top, left + self.image_size, top + self.image_size))
+        pixels = np.asarray(image, dtype=np.float32) / 255
+        pixels = (pixels - self._mean) / self._std
+        return np.ascontiguousarray(pixels.transpose(2, 0, 1)[None])
+
+    def preprocess_text(self, texts):
+        input_ids = np.full((len(texts), self.context_length), self.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((len(texts), self.context_length), dtype=np.int64)
+        for i, encoding in enumerate(self._tokenizer.encode_batch(list(texts))):
+            ids = encoding.ids[: self.context_length]
+            input_ids[i, : len(ids)] = ids
+            attention_mask[i, : len(ids)] = 1
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+
+class OnnxEncoder:
+    # encode_image/encode_text like the uform model, on numpy arrays, returning (batch,
+    # dim) float32 embeddings. Each session is created on first use, so a process that
+    # only encodes queries never loads the image encoder.
+    backend = "onnx"
+
+    def __init__(self, folder_path, quantized=True, num_threads=None):
+        if onnxruntime is None:
+            raise ImportError("The onnx backend needs onnxruntime: pip install onnxruntime")
+        self.folder_path = folder_path
+        self.quantized = quantized
+        self.num_threads = num_threads
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _session(self, modality):
+        with self._lock:
+            session = self._sessions.get(modality)
+            if session is None:
+                filename = os.path.join(
+                    self.folder_path, _encoder_filename(modality, self.quantized)
+                )
+                if not os.path.exists(filename):
+                    command = "python onnx_encoder.py" + (
+                        "" if self.quantized else " --no-quantize"
+                    )
+                    raise FileNotFoundError(
+                        f"{filename} is missing, export the model with `{command}`."
+                    )
+                options = onnxruntime.SessionOptions()
+                options.graph_optimization_level = (
+                    onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+                )
+                options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+                # One forward pass at a time per session: all threads go to its operators
+                options.inter_op_num_threads = 1
+                if self.num_threads:
+                    options.intra_op_num_threads = self.num_threads
+                session = onnxruntime.InferenceSession(
+                    filename, options, providers=["CPUExecutionProvider"]
+                )
+                self._sessions[modality] = session
+        return session
+
+    def encode_image(self, images, return_features=False):
+        images = np.ascontiguousarray(images, dtype=np.float32)
+        return self._session("image").run(None, {"images": images})[0]
+
+    def encode_text(self, text_inputs, return_features=False):
+        feed = {name: np.ascontiguousarray(text_inputs[name]) for name in TEXT_INPUTS}
+        return self._session("text").run(None, feed)[0]
+
+
+def load_model(model_name, folder_path=None, quantized=True, num_threads=None):
+    # (OnnxEncoder, OnnxProcessor) of an exported model, in place of uform.get_model
+    if Tokenizer is None:
+        raise ImportError("The onnx backend needs tokenizers: pip install tokenizers")
+    folder_path = folder_path or model_dir(model_name)
+    config_filename = os.path.join(folder_path, CONFIG_FILENAME)
+    if not os.path.exists(config_filename):
+        raise FileNotFoundError(
+            f"No exported model in {folder_path}, run `python onnx_encoder.py --model {model_name}`"
+        )
+    with open(config_filename, encoding="utf-8") as f:
+        config = json.load(f)
+    if config["model"] != model_name:
+        raise ValueError(f"{folder_path} holds {config['model']}, not {model_name}.")
+    tokenizer = Tokenizer.from_file(os.path.join(folder_path, TOKENIZER_FILENAME))
+    return OnnxEncoder(folder_path, quantized, num_threads), OnnxProcessor(config, tokenizer)
+
+
+def _check_preprocessing(onnx_processor, image_inputs, text_inputs):
+    # The numpy preprocessing must feed the graphs what the uform processor feeds the model
+    pixels = onnx_processor.preprocess_image(_probe_image())
+    if pixels.shape != image_inputs.shape or not np.allclose(pixels, image_inputs, atol=0.05):
+        raise ValueError(
+            "The numpy image preprocessing does not match the processor of the model: "
+            f"max difference {np.abs(pixels - image_inputs).max():.3f}."
+        )
+    tokens = onnx_processor.preprocess_text(_PROBE_TEXTS)
+    for name in TEXT_INPUTS:
+        if not np.array_equal(tokens[name], text_inputs[name]):
+            raise ValueError(f"The tokenization does not match the processor of the model ({name}).")
+
+
+def export(model_name, folder_path=None, quantize=True, opset_version=17):
+    # Writes the encoders (float32, and int8 when quantizing), the tokenizer and
+    # encoder.json to folder_path, and returns it
+    import torch
+    import uform
+    from huggingface_hub import hf_hub_download
+
+    folder_path = folder_path or model_dir(model_name)
+    os.makedirs(folder_path, exist_ok=True)
+    model, processor = uform.get_model(model_name)
+    model.eval()
+
+    image_inputs = processor.preprocess_image(_probe_image())
+    if image_inputs.ndim == 3:
+        image_inputs = image_inputs.unsqueeze(0)
+    text_inputs = processor.preprocess_text(_PROBE_TEXTS)
+    if set(text_inputs) != set(TEXT_INPUTS):
+        raise ValueError(f"Unexpected text inputs of {model_name}: {sorted(text_inputs)}")
+
+    class ImageEncoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, images):
+            return self.model.encode_image(images, return_features=False)
+
+    class TextEncoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            text_inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+            return self.model.encode_text(text_inputs, return_features=False)
+
+    with torch.no_grad():
+        dim = model.encode_image(image_inputs, return_features=False).shape[-1]
+        for modality, encoder, args, input_names in (
+            ("image", ImageEncoder(), (image_inputs,), ["images"]),
+            (
+                "text",
+                TextEncoder(),
+                tuple(text_inputs[name] for name in TEXT_INPUTS),
+                list(TEXT_INPUTS),
+            ),
+        ):
+            filename = os.path.join(folder_path, _encoder_filename(modality, False))
+            torch.onnx.export(
+                encoder,
+                args,
+                filename,
+                input_names=input_names,
+                output_names=["embeddings"],
+                dynamic_axes={name: {0: "batch"} for name in input_names + ["embeddings"]},
+                opset_version=opset_version,
+            )
+            logger.info(f"Exported the {modality} encoder to {filename}.")
+
+    shutil.copyfile(
+        hf_hub_download(model_name, TOKENIZER_FILENAME),
+        os.path.join(folder_path, TOKENIZER_FILENAME),
+    )
+    config = {
+        "model": model_name,
+        "dim": int(dim),
+        "image_size": int(image_inputs.shape[-1]),
+        "image_mean": IMAGE_MEAN,
+        "image_std": IMAGE_STD,
+        "context_length": int(text_inputs["input_ids"].shape[1]),
+        # The last probe text is empty, so it ends with padding
+        "pad_token_id": int(text_inputs["input_ids"][-1, -1]),
+        "opset_version": opset_version,
+    }
+    with open(os.path.join(folder_path, CONFIG_FILENAME), "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2)
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        # int8 weights, activations quantized on the fly: MatMul/Gemm run on int8 kernels
+        for modality in ("image", "text"):
+            quantize_dynamic(
+                os.path.join(folder_path, _encoder_filename(modality, False)),
+                os.path.join(folder_path, _encoder_filename(modality, True)),
+                weight_type=QuantType.QInt8,
+            )
+        logger.info(f"Quantized the encoders to int8 in {folder_path}.")
+
+    encoder, onnx_processor = load_model(model_name, folder_path, quantized=False)
+    _check_preprocessing(
+        onnx_processor,
+        image_inputs.numpy(),
+        {name: text_inputs[name].numpy() for name in TEXT_INPUTS},
+    )
+    with torch.no_grad():
+        expected = model.encode_text(text_inputs, return_features=False).numpy()
+    drift = 1 - cosine_similarities(expected, encoder.encode_text(text_inputs))
+    logger.info(f"float32 text encoder: max cosine drift {drift.max():.2e} on the probe texts.")
+    return folder_path
+
+
+def cosine_similarities(a, b):
+    # Row-wise cosine similarity of two (n, dim) arrays
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return np.sum(a * b, axis=1)
+
+
+if __name__ == "__main__":
+    from image_search import DEFAULT_MODEL
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    parser = argparse.ArgumentParser(description="Export the UForm encoders to ONNX.")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument(
+        "--output-dir", default=None, help="Default: onnx_models/<model name>."
+    )
+    parser.add_argument(
+        "--no-quantize", action="store_true", help="Only export the float32 encoders."
+    )
+    parser.add_argument("--opset", type=int, default=17)
+    args = parser.parse_args()
+    export(args.model, args.output_dir, not args.no_quantize, args.opset)
@@ -0,0 +1,567 @@
+# -*- coding: utf-8 -*-
+# Headless image search: loads the model, the vector index and the tweet table once per
+# process and answers JSON queries over local HTTP. Concurrent queries are micro-batched:
+# a worker takes every query that arrives within `max_wait` seconds (up to
+# `max_batch_size`), encodes them in one forward pass and scores them with one search.
+#
+#   python search_service.py downloaded_images --data data/tweets_parquet --port 8765
+#
+#   POST /search  {"queries": ["black cat"], "top_k": 6, "thumbnails": true (as data: URIs),
+#                  "filter": {"langs": ["ja"], "date_from": "2024-03-01", "min_likes": 100},
+#                  "mode": "image" | "text" | "hybrid"}
+#   POST /embed   embeds the new and changed images, then reloads the index
+#   POST /reload  {"data": "data/tweets_parquet"}, reloads the index and the tweet table
+#   GET  /stats
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+import argparse
+import logging
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import requests
+
+from embedding_store import EmbeddingIndex
+from image_search import (
+    BACKENDS,
+    DEFAULT_MODEL,
+    QueryEmbeddingCache,
+    embed_images,
+    encode_queries,
+    list_image_files,
+    load_model,
+    search_index,
+)
+from metadata_filter import MetadataFilter, MetadataIndex
+from text_index import TextIndex, reciprocal_rank_fusion
+from thumbnail_cache import ThumbnailCache, thumbnail_data_uri
+from tweet_lookup import TweetLookup
+from tweet_record import dumps, loads, records_to_df
+from tweet_store import TweetStore
+from tweet_writer import read_records
+from vector_index import open_index
+
+
+logger = logging.getLogger(__name__)
+
+# image: image similarity only, text: keyword (BM25) search of the tweets only, hybrid:
+# both, fused by reciprocal rank
+SEARCH_MODES = ("image", "text", "hybrid")
+# Text and hybrid searches rank this many times top_k candidates of each kind
+FUSION_DEPTH = 4
+
+TWEET_COLUMNS = [
+    "tweet_id",
+    "url",
+    "author_name",
+    "author_handle",
+    "date",
+    "lang",
+    "is_retweet",
+    "text",
+    "images_urls",
+    "mentioned_urls",
+    "num_like",
+    "num_retweet",
+    "num_reply",
+]
+
+
+def load_tweets(file_path, columns=TWEET_COLUMNS):
+    # A directory is the Parquet tweet store, only the columns shown here are read
+    if os.path.isdir(file_path):
+        return TweetStore(file_path).read(columns=columns)
+    # JSONL crawl output (plain or compressed), with the same date column as the store
+    return records_to_df(read_records(file_path), columns=columns)
+
+
+def keyword_query(query):
+    # The words of a query in double quotes, which only match tweets with all of them and
+    # skip the image search; None for other queries
+    query = query.strip()
+    if len(query) > 1 and query.startswith('"') and query.endswith('"'):
+        return query[1:-1]
+    return None
+
+
+def _tweet_json(tweet):
+    # A row of the tweet table with JSON types, `date` as YYYY-MM-DD
+    row = {}
+    for column, value in tweet.items():
+        if isinstance(value, pd.Timestamp):
+            value = value.strftime("%Y-%m-%d")
+        elif isinstance(value, np.ndarray):
+            value = value.tolist()
+        elif isinstance(value, np.generic):
+            value = value.item()
+        if not isinstance(value, (list, tuple)) and pd.isna(value):
+            value = None
+        row[column] = value
+    return row
+
+
+class SearchService:
+    # Without model_name/dtype/backend (the encoder, see image_search.BACKENDS), those of
+    # the folder's existing embedding index are used.
+    # `search`, `embed`, `reload` and `stats` are also what SearchClient calls over HTTP.
+    def __init__(
+        self,
+        folder_path,
+        data_path=None,
+        model_name=None,
+        dtype=None,
+        index_backend="auto",
+        max_batch_size=64,
+        max_wait=0.005,
+        num_workers=2,
+        query_cache_size=4096,
+        text_index_path=None,
+        backend=None,
+        num_threads=None,
+    ):
+        if model_name is None or dtype is None or backend is None:
+            try:
+                existing_index = EmbeddingIndex.open(folder_path)
+                model_name = model_name or existing_index.model_name
+                dtype = dtype or existing_index.dtype
+                backend = backend or existing_index.backend
+            except FileNotFoundError:
+                pass
+        self.folder_path = folder_path
+        self.data_path = data_path
+        self.model_name = model_name or DEFAULT_MODEL
+        self.dtype = dtype or "float16"
+        self.index_backend = index_backend
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        start_time = time.monotonic()
+        self.backend = backend or "torch"
+        self.model, self.processor = load_model(self.model_name, self.backend, num_threads)
+        self.query_cache = QueryEmbeddingCache(query_cache_size)
+        self.thumbnail_cache = ThumbnailCache(folder_path)
+        # Tweets are added as the tweet table is reloaded
+        self.text_index = TextIndex(text_index_path or os.path.join(folder_path, "text_index"))
+        # (vector index, tweet table, tweet lookup, metadata index), replaced as a whole
+        # so a batch never sees half of an update
+        self._state = (None, None, None, None)
+        self._embed_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.num_queries = 0
+        self.num_batches = 0
+        self.embedded_with = None
+        self.reload()
+        logger.info(f"Search service ready in {time.monotonic() - start_time:.1f}s.")
+        self._queue = queue.Queue()
+        for _ in range(num_workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def reload(self, data_path=None):
+        # Reopens the embeddings (e.g. after `image_search.py embed`) and the tweet table
+        data_path = data_path or self.data_path
+        _, tweets, tweet_lookup, _ = self._state
+        if data_path:
+            tweets = load_tweets(data_path)
+            tweet_lookup = TweetLookup.from_df(tweets)
+            self.text_index.add_df(tweets)
+        self._set_state(self._open_vector_index(), tweets, tweet_lookup)
+        self.data_path = data_path
+        return self.stats()
+
+    def _set_state(self, vector_index, tweets, tweet_lookup):
+        # The filter bitmaps are aligned with the embeddings, so they are rebuilt with the
+        # vector index
+        metadata_index = None
+        if vector_index is not None and tweets is not None:
+            metadata_index = MetadataIndex.build(vector_index.embeddings, tweets, tweet_lookup)
+        self._state = (vector_index, tweets, tweet_lookup, metadata_index)
+
+    def _open_vector_index(self):
+        # Embeddings made with other settings are left as they are until `embed`, and
+        # reported in the stats as "embedded_with"
+        embedding_index = EmbeddingIndex(
+            self.folder_path, self.model_name, self.dtype, self.backend
+        )
+        self.embedded_with = None
+        if embedding_index.replaces is not None:
+            self.embedded_with = {
+                key: embedding_index.replaces[key] for key in ("model", "dtype", "backend")
+            }
+        embeddings = embedding_index.load()
+        if not len(embeddings):
+            return None
+        return open_index(embeddings, self.folder_path, self.index_backend)
+
+    def embed(self, batch_size=32, num_workers=4):
+        # Embeds the new and changed images with the loaded model
+        with self._embed_lock:
+            index = EmbeddingIndex(self.folder_path, self.model_name, self.dtype, self.backend)
+            file_paths = index.update(list_image_files(self.folder_path))
+            embedded_paths = []
+            if file_paths:
+                embeddings, embedded_paths = embed_images(
+                    file_paths,
+                    self.model,
+                    self.processor,
+                    batch_size=batch_size,
+                    num_workers=num_workers,
+                )
+                index.add(embedded_paths, embeddings)
+            _, tweets, tweet_lookup, _ = self._state
+            self._set_state(self._open_vector_index(), tweets, tweet_lookup)
+            return {"embedded": len(embedded_paths), "images": len(index)}
+
+    def search(self, queries, top_k=6, thumbnails=False, metadata_filter=None, mode="image"):
+        # [{"query", "hits": [{"file_path", "similarity", "tweet", ("thumbnails")}]}] per
+        # query. The image searches are batched with those of concurrent requests. With a
+        # MetadataFilter, only the images of matching tweets are scored. Text and hybrid
+        # hits are one per tweet, with "text_score" (BM25) and "score" (fused rank) too,
+        # and file_path/similarity None when no image of the tweet matched.
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode: {mode}")
+        metadata_filter = metadata_filter or MetadataFilter()
+        image_top_k = top_k if mode == "image" else top_k * FUSION_DEPTH
+        # Hybrid searches are keyword-only until images are embedded
+        has_images = self._state[0] is not None
+        futures = []
+        for query in queries:
+            future = None
+            if mode == "image" or (
+                mode == "hybrid" and has_images and keyword_query(query) is None
+            ):
+                future = Future()
+                self._queue.put((query, image_top_k, metadata_filter, future))
+            futures.append(future)
+        results = []
+        for query, future in zip(queries, futures):
+            image_result = future.result() if future is not None else None
+            if mode == "image":
+                results.append(image_result)
+            else:
+                results.append(self._text_result(query, top_k, metadata_filter, image_result))
+        if thumbnails:
+            # Loaded concurrently for all hits
+            hits = [hit for result in results for hit in result["hits"] if hit["tweet"]]
+            tweets = [(hit["tweet"]["url"], hit["tweet"]["images_urls"]) for hit in hits]
+            for hit, thumbnail_paths in zip(hits, self.thumbnail_cache.many(tweets)):
+                hit["thumbnails"] = thumbnail_paths
+        return results
+
+    def _work(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self._search_batch(batch)
+
+    def _search_batch(self, batch):
+        vector_index, tweets, tweet_lookup, metadata_index = self._state
+        try:
+            if vector_index is None:
+                raise RuntimeError("No images are embedded yet.")
+            # One forward pass for the whole batch, then one search per distinct filter
+            query_embeddings = encode_queries(
+                [query for query, _, _, _ in batch],
+                self.model,
+                self.processor,
+                self.query_cache,
+                self.model_name,
+            )
+            groups = {}
+            for position, (_, _, metadata_filter, _) in enumerate(batch):
+                groups.setdefault(metadata_filter.key(), []).append(position)
+            for positions in groups.values():
+                self._search_group(
+                    [batch[position] for position in positions],
+                    query_embeddings[positions],
+                    vector_index,
+                    tweets,
+                    tweet_lookup,
+                    metadata_index,
+                )
+        except Exception as e:
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        with self._stats_lock:
+            self.num_queries += len(batch)
+            self.num_batches += 1
+
+    def _search_group(
+        self, batch, query_embeddings, vector_index, tweets, tweet_lookup, metadata_index
+    ):
+        # Queries with the same filter
+        try:
+            metadata_filter = batch[0][2]
+            candidates = None
+            if metadata_filter:
+                if metadata_index is None:
+                    raise ValueError("Load the tweet data to filter the search.")
+                candidates = metadata_index.candidates(metadata_filter)
+            # One hit per group of duplicate images
+            top_indices, similarities = search_index(
+                vector_index,
+                query_embeddings,
+                max(top_k for _, top_k, _, _ in batch),
+                candidates,
+            )
+            for (query, top_k, _, future), indices, scores in zip(
+                batch, top_indices, similarities
+            ):
+                result = self._result(
+                    query, indices[:top_k], scores[:top_k], vector_index, tweets, tweet_lookup
+                )
+                future.set_result(result)
+        except Exception as e:
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def _result(self, query, indices, similarities, vector_index, tweets, tweet_lookup):
+        tweet_rows = np.full(len(indices), -1)
+        if tweet_lookup is not None:
+            tweet_rows = tweet_lookup.rows(vector_index.embeddings.tweet_ids[indices])
+        group_sizes = vector_index.embeddings.group_sizes()
+        hits = [
+            {
+                "file_path": vector_index.file_paths[index],
+                "similarity": float(similarity),
+                "tweet": _tweet_json(tweets.iloc[row]) if row >= 0 else None,
+                # Other copies of the image, collapsed into this hit
+                "duplicates": int(group_sizes[index]) - 1,
+            }
+            for index, similarity, row in zip(indices, similarities, tweet_rows)
+        ]
+        return {"query": query, "hits": hits}
+
+    def _text_result(self, query, top_k, metadata_filter, image_result=None):
+        # Keyword hits, fused with the image hits when there are some
+        _, tweets, tweet_lookup, _ = self._state
+        keywords = keyword_query(query)
+        tweet_ids, text_scores = self.text_index.search(
+            keywords if keywords is not None else query,
+            top_k * FUSION_DEPTH,
+            require_all=keywords is not None,
+        )
+        rows = np.full(len(tweet_ids), -1)
+        if tweet_lookup is not None:
+            rows = tweet_lookup.rows(tweet_ids)
+        hits = {}
+        for row, text_score in zip(rows, text_scores):
+            if row < 0:
+                # Indexed from a tweet table that is not loaded any more
+                continue
+            tweet = _tweet_json(tweets.iloc[row])
+            # The text index has no metadata bitmaps, its hits are checked one by one
+            if metadata_filter and not metadata_filter.matches(tweet):
+                continue
+            hits[tweet["tweet_id"]] = {
+                "file_path": None,
+                "similarity": None,
+                "duplicates": 0,
+                "text_score": float(text_score),
+                "tweet": tweet,
+            }
+        rankings = [list(hits)]
+        if image_result is not None:
+            image_keys = []
+            for hit in image_result["hits"]:
+                # The best image of each tweet; images without a loaded tweet rank alone
+                key = hit["tweet"]["tweet_id"] if hit["tweet"] else hit["file_path"]
+                if key in image_keys:
+                    continue
+                image_keys.append(key)
+                if key in hits:
+                    hits[key].update(
+                        file_path=hit["file_path"],
+                        similarity=hit["similarity"],
+                        duplicates=hit["duplicates"],
+                    )
+                else:
+                    hits[key] = dict(hit, text_score=None)
+            rankings.append(image_keys)
+        fused = reciprocal_rank_fusion(rankings)[:top_k]
+        return {"query": query, "hits": [dict(hits[key], score=score) for key, score in fused]}
+
+    def stats(self):
+        vector_index, tweets, _, _ = self._state
+        with self._stats_lock:
+            num_queries, num_batches = self.num_queries, self.num_batches
+        return {
+            "model": self.model_name,
+            "backend": self.backend,
+            "dtype": self.dtype,
+            "images": len(vector_index) if vector_index is not None else 0,
+            "embedded_with": self.embedded_with,
+            "index": vector_index.name if vector_index is not None else None,
+            "tweets": len(tweets) if tweets is not None else None,
+            "text_index": len(self.text_index),
+            "queries": num_queries,
+            "batches": num_batches,
+            "mean_batch_size": num_queries / num_batches if num_batches else 0.0,
+            "query_cache": self.query_cache.stats(),
+        }
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    # self.server.service is the SearchService
+    def do_GET(self):
+        if urlparse(self.path).path == "/stats":
+            self._send(200, self.server.service.stats())
+        else:
+            self._send(404, {"error": f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        service = self.server.service
+        path = urlparse(self.path).path
+        try:
+            content_length = int(self.headers.get("Content-Length") or 0)
+            body = loads(self.rfile.read(content_length) or b"{}")
+            if path == "/search":
+                queries = body["queries"] if "queries" in body else [body["query"]]
+                results = service.search(
+                    queries,
+                    int(body.get("top_k", 6)),
+                    bool(body.get("thumbnails", False)),
+                    MetadataFilter.from_json(body.get("filter")),
+                    body.get("mode", "image"),
+                )
+                # Thumbnail paths are only meaningful on this machine
+                for result in results:
+                    for hit in result["hits"]:
+                        if hit.get("thumbnails"):
+                            hit["thumbnails"] = [
+                                thumbnail_data_uri(path) if path is not None else None
+                                for path in hit["thumbnails"]
+                            ]
+                self._send(200, {"results": results})
+            elif path == "/embed":
+                self._send(200, service.embed())
+            elif path == "/reload":
+                self._send(200, service.reload(body.get("data")))
+            else:
+                self._send(404, {"error": f"Unknown path: {self.path}"})
+        except (KeyError, TypeError, ValueError, FileNotFoundError) as e:
+            self._send(400, {"error": f"Bad request: {e}"})
+        except Exception as e:
+            logger.exception(f"Error handling {path}")
+            self._send(500, {"error": str(e)})
+
+    def _send(self, status, payload):
+        body = dumps(payload)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(service, host="127.0.0.1", port=8765):
+    # Serves in a daemon thread, returns the server (call shutdown() when done)
+    server = ThreadingHTTPServer((host, port), SearchRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class SearchClient:
+    # The same search/embed/reload/stats calls as SearchService, against a running
+    # service
+    def __init__(self, base_url="http://127.0.0.1:8765", timeout=(3, 60)):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+        return session
+
+    def _request(self, method, path, payload=None, timeout=None):
+        response = self._session().request(
+            method, f"{self.base_url}{path}", json=payload, timeout=timeout or self.timeout
+        )
+        if response.status_code >= 400:
+            raise RuntimeError(response.json().get("error", response.text))
+        return response.json()
+
+    def search(self, queries, top_k=6, thumbnails=False, metadata_filter=None, mode="image"):
+        payload = {"queries": queries, "top_k": top_k, "thumbnails": thumbnails, "mode": mode}
+        if metadata_filter:
+            payload["filter"] = metadata_filter.to_json()
+        return self._request("POST", "/search", payload)["results"]
+
+    def embed(self):
+        # Can take long on a big folder, so there is no read timeout
+        return self._request("POST", "/embed", timeout=(self.timeout[0], None))
+
+    def reload(self, data_path=None):
+        return self._request("POST", "/reload", {"data": data_path})
+
+    def stats(self):
+        return self._request("GET", "/stats")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    parser = argparse.ArgumentParser(description="Serve image search over local HTTP.")
+    parser.add_argument("folder_path", help="Folder of the embedded images.")
+    parser.add_argument(
+        "--data", help="JSON output of a crawl, or the Parquet tweet store folder."
+    )
+    parser.add_argument("--model", help="UForm model (default: the one of the embeddings).")
+    parser.add_argument("--dtype", choices=["float32", "float16", "int8"])
+    parser.add_argument("--index", choices=["auto", "exact", "ivf", "hnsw"], default="auto")
+    parser.add_argument(
+        "--backend", choices=BACKENDS, help="Encoder backend (default: the one of the embeddings)."
+    )
+    parser.add_argument(
+        "--num-threads", type=int, default=None, help="Intra-op threads of the encoder."
+    )
+    parser.add_argument(
+        "--text-index", help="Tweet text index folder (default: FOLDER_PATH/text_index)."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--num-workers", type=int, default=2)
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument(
+        "--max-wait-ms", type=float, default=5, help="How long a batch waits for more queries."
+    )
+    args = parser.parse_args()
+
+    service = SearchService(
+        args.folder_path,
+        args.data,
+        model_name=args.model,
+        dtype=args.dtype,
+        index_backend=args.index,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait_ms / 1000,
+        num_workers=args.num_workers,
+        text_index_path=args.text_index,
+        backend=args.backend,
+        num_threads=args.num_threads,
+    )
+    server = serve(service, args.host, args.port)
+    logger.info(f"Serving image search at http://{args.host}:{args.port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
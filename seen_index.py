@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# Persistent set of already ingested tweet IDs, shared across runs and crawl workers.
+import logging
+import math
+import os
+import sqlite3
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+_MASK64 = (1 << 64) - 1
+
+
+def tweet_id_from_url(url):
+    # e.g. https://twitter.com/llama_index/status/1763620476847632744
+    try:
+        return int(url.split("/status/")[1].split("/")[0].split("?")[0])
+    except (IndexError, ValueError, AttributeError):
+        return None
+
+
+def _splitmix64(x):
+    x = (x + 0x9E3779B97F4A7C15) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+
+class BloomFilter:
+    # Fast negatives in front of the SQLite lookup. Sized for `capacity` items at the
+    # given false positive rate, it degrades gracefully (more false positives) beyond.
+    def __init__(self, capacity=1_000_000, false_positive_rate=0.01):
+        self.num_bits = max(
+            8, int(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)
+        )
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, item):
+        # Double hashing: h1 + i * h2
+        h1 = _splitmix64(item)
+        h2 = _splitmix64(h1) | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+
+class SeenIndex:
+    # Tweet IDs live in SQLite (WAL mode, so several processes can share the file).
+    # `add` is authoritative; `__contains__` may answer from the Bloom filter for IDs
+    # this process has never seen. Inserts become visible to other processes on
+    # `commit`, which writers call right after flushing the records they cover.
+    def __init__(
+        self,
+        filename="data/seen_tweets.sqlite",
+        use_bloom_filter=True,
+        bloom_capacity=1_000_000,
+        bloom_false_positive_rate=0.01,
+    ):
+        self.filename = filename
+        if filename != ":memory:" and os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        if filename != ":memory:":
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS seen (tweet_id INTEGER PRIMARY KEY)"
+        )
+        self._connection.commit()
+
+        self._bloom = None
+        if use_bloom_filter:
+            self._bloom = BloomFilter(bloom_capacity, bloom_false_positive_rate)
+            for (tweet_id,) in self._connection.execute("SELECT tweet_id FROM seen"):
+                self._bloom.add(tweet_id)
+
+    def __contains__(self, tweet_id):
+        if tweet_id is None:
+            return False
+        if self._bloom is not None and tweet_id not in self._bloom:
+            return False
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM seen WHERE tweet_id = ?", (tweet_id,)
+            ).fetchone()
+        return row is not None
+
+    def seen_url(self, url):
+        return tweet_id_from_url(url) in self
+
+    def add(self, tweet_id):
+        # True if the ID was not seen before
+        if tweet_id is None:
+            return True
+        with self._lock:
+            cursor = self._connection.execute(
+                "INSERT OR IGNORE INTO seen (tweet_id) VALUES (?)", (tweet_id,)
+            )
+        if self._bloom is not None:
+            self._bloom.add(tweet_id)
+        return cursor.rowcount == 1
+
+    def add_url(self, url):
+        return self.add(tweet_id_from_url(url))
+
+    def commit(self):
+        with self._lock:
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM seen").fetchone()[0]
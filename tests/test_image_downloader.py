@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# ImageDownloader against a local HTTP server standing in for the image CDN.
+from functools import partial
+from http.server import ThreadingHTTPServer
+import hashlib
+import os
+import threading
+
+import pytest
+
+from benchmarks.fixture_server import QuietHandler, serve_fixtures
+from image_downloader import DownloadManifest, DownloadTask, ImageDownloader
+
+
+class NoHeadHandler(QuietHandler):
+    # Like the CDNs that reject HEAD requests
+    def do_HEAD(self):
+        self.send_error(405)
+
+
+@pytest.fixture
+def images(tmp_path):
+    # {name: bytes} of the images served by the stand-in
+    directory = tmp_path / "cdn"
+    directory.mkdir()
+    contents = {f"{name}.jpg": os.urandom(2000 + i) for i, name in enumerate("abc")}
+    for name, content in contents.items():
+        (directory / name).write_bytes(content)
+    return directory, contents
+
+
+@pytest.fixture
+def cdn(images):
+    server, base_url = serve_fixtures(str(images[0]))
+    yield base_url
+    server.shutdown()
+
+
+@pytest.fixture
+def cdn_without_head(images):
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(NoHeadHandler, directory=str(images[0]))
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/"
+    server.shutdown()
+
+
+def _downloader(output_dir):
+    return ImageDownloader(str(output_dir), requests_per_second=1000, max_attempts=1)
+
+
+def _task(output_dir, image_id, url):
+    return DownloadTask(image_id, url, os.path.join(str(output_dir), f"{image_id}.jpg"))
+
+
+def test_download_and_resume(tmp_path, images, cdn):
+    output_dir = tmp_path / "out"
+    tasks = [
+        _task(output_dir, f"user__{i}_1", f"{cdn}{name}.jpg") for i, name in enumerate("abc")
+    ]
+    with _downloader(output_dir) as downloader:
+        stats = downloader.download(tasks)
+    assert stats["downloaded"] == 3 and stats["failed"] == 0
+    for task, content in zip(tasks, images[1].values()):
+        with open(task.path, "rb") as file:
+            assert file.read() == content
+    manifest = DownloadManifest(str(output_dir / "manifest.jsonl"))
+    assert manifest.get("user__0_1")["sha256"] == hashlib.sha256(images[1]["a.jpg"]).hexdigest()
+    manifest.close()
+
+    # A rerun only verifies the files listed in the manifest
+    with _downloader(output_dir) as downloader:
+        stats = downloader.download(tasks)
+    assert stats["skipped"] == 3 and stats["downloaded"] == 0
+
+
+def test_shared_url_is_linked(tmp_path, images, cdn):
+    output_dir = tmp_path / "out"
+    tasks = [_task(output_dir, f"user__{i}_1", f"{cdn}a.jpg") for i in range(3)]
+    with _downloader(output_dir) as downloader:
+        stats = downloader.download(tasks)
+    assert (stats["downloaded"], stats["linked"]) == (1, 2)
+    for task in tasks:
+        with open(task.path, "rb") as file:
+            assert file.read() == images[1]["a.jpg"]
+
+
+def test_missing_image_fails(tmp_path, cdn):
+    output_dir = tmp_path / "out"
+    task = _task(output_dir, "user__1_1", f"{cdn}missing.jpg")
+    with _downloader(output_dir) as downloader:
+        stats = downloader.download([task])
+    assert stats["failed"] == 1
+    assert not os.path.exists(task.path) and not os.path.exists(f"{task.path}.part")
+
+
+def test_unknown_file_checked_with_head(tmp_path, images, cdn):
+    # A file from an older download is kept when the server reports the same size
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    task = _task(output_dir, "user__1_1", f"{cdn}a.jpg")
+    with open(task.path, "wb") as file:
+        file.write(images[1]["a.jpg"])
+    with _downloader(output_dir) as downloader:
+        stats = downloader.download([task])
+        assert downloader.manifest.get("user__1_1") is not None
+    assert stats["skipped"] == 1 and stats["downloaded"] == 0
+
+
+def test_unknown_file_downloaded_when_head_is_rejected(tmp_path, images, cdn_without_head):
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    task = _task(output_dir, "user__1_1", f"{cdn_without_head}a.jpg")
+    with open(task.path, "wb") as file:
+        file.write(b"stale")
+    with _downloader(output_dir) as downloader:
+        stats = downloader.download([task])
+    assert stats["downloaded"] == 1 and stats["failed"] == 0
+    with open(task.path, "rb") as file:
+        assert file.read() == images[1]["a.jpg"]
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# The extraction code of TwitterExtractor against the synthetic timeline fixtures, through
+# offline_extraction (lxml, no browser).
+from datetime import datetime, timezone
+
+import requests
+
+from benchmarks.fixture_server import serve_fixtures
+from benchmarks.timeline_fixtures import (
+    LANGS,
+    PAGE_FOOTER,
+    PAGE_HEADER,
+    fixture_filename,
+    write_fixture,
+)
+from offline_extraction import OfflineExtractor
+from tweet_record import epoch_day
+
+
+BASE_URL = "https://twitter.com/"
+FIRST_TWEET_ID = 1_760_000_000_000_000_000
+
+TWEET_HTML = (
+    '<article data-testid="tweet" tabindex="0">'
+    "<div>jack Retweeted</div>"
+    '<div data-testid="User-Name">'
+    '<div><a href="/jack"><span>Jack</span></a></div>'
+    '<div><a href="/jack"><span>@jack</span></a></div>'
+    '<div><a href="/jack/status/20"><time datetime="2024-03-01T12:30:00.000Z">Mar 1</time>'
+    "</a></div></div>"
+    '<div data-testid="tweetText" lang="en"><span>just setting up my twttr</span>'
+    ' <a href="https://t.co/abc">https://t.co/abc</a></div>'
+    '<div data-testid="tweetPhoto"><img alt="Image" src="https://pbs.twimg.com/media/A.jpg"></div>'
+    '<div data-testid="tweetPhoto"><img alt="Image" src="https://pbs.twimg.com/media/B.jpg"></div>'
+    '<div role="group">'
+    '<div data-testid="reply" aria-label="3 Replies. Reply"></div>'
+    '<div data-testid="retweet" aria-label="14 reposts. Repost"></div>'
+    '<div data-testid="like" aria-label="159 Likes. Like"></div>'
+    "</div></article>\n"
+)
+
+
+def test_tweet_fields():
+    rows = OfflineExtractor(BASE_URL).extract(PAGE_HEADER + TWEET_HTML + PAGE_FOOTER)
+    assert len(rows) == 1
+    row = rows[0]
+    assert row.tweet_id == 20
+    assert row.url == "https://twitter.com/jack/status/20"
+    assert row.text == "just setting up my twttr https://t.co/abc"
+    assert (row.author_name, row.author_handle, row.lang) == ("Jack", "@jack", "en")
+    assert row.created_at == datetime(2024, 3, 1, 12, 30, tzinfo=timezone.utc).timestamp()
+    assert row.mentioned_urls == ("https://t.co/abc",)
+    assert row.is_retweet
+    assert row.media_type == "Image"
+    assert list(row.images_urls) == [
+        "https://pbs.twimg.com/media/A.jpg",
+        "https://pbs.twimg.com/media/B.jpg",
+    ]
+    assert (row.num_reply, row.num_retweet, row.num_like) == (3, 14, 159)
+
+
+def test_fixture_rows(tmp_path):
+    filename = fixture_filename(tmp_path, 300)
+    write_fixture(filename, 300)
+    rows = OfflineExtractor(BASE_URL).extract(filename)
+
+    assert [row.tweet_id for row in rows] == [FIRST_TWEET_ID + i for i in range(300)]
+    created_at = [row.created_at for row in rows]
+    assert created_at == sorted(created_at, reverse=True)
+    for index, row in enumerate(rows):
+        handle = row.author_handle.lstrip("@")
+        assert row.url == f"{BASE_URL}{handle}/status/{row.tweet_id}"
+        assert row.author_name == handle.replace("_", " ").title()
+        assert row.text and row.lang in LANGS
+        assert all(url.startswith("https://t.co/") for url in row.mentioned_urls)
+        if row.media_type == "Image":
+            assert 1 <= len(row.images_urls) <= 4
+            assert all(f"/media/F{index}x" in url for url in row.images_urls)
+        else:
+            assert row.media_type in ("Video", "No media")
+            assert not row.images_urls
+        assert min(row.num_reply, row.num_retweet, row.num_like) >= 0
+    assert {row.media_type for row in rows} == {"Image", "Video", "No media"}
+    assert any(row.is_retweet for row in rows) and not all(row.is_retweet for row in rows)
+
+
+def test_date_range(tmp_path):
+    # About a day and a half of tweets, over two dates
+    filename = fixture_filename(tmp_path, 300)
+    write_fixture(filename, 300, newest=datetime(2024, 3, 2, 12))
+    extractor = OfflineExtractor(BASE_URL)
+    all_rows = extractor.extract(filename)
+    newer = extractor.extract(filename, start_date="2024-03-02")
+    older = extractor.extract(filename, start_date="2024-03-01", end_date="2024-03-01")
+
+    assert newer and older
+    assert newer + older == all_rows[: len(newer) + len(older)]
+    assert {row.day for row in newer} == {epoch_day("2024-03-02")}
+    assert {row.day for row in older} == {epoch_day("2024-03-01")}
+
+
+def test_served_fixture(tmp_path):
+    # The page the browser benchmark loads, with links resolved against the server
+    write_fixture(fixture_filename(tmp_path, 20), 20)
+    server, base_url = serve_fixtures(str(tmp_path))
+    try:
+        page = requests.get(f"{base_url}timeline_20.html", timeout=5).text
+    finally:
+        server.shutdown()
+    rows = OfflineExtractor(base_url).extract(page)
+    assert len(rows) == 20
+    assert all(row.url.startswith(f"{base_url}user_") for row in rows)
@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+# Keyword search over tweets: an inverted index of text, author and mentioned URLs with
+# BM25 scoring, stored in a folder as immutable segments (one per `add`, merged once there
+# are more than `max_segments`) listed by a JSON manifest. Posting lists are delta and
+# varint encoded. Words are NFKC-normalized and lowercased; Chinese/Japanese/Korean text
+# has no spaces, so it is indexed as character unigrams and bigrams.
+#
+#   python text_index.py update data/text_index data/sample_output_json.json
+#   python text_index.py search data/text_index "long context"
+from urllib.parse import urlparse
+import argparse
+import json
+import logging
+import os
+import re
+import threading
+import unicodedata
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from tweet_record import TweetRecord, loads
+from tweet_writer import infer_compression, read_records
+from vector_index import top_k_indices
+
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = "text_index.json"
+FORMAT_VERSION = 1
+# Hiragana, katakana, CJK ideographs and Hangul
+CJK_CHARACTERS = r"\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+TOKEN_PATTERN = re.compile(rf"[{CJK_CHARACTERS}]+|[^\W_{CJK_CHARACTERS}]+")
+CJK_PATTERN = re.compile(rf"[{CJK_CHARACTERS}]")
+# Reciprocal-rank fusion constant, 60 as in the original paper
+RRF_K = 60
+
+
+def tokenize(text, query=False):
+    # Lowercased words, and the unigrams and bigrams of CJK runs. A query only keeps the
+    # bigrams of runs longer than one character, which is enough to match them.
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(unicodedata.normalize("NFKC", text or "").lower()):
+        token = match.group()
+        if not CJK_PATTERN.match(token):
+            tokens.append(token)
+            continue
+        if len(token) == 1 or not query:
+            tokens.extend(token)
+        tokens.extend(token[i : i + 2] for i in range(len(token) - 1))
+    return tokens
+
+
+def document_tokens(row):
+    # row: a TweetRecord or a mapping with its fields
+    if isinstance(row, TweetRecord):
+        row = row._asdict()
+    tokens = tokenize(row.get("text"))
+    tokens += tokenize(row.get("author_name"))
+    tokens += tokenize((row.get("author_handle") or "").lstrip("@"))
+    mentioned_urls = row.get("mentioned_urls")
+    for url in mentioned_urls if mentioned_urls is not None else ():
+        parsed = urlparse(url)
+        tokens += tokenize(f"{parsed.netloc.removeprefix('www.')} {parsed.path}")
+    return tokens
+
+
+def encode_varints(values):
+    # LEB128: 7 bits per byte, low bits first, the high bit set on all but the last byte.
+    # Returns the bytes and the number of bytes of each value.
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        lengths += rest > 0
+        rest >>= np.uint64(7)
+    data = np.empty(int(lengths.sum()), dtype=np.uint8)
+    starts = np.cumsum(lengths) - lengths
+    for i in range(int(lengths.max(initial=0))):
+        selected = lengths > i
+        low_bits = (values[selected] >> np.uint64(7 * i)) & np.uint64(0x7F)
+        more = (lengths[selected] > i + 1).astype(np.uint64) << np.uint64(7)
+        data[starts[selected] + i] = low_bits | more
+    return data, lengths
+
+
+def decode_varints(data):
+    data = np.asarray(data, dtype=np.uint8)
+    if not len(data):
+        return np.empty(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    shifts = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    parts = (data & 0x7F).astype(np.uint64) << (7 * shifts).astype(np.uint64)
+    return np.bitwise_or.reduceat(parts, starts).astype(np.int64)
+
+
+def _segment_name():
+    return f"segment-{uuid.uuid4().hex[:8]}.npz"
+
+
+class Segment:
+    # Immutable part of the index. Doc IDs are positions in the segment; the postings of
+    # term i are doc_data[doc_offsets[i]:doc_offsets[i + 1]] (doc ID deltas) and the same
+    # range of tf_offsets in tf_data (term frequencies).
+    ARRAYS = (
+        "terms",
+        "term_offsets",
+        "doc_offsets",
+        "tf_offsets",
+        "doc_data",
+        "tf_data",
+        "tweet_ids",
+        "doc_lengths",
+    )
+
+    def __init__(self, name, arrays):
+        self.name = name
+        self.arrays = arrays
+        self.tweet_ids = arrays["tweet_ids"]
+        self.doc_lengths = arrays["doc_lengths"]
+        terms, term_offsets = arrays["terms"].tobytes(), arrays["term_offsets"]
+        self.terms = [
+            terms[start:end].decode("utf-8")
+            for start, end in zip(term_offsets[:-1], term_offsets[1:])
+        ]
+        self.term_ids = {term: i for i, term in enumerate(self.terms)}
+
+    @classmethod
+    def build(cls, name, tweet_ids, token_lists):
+        num_docs = len(token_lists)
+        doc_lengths = np.array([len(tokens) for tokens in token_lists], dtype=np.int64)
+        doc_ids = np.repeat(np.arange(num_docs), doc_lengths)
+        tokens = pd.Series([token for tokens in token_lists for token in tokens], dtype=object)
+        codes, terms = pd.factorize(tokens, sort=True)
+        # One (term, doc) key per posting, sorted by term then doc
+        keys, tfs = np.unique(codes.astype(np.int64) * num_docs + doc_ids, return_counts=True)
+        return cls._from_postings(
+            name, list(terms), keys // num_docs, keys % num_docs, tfs, tweet_ids, doc_lengths
+        )
+
+    @classmethod
+    def merge(cls, name, segments):
+        # Postings are decoded, renumbered after the documents of the previous segments
+        # and re-encoded under the union of the terms
+        terms = sorted(set().union(*(segment.terms for segment in segments)))
+        term_ids = {term: i for i, term in enumerate(terms)}
+        term_codes, docs, tfs = [], [], []
+        base = 0
+        for segment in segments:
+            segment_codes, segment_docs, segment_tfs = segment.postings()
+            codes = np.array([term_ids[term] for term in segment.terms], dtype=np.int64)
+            term_codes.append(codes[segment_codes])
+            docs.append(segment_docs + base)
+            tfs.append(segment_tfs)
+            base += len(segment)
+        term_codes, docs, tfs = (np.concatenate(parts) for parts in (term_codes, docs, tfs))
+        order = np.lexsort((docs, term_codes))
+        return cls._from_postings(
+            name,
+            terms,
+            term_codes[order],
+            docs[order],
+            tfs[order],
+            np.concatenate([segment.tweet_ids for segment in segments]),
+            np.concatenate([segment.doc_lengths for segment in segments]),
+        )
+
+    @classmethod
+    def _from_postings(cls, name, terms, term_codes, docs, tfs, tweet_ids, doc_lengths):
+        # term_codes/docs/tfs: one entry per posting, sorted by term then doc
+        term_starts = np.searchsorted(term_codes, np.arange(len(terms) + 1))
+        firsts = term_starts[:-1]
+        deltas = np.diff(docs, prepend=0)
+        deltas[firsts] = docs[firsts]
+        doc_data, doc_bytes = encode_varints(deltas)
+        tf_data, tf_bytes = encode_varints(tfs)
+        encoded_terms = [term.encode("utf-8") for term in terms]
+        arrays = {
+            "terms": np.frombuffer(b"".join(encoded_terms), dtype=np.uint8),
+            "term_offsets": np.cumsum([0] + [len(term) for term in encoded_terms]),
+            "doc_offsets": np.concatenate([[0], np.cumsum(doc_bytes)])[term_starts],
+            "tf_offsets": np.concatenate([[0], np.cumsum(tf_bytes)])[term_starts],
+            "doc_data": doc_data,
+            "tf_data": tf_data,
+            "tweet_ids": np.asarray(tweet_ids, dtype=np.int64),
+            "doc_lengths": np.asarray(doc_lengths, dtype=np.int32),
+        }
+        return cls(name, arrays)
+
+    @classmethod
+    def load(cls, folder_path, name):
+        with np.load(os.path.join(folder_path, name), allow_pickle=False) as data:
+            return cls(name, {key: data[key] for key in cls.ARRAYS})
+
+    def save(self, folder_path):
+        filename = os.path.join(folder_path, self.name)
+        with open(f"{filename}.tmp", "wb") as f:
+            np.savez(f, **self.arrays)
+        os.replace(f"{filename}.tmp", filename)
+
+    def term_postings(self, term):
+        # (doc ids, term frequencies) of a term, None when the segment does not have it
+        i = self.term_ids.get(term)
+        if i is None:
+            return None
+        doc_offsets, tf_offsets = self.arrays["doc_offsets"], self.arrays["tf_offsets"]
+        deltas = decode_varints(self.arrays["doc_data"][doc_offsets[i] : doc_offsets[i + 1]])
+        tfs = decode_varints(self.arrays["tf_data"][tf_offsets[i] : tf_offsets[i + 1]])
+        return np.cumsum(deltas), tfs
+
+    def postings(self):
+        # (term ids, doc ids, term frequencies) of every posting, sorted by term then doc
+        doc_data = self.arrays["doc_data"]
+        # Postings per term: the varints ending in its byte range
+        ends = np.concatenate([[0], np.cumsum(doc_data < 0x80)])
+        counts = np.diff(ends[self.arrays["doc_offsets"]])
+        deltas = decode_varints(doc_data)
+        starts = np.cumsum(counts) - counts
+        cumulative = np.cumsum(deltas)
+        docs = cumulative - np.repeat(cumulative[starts] - deltas[starts], counts)
+        term_codes = np.repeat(np.arange(len(self.terms)), counts)
+        return term_codes, docs, decode_varints(self.arrays["tf_data"])
+
+    def __len__(self):
+        return len(self.tweet_ids)
+
+
+class TextIndex:
+    # Tweets are identified by tweet ID and added once: adding a tweet that is already
+    # indexed does nothing. Searches can run while another thread adds.
+    def __init__(self, folder_path, max_segments=8, k1=1.2, b=0.75):
+        self.folder_path = folder_path
+        self.max_segments = max_segments
+        self.k1 = k1
+        self.b = b
+        self.manifest_filename = os.path.join(folder_path, MANIFEST_FILENAME)
+        # JSONL file -> bytes already indexed, see `update_from_file`
+        self.sources = {}
+        self.segments = []
+        self._lock = threading.Lock()
+        if os.path.exists(self.manifest_filename):
+            with open(self.manifest_filename, encoding="utf-8") as f:
+                manifest = json.load(f)
+            if manifest.get("version") == FORMAT_VERSION:
+                self.sources = manifest["sources"]
+                self.segments = [
+                    Segment.load(folder_path, name) for name in manifest["segments"]
+                ]
+            else:
+                logger.info(f"Rebuilding the text index in {folder_path} (old format).")
+        self._tweet_ids = self._all_tweet_ids(self.segments)
+
+    @staticmethod
+    def _all_tweet_ids(segments):
+        tweet_ids = [segment.tweet_ids for segment in segments]
+        return pd.Index(np.concatenate([np.empty(0, dtype=np.int64)] + tweet_ids))
+
+    def add(self, rows):
+        # rows: TweetRecords or mappings with their fields. Returns how many were added.
+        with self._lock:
+            tweet_ids, token_lists, seen = [], [], set()
+            for row in rows:
+                if isinstance(row, TweetRecord):
+                    tweet_id = row.tweet_id
+                else:
+                    tweet_id = row.get("tweet_id")
+                if tweet_id is None or pd.isna(tweet_id):
+                    continue
+                tweet_id = int(tweet_id)
+                if tweet_id in seen or tweet_id in self._tweet_ids:
+                    continue
+                seen.add(tweet_id)
+                tweet_ids.append(tweet_id)
+                token_lists.append(document_tokens(row))
+            if tweet_ids:
+                segment = Segment.build(_segment_name(), tweet_ids, token_lists)
+                self._commit(self.segments + [segment], [segment])
+            return len(tweet_ids)
+
+    def add_df(self, df):
+        # Only the rows of tweets that are not indexed yet are converted
+        tweet_ids = df["tweet_id"].astype("Int64").fillna(-1).to_numpy(dtype=np.int64)
+        new = ~pd.Index(tweet_ids).isin(self._tweet_ids) & (tweet_ids >= 0)
+        if not new.any():
+            return 0
+        return self.add(df[new].to_dict("records"))
+
+    def update_from_file(self, filename):
+        # Indexes the tweets appended to a JSONL crawl output since the last update. A
+        # compressed file is read again from the start (indexed tweets are skipped).
+        key = os.path.abspath(filename)
+        if infer_compression(filename) is not None:
+            return self.add(read_records(filename))
+        offset = self.sources.get(key, 0)
+        if os.path.getsize(filename) < offset:
+            # Replaced or truncated
+            offset = 0
+        with open(filename, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        # A last line without a newline may still be being written
+        data = data[: data.rfind(b"\n") + 1]
+        added = self.add(
+            TweetRecord.from_row(loads(line)) for line in data.splitlines() if line.strip()
+        )
+        with self._lock:
+            self.sources[key] = offset + len(data)
+            self._save_manifest()
+        return added
+
+    def _commit(self, segments, new_segments):
+        # Writes the new segments, merges them all when there are too many, then switches
+        # the manifest (readers keep the old list until then)
+        os.makedirs(self.folder_path, exist_ok=True)
+        if len(segments) > self.max_segments:
+            merged = Segment.merge(_segment_name(), segments)
+            old_segments, segments, new_segments = segments, [merged], [merged]
+        else:
+            old_segments = []
+        for segment in new_segments:
+            segment.save(self.folder_path)
+        self.segments = segments
+        self._tweet_ids = self._all_tweet_ids(segments)
+        self._save_manifest()
+        for segment in old_segments:
+            try:
+                os.remove(os.path.join(self.folder_path, segment.name))
+            except FileNotFoundError:
+                pass
+
+    def _save_manifest(self):
+        os.makedirs(self.folder_path, exist_ok=True)
+        manifest = {
+            "version": FORMAT_VERSION,
+            "segments": [segment.name for segment in self.segments],
+            "sources": self.sources,
+        }
+        with open(f"{self.manifest_filename}.tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(f"{self.manifest_filename}.tmp", self.manifest_filename)
+
+    def search(self, query, top_k=10, require_all=False):
+        # (tweet IDs, BM25 scores), best first. With require_all, only tweets that contain
+        # every term of the query.
+        terms = list(dict.fromkeys(tokenize(query, query=True)))
+        segments = self.segments
+        num_docs = sum(len(segment) for segment in segments)
+        if not terms or not num_docs:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        average_length = sum(int(s.doc_lengths.sum()) for s in segments) / num_docs
+        postings = [[segment.term_postings(term) for term in terms] for segment in segments]
+        dfs = [
+            sum(len(found[i][0]) for found in postings if found[i] is not None)
+            for i in range(len(terms))
+        ]
+        idfs = [np.log(1 + (num_docs - df + 0.5) / (df + 0.5)) for df in dfs]
+
+        tweet_ids, scores = [], []
+        for segment, segment_postings in zip(segments, postings):
+            found = [(p, idf) for p, idf in zip(segment_postings, idfs) if p is not None]
+            if not found or (require_all and len(found) < len(terms)):
+                continue
+            docs = np.concatenate([doc_ids for (doc_ids, _), _ in found])
+            lengths = segment.doc_lengths[docs]
+            tfs = np.concatenate([tfs for (_, tfs), _ in found]).astype(np.float32)
+            weights = np.concatenate([np.full(len(docs), idf) for (docs, _), idf in found])
+            norms = self.k1 * (1 - self.b + self.b * lengths / average_length)
+            posting_scores = weights * tfs * (self.k1 + 1) / (tfs + norms)
+            # Sum per document
+            docs, inverse, counts = np.unique(docs, return_inverse=True, return_counts=True)
+            doc_scores = np.bincount(inverse, weights=posting_scores).astype(np.float32)
+            if require_all:
+                docs, doc_scores = docs[counts == len(terms)], doc_scores[counts == len(terms)]
+            positions, top_scores = top_k_indices(doc_scores, top_k)
+            tweet_ids.append(segment.tweet_ids[docs[positions]])
+            scores.append(top_scores)
+        if not tweet_ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        positions, top_scores = top_k_indices(np.concatenate(scores), top_k)
+        return np.concatenate(tweet_ids)[positions], top_scores
+
+    def __contains__(self, tweet_id):
+        return tweet_id in self._tweet_ids
+
+    def __len__(self):
+        return len(self._tweet_ids)
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    # rankings: lists of keys, best first. Returns [(key, score)], best first, where a key
+    # scores the sum of 1 / (k + rank) over the rankings it appears in.
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def _update(args):
+    index = TextIndex(args.index, args.max_segments)
+    for filename in args.files:
+        if os.path.isdir(filename):
+            from tweet_store import TweetStore
+
+            columns = ["tweet_id", "text", "author_name", "author_handle", "mentioned_urls"]
+            added = index.add_df(TweetStore(filename).read(columns=columns))
+        else:
+            added = index.update_from_file(filename)
+        logger.info(f"Indexed {added} new tweets from {filename}.")
+    logger.info(f"{len(index)} tweets in {len(index.segments)} segments.")
+
+
+def _search(args):
+    index = TextIndex(args.index)
+    tweet_ids, scores = index.search(args.query, args.top_k, args.all)
+    for tweet_id, score in zip(tweet_ids, scores):
+        print(json.dumps({"tweet_id": int(tweet_id), "score": round(float(score), 4)}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keyword search over tweets.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    update_parser = subparsers.add_parser(
+        "update", help="Index the new tweets of JSONL files or Parquet tweet stores."
+    )
+    update_parser.add_argument("index", help="Folder of the text index.")
+    update_parser.add_argument("files", nargs="+")
+    update_parser.add_argument("--max-segments", type=int, default=8)
+    search_parser = subparsers.add_parser("search", help="Print the best matching tweets.")
+    search_parser.add_argument("index", help="Folder of the text index.")
+    search_parser.add_argument("query")
+    search_parser.add_argument("--top-k", type=int, default=10)
+    search_parser.add_argument(
+        "--all", action="store_true", help="Only tweets with every term of the query."
+    )
+    args = parser.parse_args()
+    if args.command == "update":
+        _update(args)
+    else:
+        _search(args)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    main()
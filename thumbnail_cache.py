@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# Fixed-size thumbnails of tweet images for the webapp, generated once and stored by
+# content hash as `{cache_dir}/{sha256[:2]}/{sha256}_{width}x{height}.{ext}`. Images that
+# are already in the download folder are read from disk; the others are fetched
+# concurrently with a timeout, and the hash of every fetched URL is kept so it is only
+# fetched once.
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import hashlib
+import io
+import logging
+import os
+import threading
+
+import requests
+from PIL import Image, features
+
+from image_downloader import image_tasks, sha256_file
+from tweet_record import dumps, loads
+
+
+logger = logging.getLogger(__name__)
+
+IMAGE_FORMAT_EXTENSIONS = {"webp": "webp", "jpeg": "jpg"}
+
+
+def thumbnail_data_uri(thumbnail_path):
+    # The thumbnail inlined as a data: URI, for clients that cannot read the cache folder
+    # (e.g. the webapp of a search service running on another machine)
+    mime_type = "image/webp" if thumbnail_path.endswith(".webp") else "image/jpeg"
+    with open(thumbnail_path, "rb") as f:
+        return f"data:{mime_type};base64,{base64.b64encode(f.read()).decode('ascii')}"
+
+
+class ThumbnailCache:
+    # image_format: "webp", or "jpeg" (also used when Pillow was built without WebP)
+    def __init__(
+        self,
+        image_dir="downloaded_images",
+        cache_dir=None,
+        size=(800, 800),
+        image_format="webp",
+        quality=80,
+        num_workers=8,
+        timeout=(3, 10),
+    ):
+        if image_format not in IMAGE_FORMAT_EXTENSIONS:
+            raise ValueError(f"Unknown thumbnail format: {image_format}")
+        if image_format == "webp" and not features.check("webp"):
+            image_format = "jpeg"
+        self.image_dir = image_dir
+        self.cache_dir = cache_dir or os.path.join(image_dir, ".thumbnails")
+        self.size = tuple(size)
+        self.image_format = image_format
+        self.quality = quality
+        self.timeout = timeout
+        # URL -> sha256 of the fetched image, append-only JSONL
+        self._url_filename = os.path.join(self.cache_dir, "urls.jsonl")
+        self._url_digests = {}
+        if os.path.exists(self._url_filename):
+            with open(self._url_filename, "rb") as f:
+                for line in f:
+                    if line.strip():
+                        entry = loads(line)
+                        self._url_digests[entry["url"]] = entry["sha256"]
+        # (path, size, mtime_ns) -> sha256 of the downloaded images
+        self._file_digests = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(num_workers)
+
+    def thumbnail_path(self, digest):
+        width, height = self.size
+        extension = IMAGE_FORMAT_EXTENSIONS[self.image_format]
+        filename = f"{digest}_{width}x{height}.{extension}"
+        return os.path.join(self.cache_dir, digest[:2], filename)
+
+    def tweet_thumbnails(self, tweet_url, images_urls):
+        # Thumbnail paths of the images of a tweet, None for images that cannot be loaded
+        return self.many([(tweet_url, images_urls)])[0]
+
+    def many(self, tweets):
+        # tweets: (tweet url, images urls) pairs, all of their images are loaded
+        # concurrently. Returns the thumbnail paths of each tweet.
+        futures = [
+            [
+                self._executor.submit(self.thumbnail, task)
+                for task in image_tasks([tweet], self.image_dir)
+            ]
+            for tweet in tweets
+        ]
+        return [[future.result() for future in tweet_futures] for tweet_futures in futures]
+
+    def thumbnail(self, task):
+        # task: an image_downloader.DownloadTask
+        try:
+            if os.path.exists(task.path):
+                return self._local_thumbnail(task.path)
+            return self._remote_thumbnail(task.url)
+        except Exception as e:
+            logger.warning(f"Error loading image {task.image_id} from {task.url}: {e}")
+            return None
+
+    def _local_thumbnail(self, path):
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        digest = self._file_digests.get(key)
+        if digest is None:
+            digest = sha256_file(path)
+            self._file_digests[key] = digest
+        thumbnail_path = self.thumbnail_path(digest)
+        if not os.path.exists(thumbnail_path):
+            with Image.open(path) as image:
+                self._write_thumbnail(image, thumbnail_path)
+        return thumbnail_path
+
+    def _remote_thumbnail(self, url):
+        digest = self._url_digests.get(url)
+        if digest is not None and os.path.exists(self.thumbnail_path(digest)):
+            return self.thumbnail_path(digest)
+        response = self._session().get(url, timeout=self.timeout)
+        response.raise_for_status()
+        digest = hashlib.sha256(response.content).hexdigest()
+        thumbnail_path = self.thumbnail_path(digest)
+        if not os.path.exists(thumbnail_path):
+            with Image.open(io.BytesIO(response.content)) as image:
+                self._write_thumbnail(image, thumbnail_path)
+        with self._lock:
+            self._url_digests[url] = digest
+            with open(self._url_filename, "ab") as f:
+                f.write(dumps({"url": url, "sha256": digest}) + b"\n")
+        return thumbnail_path
+
+    def _write_thumbnail(self, image, thumbnail_path):
+        os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+        # JPEGs are decoded directly at a reduced scale when that still covers the size
+        image.draft("RGB", self.size)
+        image = image.convert("RGB")
+        image.thumbnail(self.size)
+        # Another thread can be writing the same thumbnail
+        tmp_path = f"{thumbnail_path}.{threading.get_ident()}.tmp"
+        image.save(tmp_path, format=self.image_format.upper(), quality=self.quality)
+        os.replace(tmp_path, thumbnail_path)
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+        return session
+
+    def close(self):
+        self._executor.shutdown()
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Finds the tweet of a search hit without scanning the tweet table: TweetLookup maps tweet
+# IDs to row positions, built once when the table is loaded, and the embedding index
+# stores the tweet ID of every image (EmbeddingMatrix.tweet_ids).
+import numpy as np
+import pandas as pd
+
+
+class TweetLookup:
+    # Hash lookup of int64 tweet IDs; a duplicated tweet ID maps to its first row, and
+    # negative IDs (no tweet ID) are left out
+    def __init__(self, tweet_ids):
+        tweet_ids = pd.Index(np.asarray(tweet_ids, dtype=np.int64))
+        kept = ~tweet_ids.duplicated() & (tweet_ids >= 0)
+        self._index = tweet_ids[kept]
+        self._positions = np.flatnonzero(kept)
+
+    @classmethod
+    def from_df(cls, df):
+        # A nullable column (e.g. Int64) has its missing IDs replaced with -1
+        return cls(df["tweet_id"].astype("Int64").fillna(-1).to_numpy(dtype=np.int64))
+
+    def rows(self, tweet_ids):
+        # Row positions of the tweet IDs, -1 for IDs that are not in the table
+        found = self._index.get_indexer(np.asarray(tweet_ids, dtype=np.int64))
+        return np.where(found >= 0, self._positions[found], -1)
+
+    def row(self, tweet_id):
+        position = self.rows([tweet_id])[0]
+        return None if position < 0 else int(position)
+
+    def __contains__(self, tweet_id):
+        return self.row(tweet_id) is not None
+
+    def __len__(self):
+        return len(self._index)
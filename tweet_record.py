@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# The tweet record passed from extraction to the writers, and its JSONL encoding.
+from collections import namedtuple
+from datetime import date, datetime, timezone
+import json
+import logging
+import sys
+import time
+
+import pandas as pd
+
+from seen_index import tweet_id_from_url
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib json module is used instead
+    orjson = None
+
+
+logger = logging.getLogger(__name__)
+if orjson is not None:
+    logger.debug("Encoding JSONL with orjson.")
+else:
+    logger.debug("Encoding JSONL with the stdlib json module (orjson is not installed).")
+
+FIELDS = (
+    "tweet_id",
+    "url",
+    "text",
+    "author_name",
+    "author_handle",
+    "created_at",
+    "lang",
+    "mentioned_urls",
+    "is_retweet",
+    "media_type",
+    "images_urls",
+    "num_reply",
+    "num_retweet",
+    "num_like",
+    "num_view",
+)
+SECONDS_PER_DAY = 86_400
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def _intern(value):
+    return sys.intern(value) if value else value
+
+
+class TweetRecord(namedtuple("TweetRecord", FIELDS)):
+    # Immutable and without a per-instance __dict__. tweet_id is the integer ID from the
+    # URL, created_at is in epoch seconds (UTC), and the few distinct values of
+    # author_handle, lang and media_type are interned.
+    __slots__ = ()
+
+    def __new__(
+        cls,
+        tweet_id,
+        url,
+        text="",
+        author_name="",
+        author_handle="",
+        created_at=None,
+        lang=None,
+        mentioned_urls=(),
+        is_retweet=False,
+        media_type="No media",
+        images_urls=None,
+        num_reply=0,
+        num_retweet=0,
+        num_like=0,
+        num_view=0,
+    ):
+        return super().__new__(
+            cls,
+            tweet_id,
+            url,
+            text,
+            author_name,
+            _intern(author_handle),
+            created_at,
+            _intern(lang),
+            tuple(mentioned_urls or ()),
+            bool(is_retweet),
+            _intern(media_type),
+            tuple(images_urls) if images_urls is not None else None,
+            num_reply or 0,
+            num_retweet or 0,
+            num_like or 0,
+            num_view or 0,
+        )
+
+    @property
+    def day(self):
+        # Days since the epoch (UTC), None without a timestamp
+        if self.created_at is None:
+            return None
+        return self.created_at // SECONDS_PER_DAY
+
+    @property
+    def date(self):
+        if self.created_at is None:
+            return ""
+        return time.strftime("%Y-%m-%d", time.gmtime(self.created_at))
+
+    @classmethod
+    def from_row(cls, row):
+        # Also reads rows written before records existed: no tweet_id, and created_at as
+        # an ISO string (GraphQL mode) or only a `date`
+        created_at = row.get("created_at")
+        if isinstance(created_at, str):
+            created_at = epoch_from_iso(created_at)
+        if created_at is None and row.get("date"):
+            created_at = epoch_from_iso(row["date"])
+        return cls(
+            tweet_id=row.get("tweet_id") or tweet_id_from_url(row.get("url")),
+            url=row.get("url", ""),
+            text=row.get("text", ""),
+            author_name=row.get("author_name", ""),
+            author_handle=row.get("author_handle", ""),
+            created_at=created_at,
+            lang=row.get("lang"),
+            mentioned_urls=row.get("mentioned_urls"),
+            is_retweet=row.get("is_retweet"),
+            media_type=row.get("media_type", "No media"),
+            images_urls=row.get("images_urls"),
+            num_reply=row.get("num_reply"),
+            num_retweet=row.get("num_retweet"),
+            num_like=row.get("num_like"),
+            num_view=row.get("num_view"),
+        )
+
+    def to_row(self):
+        # The JSONL schema: every field, plus `date` (YYYY-MM-DD) for readability
+        row = dict(zip(FIELDS, self))
+        row["date"] = self.date
+        return row
+
+
+def epoch_from_iso(value):
+    # e.g. "2024-03-01T17:33:51.000Z" from a <time datetime> or "2024-03-01"; naive
+    # values are UTC
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        # Legacy day-first dates
+        parsed = datetime.strptime(value, "%d/%m/%Y")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+
+def epoch_day(date_string):
+    # "YYYY-MM-DD" to days since the epoch, comparable with `TweetRecord.day`
+    return date.fromisoformat(date_string).toordinal() - _EPOCH_ORDINAL
+
+
+def dumps(row):
+    if orjson is not None:
+        return orjson.dumps(row)
+    return json.dumps(row, ensure_ascii=False).encode("utf-8")
+
+
+def loads(line):
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+
+def encode(record):
+    # One JSONL line (bytes) for a TweetRecord, or a plain dict row
+    if isinstance(record, TweetRecord):
+        record = record.to_row()
+    return dumps(record) + b"\n"
+
+
+def decode(line):
+    return TweetRecord.from_row(loads(line))
+
+
+def records_to_df(records, columns=None):
+    # `created_at` becomes a UTC timestamp and `date` the (naive) day, as in
+    # TweetStore.read
+    df = pd.DataFrame(list(records), columns=FIELDS)
+    for column in ("mentioned_urls", "images_urls"):
+        df[column] = [list(value) if value is not None else None for value in df[column]]
+    df["created_at"] = pd.to_datetime(df["created_at"], unit="s", utc=True)
+    df["date"] = df["created_at"].dt.tz_localize(None).dt.normalize()
+    if columns is not None:
+        df = df[list(columns)]
+    return df
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+# Date-partitioned Parquet dataset of tweets: the canonical store crawls append to, and
+# that the webapp/notebook read only the columns and date ranges they need from.
+from datetime import date, datetime, timezone
+import logging
+import os
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from tweet_record import TweetRecord
+from tweet_writer import read_records
+
+
+logger = logging.getLogger(__name__)
+
+# Excel stops at 1,048,576 rows (including the header)
+EXCEL_MAX_ROWS = 1_048_575
+
+TWEET_SCHEMA = pa.schema(
+    [
+        ("tweet_id", pa.int64()),
+        ("url", pa.string()),
+        ("text", pa.string()),
+        ("author_name", pa.string()),
+        ("author_handle", pa.string()),
+        ("created_at", pa.timestamp("ms", tz="UTC")),
+        ("lang", pa.string()),
+        ("mentioned_urls", pa.list_(pa.string())),
+        ("is_retweet", pa.bool_()),
+        ("media_type", pa.dictionary(pa.int8(), pa.string())),
+        ("images_urls", pa.list_(pa.string())),
+        ("num_reply", pa.int64()),
+        ("num_retweet", pa.int64()),
+        ("num_like", pa.int64()),
+        ("num_view", pa.int64()),
+        ("date", pa.date32()),
+    ]
+)
+PARTITIONING = ds.partitioning(pa.schema([("date", pa.date32())]), flavor="hive")
+
+
+def _to_record(row):
+    # row: a TweetRecord, or a dict row (see `TweetRecord.from_row`)
+    if not isinstance(row, TweetRecord):
+        row = TweetRecord.from_row(row)
+    created_at = None
+    if row.created_at is not None:
+        created_at = datetime.fromtimestamp(row.created_at, timezone.utc)
+    return {
+        "tweet_id": row.tweet_id,
+        "url": row.url,
+        "text": row.text,
+        "author_name": row.author_name,
+        "author_handle": row.author_handle,
+        "created_at": created_at,
+        "lang": row.lang,
+        "mentioned_urls": list(row.mentioned_urls),
+        "is_retweet": row.is_retweet,
+        "media_type": row.media_type,
+        "images_urls": list(row.images_urls) if row.images_urls is not None else None,
+        "num_reply": row.num_reply,
+        "num_retweet": row.num_retweet,
+        "num_like": row.num_like,
+        "num_view": row.num_view,
+        "date": created_at.date() if created_at else None,
+    }
+
+
+def _to_date(value):
+    if value is None or isinstance(value, date):
+        return value
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+class TweetStore:
+    def __init__(self, root="data/tweets_parquet"):
+        self.root = root
+
+    def _dataset(self):
+        return ds.dataset(
+            self.root, schema=TWEET_SCHEMA, format="parquet", partitioning=PARTITIONING
+        )
+
+    def _tweet_ids(self, dates):
+        # IDs of the stored tweets in the date partitions of `dates` (None: undated tweets)
+        if not os.path.isdir(self.root) or not dates:
+            return set()
+        expression = ds.field("date").isin([day for day in dates if day is not None])
+        if None in dates:
+            expression = expression | ds.field("date").is_null()
+        table = self._dataset().to_table(columns=["tweet_id"], filter=expression)
+        return set(table.column("tweet_id").to_pylist())
+
+    def append(self, rows):
+        # Tweets already in the store, or earlier in `rows`, are skipped: re-crawling a
+        # date range or tweets extracted twice after a reload do not add rows. Only the
+        # tweet IDs of the date partitions the rows fall in are read. Each call writes one
+        # new file per date partition it touches.
+        records = {}
+        for row in rows:
+            record = _to_record(row)
+            # Tweets without an ID (an URL that is not a status URL) are kept by URL
+            records.setdefault(record["tweet_id"] or record["url"], record)
+        existing = self._tweet_ids({record["date"] for record in records.values()})
+        table = pa.Table.from_pylist(
+            [record for tweet_id, record in records.items() if tweet_id not in existing],
+            schema=TWEET_SCHEMA,
+        )
+        if not table.num_rows:
+            return 0
+        ds.write_dataset(
+            table,
+            self.root,
+            format="parquet",
+            partitioning=PARTITIONING,
+            basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+        )
+        return table.num_rows
+
+    def append_jsonl(self, json_filename, batch_size=100_000):
+        num_rows, batch = 0, []
+        for row in read_records(json_filename):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                num_rows += self.append(batch)
+                batch = []
+        num_rows += self.append(batch)
+        logger.info(f"Appended {num_rows} new tweets from {json_filename} to {self.root}.")
+        return num_rows
+
+    def compact(self, min_files=2):
+        # Merges the small per-crawl files of each partition into one, keeping the last
+        # (most recently crawled) copy of every tweet
+        if not os.path.isdir(self.root):
+            return
+        for partition in sorted(os.listdir(self.root)):
+            partition_dir = os.path.join(self.root, partition)
+            files = sorted(
+                (
+                    os.path.join(partition_dir, name)
+                    for name in os.listdir(partition_dir)
+                    if name.endswith(".parquet")
+                ),
+                key=os.path.getmtime,
+            )
+            if len(files) < min_files:
+                continue
+            table = pa.concat_tables([pq.read_table(file) for file in files])
+            df = table.to_pandas().drop_duplicates(subset=["tweet_id"], keep="last")
+            compacted = pa.Table.from_pandas(
+                df, schema=table.schema, preserve_index=False
+            )
+            tmp_file = os.path.join(partition_dir, f".compact-{uuid.uuid4().hex}.tmp")
+            pq.write_table(compacted, tmp_file)
+            os.replace(
+                tmp_file,
+                os.path.join(partition_dir, f"part-{uuid.uuid4().hex}-0.parquet"),
+            )
+            for file in files:
+                os.remove(file)
+            logger.info(f"Compacted {len(files)} files in {partition} into {len(df)} tweets.")
+
+    def read(self, columns=None, start_date=None, end_date=None, filter=None):
+        # Only the requested columns and date partitions are read from disk
+        if not os.path.isdir(self.root):
+            return pd.DataFrame(columns=columns or TWEET_SCHEMA.names)
+        expression = filter
+        for bound in (
+            ds.field("date") >= _to_date(start_date) if start_date else None,
+            ds.field("date") <= _to_date(end_date) if end_date else None,
+        ):
+            if bound is not None:
+                expression = bound if expression is None else expression & bound
+        df = self._dataset().to_table(columns=columns, filter=expression).to_pandas()
+        if "date" in df:
+            df["date"] = pd.to_datetime(df["date"])
+        return df
+
+    def export_excel(self, output_filename, max_rows=EXCEL_MAX_ROWS, **read_kwargs):
+        df = self.read(**read_kwargs)
+        return export_excel(df, output_filename, max_rows)
+
+
+def export_excel(df, output_filename, max_rows=EXCEL_MAX_ROWS):
+    if len(df) > max_rows:
+        logger.warning(
+            f"{len(df)} tweets do not fit in one Excel sheet, exporting the first {max_rows}."
+        )
+        df = df.head(max_rows)
+    df = df.copy()
+    # Excel cannot store timezone-aware datetimes
+    for column in df.select_dtypes(include=["datetimetz"]).columns:
+        df[column] = df[column].dt.tz_localize(None)
+    df.to_excel(output_filename, index=False)
+    return len(df)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# Buffered JSONL output for crawls, optionally gzip/zstd compressed.
+import gzip
+import io
+import logging
+import os
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for .zst output
+    zstandard = None
+
+from tweet_record import TweetRecord, encode, loads
+
+
+logger = logging.getLogger(__name__)
+
+COMPRESSION_SUFFIXES = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+
+def infer_compression(filename):
+    if filename.endswith(".gz"):
+        return "gzip"
+    if filename.endswith(".zst"):
+        return "zstd"
+    return None
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise ImportError("zstd compression requires `pip install zstandard`.")
+
+
+def open_jsonl(filename, mode="rt", compression="infer"):
+    # Text-mode handle on a (possibly compressed) JSONL file, mode is "rt" or "at"
+    if compression == "infer":
+        compression = infer_compression(filename)
+    if compression == "gzip":
+        return gzip.open(filename, mode, encoding="utf-8")
+    if compression == "zstd":
+        _require_zstandard()
+        if mode == "rt":
+            # Every append starts a new zstd frame, so read across frames
+            reader = zstandard.ZstdDecompressor().stream_reader(
+                open(filename, "rb"), read_across_frames=True, closefd=True
+            )
+            return io.TextIOWrapper(reader, encoding="utf-8")
+        return zstandard.open(filename, mode, encoding="utf-8")
+    if compression is None:
+        return open(filename, mode[0], encoding="utf-8")
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+def read_jsonl(filename):
+    with open_jsonl(filename) as file:
+        try:
+            for line in file:
+                if line.strip():
+                    yield loads(line)
+        except EOFError:
+            # The compressed stream of a crashed (or still running) writer has no end
+            # marker, but every flushed record before it is readable
+            logger.warning(f"{filename} is truncated, read up to the last flush.")
+
+
+def read_records(filename):
+    for row in read_jsonl(filename):
+        yield TweetRecord.from_row(row)
+
+
+class TweetWriter:
+    # Buffers records and flushes them every `flush_every` records or `flush_interval`
+    # seconds (checked on write), so a crash loses at most one flush window.
+    # Durability: by default a flush only hands the data to the OS; with `fsync_every`
+    # the file is also fsync'ed once at least that many records were flushed since the
+    # last fsync.
+    def __init__(
+        self,
+        filename,
+        flush_every=100,
+        flush_interval=5.0,
+        fsync_every=None,
+        compression="infer",
+        on_flush=None,
+    ):
+        # on_flush is called after every flush, e.g. to commit a SeenIndex
+        self.filename = filename
+        self.on_flush = on_flush
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.fsync_every = fsync_every
+        self.compression = (
+            infer_compression(filename) if compression == "infer" else compression
+        )
+        self.num_written = 0
+        self._buffer = []
+        self._unsynced = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._raw_file, self._file = self._open()
+
+    def _open(self):
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        raw_file = open(self.filename, "ab")
+        if self.compression == "gzip":
+            stream = gzip.GzipFile(fileobj=raw_file, mode="ab")
+        elif self.compression == "zstd":
+            _require_zstandard()
+            stream = zstandard.ZstdCompressor().stream_writer(raw_file, closefd=False)
+        elif self.compression is None:
+            stream = raw_file
+        else:
+            raise ValueError(f"Unknown compression: {self.compression}")
+        return raw_file, stream
+
+    def write(self, row):
+        # row: a TweetRecord or a plain dict
+        line = encode(row)
+        with self._lock:
+            self._buffer.append(line)
+            self.num_written += 1
+            if (
+                len(self._buffer) >= self.flush_every
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            ):
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        self._file.write(b"".join(self._buffer))
+        self._unsynced += len(self._buffer)
+        self._buffer = []
+
+        # Compressed streams are flushed to a decodable block boundary
+        if self.compression == "gzip":
+            self._file.flush()
+        elif self.compression == "zstd":
+            self._file.flush(zstandard.FLUSH_BLOCK)
+        self._raw_file.flush()
+        if self.fsync_every and self._unsynced >= self.fsync_every:
+            os.fsync(self._raw_file.fileno())
+            self._unsynced = 0
+        if self.on_flush:
+            self.on_flush()
+
+    def close(self):
+        with self._lock:
+            if self._raw_file.closed:
+                return
+            self._flush()
+            if self._file is not self._raw_file:
+                self._file.close()
+            self._raw_file.flush()
+            if self.fsync_every and self._unsynced:
+                os.fsync(self._raw_file.fileno())
+            self._raw_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
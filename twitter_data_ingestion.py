@@ -2,16 +2,27 @@
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.options import Options
-from selenium.common.exceptions import NoSuchElementException, TimeoutException
+from selenium.common.exceptions import (
+    NoSuchElementException,
+    TimeoutException,
+    WebDriverException,
+)
 from selenium.webdriver.support.ui import WebDriverWait
 from datetime import datetime, timedelta
+import base64
 import re
 import json
 import time
-import pandas as pd
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
+from tenacity import retry, stop_after_attempt, wait_fixed
 import logging
 from config import TWITTER_AUTH_TOKEN
+from ingest_metrics import NullMetrics
+from seen_index import tweet_id_from_url
+from twitter_graphql import is_timeline_url, parse_timeline_response
+from crawl_checkpoint import CrawlCheckpoints, IncrementalCrawl, PROCESS, SKIP, STOP
+from tweet_record import TweetRecord, epoch_day, epoch_from_iso, records_to_df
+from tweet_store import EXCEL_MAX_ROWS, TweetStore, export_excel
+from tweet_writer import COMPRESSION_SUFFIXES, TweetWriter, read_records
 
 
 logging.basicConfig(
@@ -19,19 +30,228 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Resolves as soon as a tweet article (or the 'Try reloading' error) is in the page, using a
+# MutationObserver instead of polling, and scrolls down so the timeline loads more.
+WAIT_FOR_TWEETS_JS = r"""
+const timeoutMs = arguments[0];
+const done = arguments[arguments.length - 1];
+const start = performance.now();
+const check = () => {
+    if (document.querySelector("article[data-testid='tweet']")) {
+        return "tweet";
+    }
+    const error = document.evaluate(
+        "//span[contains(text(),'Try reloading')]", document, null,
+        XPathResult.FIRST_ORDERED_NODE_TYPE, null
+    ).singleNodeValue;
+    return error ? "error" : null;
+};
+const status = check();
+if (status) {
+    done({status: status, latency_ms: 0});
+} else {
+    let finished = false;
+    let timer = null;
+    const observer = new MutationObserver(() => {
+        const status = check();
+        if (status) {
+            finish(status);
+        }
+    });
+    const finish = (status) => {
+        if (finished) {
+            return;
+        }
+        finished = true;
+        observer.disconnect();
+        clearTimeout(timer);
+        done({status: status, latency_ms: performance.now() - start});
+    };
+    observer.observe(document.body, {childList: true, subtree: true});
+    timer = setTimeout(() => finish("timeout"), timeoutMs);
+    window.scrollTo(0, document.body.scrollHeight);
+}
+"""
+
+# Lean profile: only the `src` of tweet images is scraped, never their bytes. The timeline
+# XHR/GraphQL calls (x.com/i/api, twitter.com/i/api) are not matched by these patterns.
+LEAN_BLOCKED_URL_PATTERNS = [
+    "*://pbs.twimg.com/*",
+    "*://video.twimg.com/*",
+    "*://abs.twimg.com/emoji/*",
+    "*://abs.twimg.com/sticky/*",
+    "*.jpg*",
+    "*.jpeg*",
+    "*.png*",
+    "*.gif*",
+    "*.webp*",
+    "*.mp4*",
+    "*.m4s*",
+    "*.m3u8*",
+    "*.woff*",
+    "*.ttf*",
+]
+# Rough average transfer size of a blocked request, per DevTools resource type. Blocked
+# requests never download, so the savings can only be estimated.
+ESTIMATED_BLOCKED_BYTES = {"Image": 60_000, "Media": 500_000, "Font": 40_000}
+
+# Serializes every rendered tweet into the same schema as `_process_tweet` and removes
+# the processed nodes, all in a single round trip to chromedriver.
+EXTRACT_VISIBLE_TWEETS_JS = r"""
+const tweets = Array.from(document.querySelectorAll("article[data-testid='tweet']"));
+const firstNumber = (tweet, testid) => {
+    const el = tweet.querySelector(`div[data-testid='${testid}']`);
+    const match = el && (el.getAttribute("aria-label") || "").match(/\b\d+\b/);
+    return match ? parseInt(match[0], 10) : 0;
+};
+const rows = tweets.map((tweet) => {
+    const textEl = tweet.querySelector("div[data-testid='tweetText']");
+    const userEl = tweet.querySelector("div[data-testid='User-Name']");
+    const timeEl = tweet.querySelector("time");
+    const statusEl = tweet.querySelector("a[href*='/status/']");
+    const authorParts = userEl ? userEl.innerText.split("\n") : [""];
+    let mediaType = "No media";
+    if (tweet.querySelector("div[data-testid='videoPlayer']")) {
+        mediaType = "Video";
+    } else if (tweet.querySelector("div[data-testid='tweetPhoto']")) {
+        mediaType = "Image";
+    }
+    const isRetweet = Array.from(tweet.querySelectorAll("div")).some((div) =>
+        Array.from(div.childNodes).some(
+            (node) => node.nodeType === Node.TEXT_NODE && node.textContent.includes("Retweeted")
+        )
+    );
+    return {
+        text: textEl ? textEl.innerText : "",
+        author_name: authorParts[0],
+        author_handle: authorParts.length >= 2 ? authorParts[1] : "",
+        created_at: timeEl ? timeEl.getAttribute("datetime") : "",
+        lang: textEl ? textEl.getAttribute("lang") : "",
+        url: statusEl ? statusEl.href : "",
+        mentioned_urls: Array.from(tweet.querySelectorAll("a[href*='http']")).map((a) => a.href),
+        is_retweet: isRetweet,
+        media_type: mediaType,
+        images_urls: mediaType === "Image"
+            ? Array.from(tweet.querySelectorAll("div[data-testid='tweetPhoto'] img")).map((img) => img.src)
+            : null,
+        num_reply: firstNumber(tweet, "reply"),
+        num_retweet: firstNumber(tweet, "retweet"),
+        num_like: firstNumber(tweet, "like"),
+    };
+});
+tweets.forEach((tweet) => tweet.remove());
+return rows;
+"""
+
+
+# True when the timeline has nothing more to load: scrolled to the bottom, with no loading
+# spinner. Returns the page height too, so growth across stalls can be told apart.
+TIMELINE_END_JS = r"""
+const height = document.body.scrollHeight;
+const atBottom = window.innerHeight + window.scrollY >= height - 2;
+return {height: height, at_end: atBottom && !document.querySelector("[role='progressbar']")};
+"""
+
+
+class EndOfTimeline(TimeoutException):
+    # No more tweets will load: the crawl reached the oldest tweet of the timeline
+    pass
+
 
 class TwitterExtractor:
-    def __init__(self, headless=True):
+    def __init__(
+        self,
+        headless=True,
+        capture_network=False,
+        lean=False,
+        auth_token=TWITTER_AUTH_TOKEN,
+        writer_options=None,
+        seen_index=None,
+        tweet_store=None,
+        metrics=None,
+        log_sample_every=100,
+    ):
+        # capture_network turns on DevTools network logging, required by mode="graphql".
+        # lean blocks image/media/font downloads and autoplay (and also logs the network
+        # to count what was blocked).
+        self.capture_network = capture_network
+        self.lean = lean
+        # TweetWriter settings for the output files, e.g. {"compression": "gzip"}
+        self.writer_options = writer_options or {}
+        # Optional SeenIndex: known tweets are skipped before they are processed
+        self.seen_index = seen_index
+        # Parquet dataset that crawl outputs are appended to (see `fetch_tweets(export=...)`)
+        self.tweet_store = tweet_store if tweet_store is not None else TweetStore()
+        # Optional IngestMetrics (see ingest_metrics.py), shared e.g. by crawl pool workers.
+        # Saved tweets are logged at debug level, one in every `log_sample_every`.
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        self.log_sample_every = log_sample_every
+        self._num_saved = 0
+        self._pending_timeline_requests = {}
+        self.network_stats = {
+            "blocked_requests": 0,
+            "estimated_bytes_saved": 0,
+            "bytes_received": 0,
+        }
+        # Number of 'Try reloading' errors seen, and an optional callback (e.g. a crawl
+        # pool's backoff) invoked before the workaround is attempted
+        self.reload_errors = 0
+        self.on_reload_error = None
+        # Waits for new tweets adapt to the measured render latency (seconds)
+        self.min_wait_timeout = 1
+        self.max_wait_timeout = 10
+        self.max_stalls = 5
+        self.max_stall_backoff = 8
+        self._render_latency = 1.0
         self.driver = self._start_chrome(headless)
-        self.set_token()
+        try:
+            self.driver.set_script_timeout(self.max_wait_timeout + 5)
+            self.set_token(auth_token)
+        except BaseException:
+            # Nobody else holds the driver yet, so the browser would outlive the error
+            self.driver.quit()
+            raise
 
     def _start_chrome(self, headless):
         options = Options()
         options.headless = headless
+        if self.capture_network or self.lean:
+            options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+            options.add_experimental_option(
+                "perfLoggingPrefs", {"enableNetwork": True, "enablePage": False}
+            )
+        if self.lean:
+            self._add_lean_options(options)
         driver = webdriver.Chrome(options=options)
-        driver.get("https://twitter.com")
+        try:
+            if self.lean:
+                driver.execute_cdp_cmd("Network.enable", {})
+                driver.execute_cdp_cmd(
+                    "Network.setBlockedURLs", {"urls": LEAN_BLOCKED_URL_PATTERNS}
+                )
+            driver.get("https://twitter.com")
+        except BaseException:
+            driver.quit()
+            raise
         return driver
 
+    @staticmethod
+    def _add_lean_options(options):
+        options.add_argument("--blink-settings=imagesEnabled=false")
+        options.add_argument("--autoplay-policy=user-gesture-required")
+        options.add_argument("--mute-audio")
+        options.add_argument("--disable-gpu")
+        options.add_argument("--disable-gpu-compositing")
+        options.add_argument("--disable-smooth-scrolling")
+        options.add_argument("--disable-remote-fonts")
+        options.add_experimental_option(
+            "prefs",
+            {
+                "profile.managed_default_content_settings.images": 2,
+                "profile.default_content_setting_values.sound": 2,
+            },
+        )
+
     def set_token(self, auth_token=TWITTER_AUTH_TOKEN):
         if not auth_token or auth_token == "YOUR_TWITTER_AUTH_TOKEN_HERE":
             raise ValueError("Access token is missing. Please configure it properly.")
@@ -39,157 +259,486 @@ class TwitterExtractor:
         cookie_script = f"document.cookie = 'auth_token={auth_token}; expires={expiration}; path=/';"
         self.driver.execute_script(cookie_script)
 
-    def fetch_tweets(self, page_url, start_date, end_date):
+    def fetch_tweets(
+        self,
+        page_url,
+        start_date,
+        end_date,
+        mode="dom",
+        writer=None,
+        incremental=False,
+        checkpoints=None,
+        export="parquet",
+        finish_metrics=True,
+    ):
+        # mode="dom" processes one tweet element at a time, mode="batch" serializes every
+        # rendered tweet with a single execute_script call per scroll batch, and
+        # mode="graphql" parses the timeline API responses captured from the network.
+        # By default rows go to a new data/tweets_*.json file (see `writer_options`), which
+        # is appended to the Parquet tweet store at the end (export="parquet"), or
+        # exported to Excel (export="excel"), or left as is (export=None). A `writer`
+        # (any object with write(row) and flush()) receives the rows instead, and nothing
+        # is exported.
+        # With incremental=True, the crawl stops at tweets ingested by the last completed
+        # run of `page_url`, and resumes an interrupted run (see crawl_checkpoint.py).
+        # finish_metrics=False leaves the metrics summary to the caller, e.g. a crawl pool
+        # whose workers share one IngestMetrics.
+        if mode == "graphql":
+            if not self.capture_network:
+                raise ValueError(
+                    'mode="graphql" requires TwitterExtractor(capture_network=True).'
+                )
+            # Drop whatever was logged before navigating
+            self._read_network_events()
+            self._pending_timeline_requests.clear()
         self.driver.get(page_url)
-        cur_filename = f"data/tweets_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
+        compression = self.writer_options.get("compression")
+        json_filename = (
+            f"data/tweets_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json"
+            f"{COMPRESSION_SUFFIXES[compression]}"
+        )
+
+        # Days since the epoch, compared with `TweetRecord.day`
+        start_day = epoch_day(start_date)
+        end_day = epoch_day(end_date)
+
+        tracker = None
+        check_url = None
+        if incremental:
+            tracker = IncrementalCrawl(checkpoints or CrawlCheckpoints(), page_url)
+            check_url = tracker.check
+            if writer is None and tracker.output_filename:
+                # Keep appending to the output of the interrupted run
+                json_filename = tracker.output_filename
+            tracker.output_filename = json_filename
+
+        if self.seen_index is not None:
+            check_url = self._skip_seen(check_url)
+
+        owns_writer = writer is None
+        if owns_writer:
+            writer = TweetWriter(json_filename, **self.writer_options)
+
+        def sink(row):
+            # An external writer does its own dedup (e.g. the crawl pool's shared store)
+            if owns_writer and self.seen_index is not None:
+                if not self.seen_index.add(row.tweet_id):
+                    self.metrics.inc("duplicate")
+                    return
+            with self.metrics.time("write"):
+                writer.write(row)
+            if tracker:
+                tracker.record(row)
+            self.metrics.tweet_done()
+            self._log_saved(row)
+
+        if owns_writer and self.seen_index is not None:
+            # IDs are committed only once the records they cover are written out
+            writer.on_flush = self.seen_index.commit
+        if tracker:
+            # Checkpoints must never get ahead of what was written out
+            tracker.on_save = writer.flush
+
+        if mode == "batch":
+            fetch = self._fetch_tweets_batch
+        elif mode == "graphql":
+            fetch = self._fetch_tweets_graphql
+        elif mode == "dom":
+            fetch = self._fetch_tweets_dom
+        else:
+            raise ValueError(f"Unknown extraction mode: {mode}")
+
+        stalled = False
+        try:
+            fetch(sink, start_day, end_day, check_url=check_url)
+        except EndOfTimeline as e:
+            logger.info(f"{e} The crawl is complete.")
+        except TimeoutException as e:
+            # X stopped serving the timeline midway: the pending range is crawled again
+            stalled = True
+            logger.warning(f"{e} Stopping, the run can be resumed.")
+        except BaseException:
+            if tracker:
+                tracker.interrupt()
+            raise
+        finally:
+            if owns_writer:
+                writer.close()
+            else:
+                writer.flush()
+            summary = self.metrics.finish() if finish_metrics else None
+            if summary:
+                logger.info(
+                    f"Saved {summary['tweets']} tweets in {summary['elapsed_seconds']:.0f}s "
+                    f"({summary['rolling_tweets_per_second']:.1f} tweets/s recently)."
+                )
+        if tracker:
+            # After a stall, keep the run resumable rather than moving the high-water mark
+            if stalled:
+                tracker.interrupt()
+            else:
+                tracker.complete()
 
-        # Convert start_date and end_date from "YYYY-MM-DD" to datetime objects
-        start_date = datetime.strptime(start_date, "%Y-%m-%d")
-        end_date = datetime.strptime(end_date, "%Y-%m-%d")
+        if self.lean:
+            self._read_network_events()
+            logger.info(
+                f"Network: {self.network_stats['bytes_received'] / 1e6:.1f} MB received, "
+                f"{self.network_stats['blocked_requests']} requests blocked "
+                f"(~{self.network_stats['estimated_bytes_saved'] / 1e6:.1f} MB saved)."
+            )
+
+        if owns_writer and export == "parquet":
+            self.tweet_store.append_jsonl(json_filename)
+        elif owns_writer and export == "excel":
+            self._save_to_excel(
+                json_filename=json_filename,
+                output_filename=json_filename.split(".json")[0] + ".xlsx",
+                drop_duplicates=self.seen_index is None,
+            )
+
+    def _log_saved(self, row):
+        # Formatting a line per tweet is not free, so only sample them
+        self._num_saved += 1
+        if self._num_saved % self.log_sample_every == 0 and logger.isEnabledFor(
+            logging.DEBUG
+        ):
+            logger.debug(
+                f"Saved {self._num_saved} tweets, latest: {row.date},  "
+                f"{row.author_name} -- {row.text[:50]}..."
+            )
+
+    def save_snapshot(self, filename):
+        # Saves the rendered timeline, e.g. as a fixture for offline_extraction.py
+        with open(filename, "w", encoding="utf-8") as file:
+            file.write(self.driver.page_source)
 
+    def _skip_seen(self, check_url=None):
+        def check(url):
+            action = check_url(url) if check_url else PROCESS
+            if action == PROCESS and self.seen_index.seen_url(url):
+                return SKIP
+            return action
+
+        return check
+
+    def _fetch_tweets_dom(
+        self, sink, start_day, end_day, check_url=None, network_drain_interval=50
+    ):
+        num_processed = 0
         while True:
+            num_processed += 1
+            if self.lean and num_processed % network_drain_interval == 0:
+                self._read_network_events()
+
             tweet = self._get_first_tweet()
             if not tweet:
                 continue
 
-            row = self._process_tweet(tweet)
-            if row["date"]:
-                try:
-                    date = datetime.strptime(row["date"], "%Y-%m-%d")
-
-                except ValueError as e:
-                    # infer date format
-                    logger.info(
-                        f"Value error on date format, trying another format.{row['date']}",
-                        e,
-                    )
-                    date = datetime.strptime(row["date"], "%d/%m/%Y")
+            if check_url:
+                action = check_url(self._get_tweet_url(tweet))
+                if action == STOP:
+                    break
+                elif action == SKIP:
+                    self._delete_first_tweet()
+                    continue
 
-                if date < start_date:
+            with self.metrics.time("process_tweet"):
+                row = self._process_tweet(tweet)
+            if row.day is not None:
+                if row.day < start_day:
                     break
-                elif date > end_date:
+                elif row.day > end_day:
                     self._delete_first_tweet()
                     continue
 
-            self._save_to_json(row, filename=f"{cur_filename}.json")
-            logger.info(
-                f"Saving tweets...\n{row['date']},  {row['author_name']} -- {row['text'][:50]}...\n\n"
-            )
+            sink(row)
             self._delete_first_tweet()
 
-        # Save to Excel
-        self._save_to_excel(
-            json_filename=f"{cur_filename}.json", output_filename=f"{cur_filename}.xlsx"
+    def _fetch_tweets_batch(self, sink, start_day, end_day, check_url=None):
+        while True:
+            if self.lean:
+                # Keeps the browser-side log buffer small and the byte counters current
+                self._read_network_events()
+            with self.metrics.time("extract_batch"):
+                rows = self._extract_visible_tweets()
+            if not rows:
+                # Wait for the next batch to render (also handles the 'Try reloading' error)
+                self._get_first_tweet()
+                continue
+
+            for row in rows:
+                if check_url:
+                    action = check_url(row.url)
+                    if action == STOP:
+                        return
+                    elif action == SKIP:
+                        continue
+
+                if row.day is not None:
+                    if row.day < start_day:
+                        return
+                    elif row.day > end_day:
+                        continue
+
+                sink(row)
+
+    def _fetch_tweets_graphql(self, sink, start_day, end_day, check_url=None):
+        while True:
+            self._scroll_timeline()
+            # Rendered tweets mean the next timeline response has arrived
+            self._get_first_tweet()
+
+            with self.metrics.time("collect_timeline"):
+                rows = self._collect_timeline_rows()
+            for row in rows:
+                if check_url:
+                    action = check_url(row.url)
+                    if action == STOP:
+                        return
+                    elif action == SKIP:
+                        continue
+
+                if row.day is not None:
+                    if row.day < start_day:
+                        return
+                    elif row.day > end_day:
+                        continue
+
+                sink(row)
+
+    def _scroll_timeline(self):
+        # Rendered tweets are not needed in this mode, dropping them keeps the page light
+        self.driver.execute_script(
+            "document.querySelectorAll(\"article[data-testid='tweet']\").forEach((t) => t.remove());"
+            "window.scrollTo(0, document.body.scrollHeight);"
         )
 
-    @retry(
-        stop=stop_after_attempt(5),
-        wait=wait_fixed(2),
-        retry=retry_if_exception_type(TimeoutException),
-    )
-    def _get_first_tweet(
-        self, timeout=10, use_hacky_workaround_for_reloading_issue=True
-    ):
+    def _read_network_events(self):
+        if not (self.capture_network or self.lean):
+            return []
+        events = []
+        for entry in self.driver.get_log("performance"):
+            message = json.loads(entry["message"])["message"]
+            if message.get("method", "").startswith("Network."):
+                self._update_network_stats(message)
+                events.append(message)
+        return events
+
+    def _update_network_stats(self, event):
+        params = event.get("params", {})
+        if event["method"] == "Network.loadingFinished":
+            self.network_stats["bytes_received"] += int(
+                params.get("encodedDataLength", 0)
+            )
+        elif event["method"] == "Network.loadingFailed" and params.get("blockedReason"):
+            self.network_stats["blocked_requests"] += 1
+            self.network_stats["estimated_bytes_saved"] += ESTIMATED_BLOCKED_BYTES.get(
+                params.get("type"), 0
+            )
+
+    def _collect_timeline_rows(self):
+        rows = []
+        for event in self._read_network_events():
+            params = event.get("params", {})
+            request_id = params.get("requestId")
+            if event["method"] == "Network.responseReceived":
+                if is_timeline_url(params["response"]["url"]):
+                    self._pending_timeline_requests[request_id] = params["response"]["url"]
+            elif event["method"] == "Network.loadingFinished":
+                if request_id in self._pending_timeline_requests:
+                    rows.extend(self._parse_timeline_body(request_id))
+            elif event["method"] == "Network.loadingFailed":
+                self._pending_timeline_requests.pop(request_id, None)
+        return rows
+
+    def _parse_timeline_body(self, request_id):
+        url = self._pending_timeline_requests.pop(request_id)
         try:
-            # Wait for either a tweet or the error message to appear
-            WebDriverWait(self.driver, timeout).until(
-                lambda d: d.find_elements(By.XPATH, "//article[@data-testid='tweet']")
-                or d.find_elements(By.XPATH, "//span[contains(text(),'Try reloading')]")
+            response = self.driver.execute_cdp_cmd(
+                "Network.getResponseBody", {"requestId": request_id}
             )
+        except WebDriverException as e:
+            logger.error(f"Could not read timeline response {url}: {e}")
+            return []
+        body = response["body"]
+        if response.get("base64Encoded"):
+            body = base64.b64decode(body)
+        try:
+            return [TweetRecord.from_row(row) for row in parse_timeline_response(body)]
+        except ValueError as e:
+            logger.error(f"Could not parse timeline response {url}: {e}")
+            return []
 
-            # Check for error message and try to click "Retry" if it's present
-            error_message = self.driver.find_elements(
-                By.XPATH, "//span[contains(text(),'Try reloading')]"
+    def _extract_visible_tweets(self):
+        rows = self.driver.execute_script(EXTRACT_VISIBLE_TWEETS_JS) or []
+        return [TweetRecord.from_row(row) for row in rows]
+
+    def _get_first_tweet(self, use_hacky_workaround_for_reloading_issue=True):
+        with self.metrics.time("wait_for_tweet"):
+            status = self._wait_for_tweets_with_backoff()
+        if status == "error":
+            self.reload_errors += 1
+            self.metrics.inc("reload_error")
+            if self.on_reload_error:
+                self.on_reload_error(self.reload_errors)
+
+            if not use_hacky_workaround_for_reloading_issue:
+                raise TimeoutException("Error message present. Not using hacky workaround.")
+            logger.info(
+                "Encountered 'Something went wrong. Try reloading.' error.\nTrying to resolve with a hacky workaround (click on another tab and switch back). Note that this is not optimal.\n"
             )
-            if error_message and use_hacky_workaround_for_reloading_issue:
-                logger.info(
-                    "Encountered 'Something went wrong. Try reloading.' error.\nTrying to resolve with a hacky workaround (click on another tab and switch back). Note that this is not optimal.\n"
-                )
-                logger.info(
-                    "You do not have to worry about data duplication though. The save to excel part does the dedup."
-                )
+            logger.info(
+                "Tweets already in the seen index (or the crawl pool's shared store) are skipped before they are written. Without a seen index the JSON output can repeat tweets, which the Parquet export skips by tweet ID and the Excel export drops by URL."
+            )
+            with self.metrics.time("navigate_tabs"):
                 self._navigate_tabs()
+            return None
 
-                WebDriverWait(self.driver, timeout).until(
-                    lambda d: d.find_elements(
-                        By.XPATH, "//article[@data-testid='tweet']"
-                    )
-                )
-            elif error_message and not use_hacky_workaround_for_reloading_issue:
-                raise TimeoutException(
-                    "Error message present. Not using hacky workaround."
-                )
-
-            else:
-                # If no error message, assume tweet is present
-                return self.driver.find_element(
-                    By.XPATH, "//article[@data-testid='tweet']"
+        try:
+            return self.driver.find_element(By.XPATH, "//article[@data-testid='tweet']")
+        except NoSuchElementException:
+            # Removed by a re-render between the wait and the lookup
+            return None
+
+    def _wait_for_tweets_with_backoff(self):
+        # Returns "tweet" or "error". Each consecutive timeout is a stall: back off
+        # (bounded, exponential) and nudge the timeline, then give up once `max_stalls` is
+        # exceeded: with EndOfTimeline when the page sits at its bottom, unchanged since
+        # the first stall and not loading, otherwise with a TimeoutException.
+        first_height = None
+        for stall in range(self.max_stalls + 1):
+            status = self._wait_for_tweets()
+            if status != "timeout":
+                return status
+            self.metrics.inc("stall")
+            if first_height is None:
+                first_height = self.driver.execute_script(TIMELINE_END_JS)["height"]
+            if stall < self.max_stalls:
+                backoff = min(self.max_stall_backoff, 0.5 * 2**stall)
+                logger.info(
+                    f"No new tweets after {self._wait_timeout():.1f}s, backing off {backoff:.1f}s "
+                    f"(stall {stall + 1}/{self.max_stalls})."
                 )
+                time.sleep(backoff)
+        end = self.driver.execute_script(TIMELINE_END_JS)
+        if end["at_end"] and end["height"] == first_height:
+            raise EndOfTimeline(f"No more tweets after {self.max_stalls} retries.")
+        raise TimeoutException(f"Timeline stalled after {self.max_stalls} retries.")
+
+    def _wait_timeout(self):
+        # A few times the typical render latency, so waits track how fast the page loads
+        return min(
+            self.max_wait_timeout,
+            max(self.min_wait_timeout, 4 * self._render_latency),
+        )
 
-        except TimeoutException:
-            logger.error("Timeout waiting for tweet or after clicking 'Retry'")
-            raise
-        except NoSuchElementException:
-            logger.error("Could not find tweet or 'Retry' button")
-            raise
+    def _wait_for_tweets(self):
+        result = self.driver.execute_async_script(
+            WAIT_FOR_TWEETS_JS, int(self._wait_timeout() * 1000)
+        )
+        if result["status"] != "timeout" and result["latency_ms"] > 0:
+            # Exponential moving average of the measured render latency
+            self._render_latency = (
+                0.8 * self._render_latency + 0.2 * result["latency_ms"] / 1000
+            )
+        return result["status"]
 
     def _navigate_tabs(self, target_tab="Likes"):
         # Deal with the 'Retry' issue. Not optimal.
         try:
-            # Click on the 'Media' tab
+            # Click on the 'Media' tab and wait until it is selected
             self.driver.find_element(By.XPATH, "//span[text()='Media']").click()
-            time.sleep(2)  # Wait for the Media tab to load
+            self._wait_for_selected_tab("Media")
 
             # Click back on the Target tab. If you are fetching posts, you can click on 'Posts' tab
             self.driver.find_element(By.XPATH, f"//span[text()='{target_tab}']").click()
-            time.sleep(2)  # Wait for the Likes tab to reload
+            self._wait_for_selected_tab(target_tab)
         except NoSuchElementException as e:
             logger.error("Error navigating tabs: " + str(e))
+        except TimeoutException as e:
+            logger.error("Timeout navigating tabs: " + str(e))
+
+    def _wait_for_selected_tab(self, tab):
+        WebDriverWait(self.driver, self.max_wait_timeout, poll_frequency=0.1).until(
+            lambda d: d.find_elements(
+                By.XPATH,
+                f"//a[@role='tab'][@aria-selected='true'][.//span[text()='{tab}']]",
+            )
+        )
 
-    @retry(stop=stop_after_attempt(2), wait=wait_fixed(1))
+    @retry(
+        stop=stop_after_attempt(2),
+        wait=wait_fixed(1),
+        before_sleep=lambda retry_state: retry_state.args[0].metrics.inc(
+            "process_tweet_retry"
+        ),
+    )
     def _process_tweet(self, tweet):
-
-        author_name, author_handle = self._extract_author_details(tweet)
+        timed = self._timed
+        author_name, author_handle = timed(
+            "extract_author", self._extract_author_details, tweet
+        )
         try:
-            data = {
-                "text": self._get_element_text(
-                    tweet, ".//div[@data-testid='tweetText']"
+            media_type = timed("extract_media_type", self._get_media_type, tweet)
+            url = timed("extract_url", self._get_tweet_url, tweet)
+            record = TweetRecord(
+                tweet_id=tweet_id_from_url(url),
+                url=url,
+                text=timed(
+                    "extract_text",
+                    self._get_element_text,
+                    tweet,
+                    ".//div[@data-testid='tweetText']",
+                ),
+                author_name=author_name,
+                author_handle=author_handle,
+                # The full <time datetime>, e.g. 2024-03-01T17:33:51.000Z
+                created_at=epoch_from_iso(
+                    timed(
+                        "extract_date",
+                        self._get_element_attribute,
+                        tweet,
+                        "time",
+                        "datetime",
+                    )
+                ),
+                lang=timed(
+                    "extract_lang",
+                    self._get_element_attribute,
+                    tweet,
+                    "div[data-testid='tweetText']",
+                    "lang",
                 ),
-                "author_name": author_name,
-                "author_handle": author_handle,
-                "date": self._get_element_attribute(tweet, "time", "datetime")[:10],
-                "lang": self._get_element_attribute(
-                    tweet, "div[data-testid='tweetText']", "lang"
+                mentioned_urls=timed(
+                    "extract_mentioned_urls", self._get_mentioned_urls, tweet
                 ),
-                "url": self._get_tweet_url(tweet),
-                "mentioned_urls": self._get_mentioned_urls(tweet),
-                "is_retweet": self.is_retweet(tweet),
-                "media_type": self._get_media_type(tweet),
-                "images_urls": (
-                    self._get_images_urls(tweet)
-                    if self._get_media_type(tweet) == "Image"
+                is_retweet=timed("extract_is_retweet", self.is_retweet, tweet),
+                media_type=media_type,
+                images_urls=(
+                    timed("extract_images_urls", self._get_images_urls, tweet)
+                    if media_type == "Image"
                     else None
                 ),
-            }
+                # Extract numbers from aria-labels
+                num_reply=timed(
+                    "extract_counts", self._extract_number_from_aria_label, tweet, "reply"
+                ),
+                num_retweet=timed(
+                    "extract_counts", self._extract_number_from_aria_label, tweet, "retweet"
+                ),
+                num_like=timed(
+                    "extract_counts", self._extract_number_from_aria_label, tweet, "like"
+                ),
+            )
         except Exception as e:
             logger.error(f"Error processing tweet: {e}")
             logger.info(f"Tweet: {tweet}")
             raise
-        # Convert date format
-        if data["date"]:
-            data["date"] = datetime.strptime(data["date"], "%Y-%m-%d").strftime(
-                "%Y-%m-%d"
-            )
+        return record
 
-        # Extract numbers from aria-labels
-        data.update(
-            {
-                "num_reply": self._extract_number_from_aria_label(tweet, "reply"),
-                "num_retweet": self._extract_number_from_aria_label(tweet, "retweet"),
-                "num_like": self._extract_number_from_aria_label(tweet, "like"),
-            }
-        )
-        return data
+    def _timed(self, stage, function, *args):
+        with self.metrics.time(stage):
+            return function(*args)
 
     def _get_element_text(self, parent, selector):
         try:
@@ -278,7 +827,11 @@ class TwitterExtractor:
         except NoSuchElementException:
             return 0
 
-    def _delete_first_tweet(self, sleep_time_range_ms=(0, 1000)):
+    def _delete_first_tweet(self):
+        with self.metrics.time("delete_tweet"):
+            self._delete_tweet_element()
+
+    def _delete_tweet_element(self):
         try:
             tweet = self.driver.find_element(
                 By.XPATH, "//article[@data-testid='tweet'][1]"
@@ -288,19 +841,19 @@ class TwitterExtractor:
             logger.info("Could not find the first tweet to delete.")
 
     @staticmethod
-    def _save_to_json(data, filename="data.json"):
-        with open(filename, "a", encoding="utf-8") as file:
-            json.dump(data, file)
-            file.write("\n")
-
-    @staticmethod
-    def _save_to_excel(json_filename, output_filename="data/data.xlsx"):
+    def _save_to_excel(
+        json_filename,
+        output_filename="data/data.xlsx",
+        drop_duplicates=True,
+        max_rows=EXCEL_MAX_ROWS,
+    ):
         # Read JSON data
-        cur_df = pd.read_json(json_filename, lines=True)
+        cur_df = records_to_df(read_records(json_filename))
 
-        # Drop duplicates & save to Excel
-        cur_df.drop_duplicates(subset=["url"], inplace=True)
-        cur_df.to_excel(output_filename, index=False)
+        # Drop duplicates (not needed when a SeenIndex deduplicated at ingest time) & save to Excel
+        if drop_duplicates:
+            cur_df.drop_duplicates(subset=["url"], inplace=True)
+        export_excel(cur_df, output_filename, max_rows)
         logger.info(
             f"\n\nDone saving to {output_filename}. Total of {len(cur_df)} unique tweets."
         )
@@ -314,5 +867,8 @@ if __name__ == "__main__":
         end_date="2024-03-02",
     )  # YYYY-MM-DD format
 
+    # To read the tweet store back, e.g. only some columns of March 2024:
+    # TweetStore().read(columns=["url", "text", "num_like"], start_date="2024-03-01", end_date="2024-03-31")
+
     # If you just want to export to Excel, you can use the following line
     # scraper._save_to_excel(json_filename="tweets_2024-02-01_14-30-00.json", output_filename="tweets_2024-02-01_14-30-00.xlsx")
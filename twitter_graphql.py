@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+# Parsing of X/Twitter timeline GraphQL responses (Likes, UserTweets, ...) into the same
+# record schema that `TwitterExtractor._process_tweet` produces.
+from datetime import datetime, timezone
+import html
+import json
+import re
+import sys
+
+
+TIMELINE_OPERATIONS = (
+    "Likes",
+    "UserTweets",
+    "UserTweetsAndReplies",
+    "UserMedia",
+    "HomeTimeline",
+    "HomeLatestTimeline",
+    "SearchTimeline",
+    "Bookmarks",
+    "ListLatestTweetsTimeline",
+)
+TIMELINE_URL_PATTERN = re.compile(
+    r"/graphql/[^/]+/(" + "|".join(TIMELINE_OPERATIONS) + r")(\?|$)"
+)
+
+
+def is_timeline_url(url):
+    return bool(TIMELINE_URL_PATTERN.search(url))
+
+
+def parse_timeline_response(payload):
+    if isinstance(payload, (str, bytes)):
+        payload = json.loads(payload)
+
+    rows = []
+    for instruction in _find_instructions(payload):
+        entries = instruction.get("entries") or []
+        if instruction.get("entry"):
+            entries = [instruction["entry"]]
+        for entry in entries:
+            for tweet_result in _entry_tweet_results(entry.get("content", {})):
+                row = parse_tweet_result(tweet_result)
+                if row:
+                    rows.append(row)
+    return rows
+
+
+def parse_tweet_result(result):
+    tweet = _unwrap_tweet(result)
+    if not tweet:
+        return None
+
+    legacy = tweet.get("legacy", {})
+    retweeted = _unwrap_tweet(legacy.get("retweeted_status_result", {}).get("result"))
+    if retweeted:
+        # Like the rendered timeline, a retweet shows the original tweet
+        row = parse_tweet_result(retweeted)
+        if row:
+            row["is_retweet"] = True
+        return row
+
+    author_name, screen_name = _author_details(tweet)
+    created_at = _parse_created_at(legacy.get("created_at"))
+    media = legacy.get("extended_entities", {}).get("media") or legacy.get(
+        "entities", {}
+    ).get("media", [])
+    media_type = _media_type(media)
+
+    return {
+        "text": _tweet_text(tweet, legacy),
+        "author_name": author_name,
+        "author_handle": f"@{screen_name}" if screen_name else "",
+        "date": created_at.strftime("%Y-%m-%d") if created_at else "",
+        "created_at": created_at.isoformat() if created_at else "",
+        "lang": legacy.get("lang", ""),
+        "url": f"https://twitter.com/{screen_name}/status/{tweet.get('rest_id', legacy.get('id_str', ''))}",
+        "mentioned_urls": [
+            url.get("expanded_url") or url.get("url")
+            for url in legacy.get("entities", {}).get("urls", [])
+        ],
+        "is_retweet": False,
+        "media_type": media_type,
+        "images_urls": (
+            [item["media_url_https"] for item in media if item.get("type") == "photo"]
+            if media_type == "Image"
+            else None
+        ),
+        "num_reply": legacy.get("reply_count", 0),
+        "num_retweet": legacy.get("retweet_count", 0),
+        "num_like": legacy.get("favorite_count", 0),
+        "num_view": _to_int(tweet.get("views", {}).get("count")),
+    }
+
+
+def _find_instructions(node):
+    # The timeline lives at different paths per operation (data.user.result.timeline_v2...,
+    # data.search_by_raw_query..., data.home...), so look for the instructions list itself.
+    if isinstance(node, dict):
+        if isinstance(node.get("instructions"), list):
+            yield from node["instructions"]
+            return
+        for value in node.values():
+            yield from _find_instructions(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from _find_instructions(value)
+
+
+def _entry_tweet_results(content):
+    item_contents = []
+    if content.get("itemContent"):
+        item_contents.append(content["itemContent"])
+    # Conversation modules (e.g. self-threads in UserTweets)
+    for item in content.get("items", []):
+        item_content = item.get("item", {}).get("itemContent")
+        if item_content:
+            item_contents.append(item_content)
+
+    for item_content in item_contents:
+        if item_content.get("itemType") != "TimelineTweet":
+            continue
+        # Skip promoted tweets, the DOM path does not see them as timeline items either
+        if item_content.get("promotedMetadata"):
+            continue
+        result = item_content.get("tweet_results", {}).get("result")
+        if result:
+            yield result
+
+
+def _unwrap_tweet(result):
+    if not result:
+        return None
+    typename = result.get("__typename")
+    if typename == "TweetWithVisibilityResults":
+        return result.get("tweet")
+    if typename in ("Tweet", None) and "legacy" in result:
+        return result
+    # TweetTombstone, TweetUnavailable, ...
+    return None
+
+
+def _author_details(tweet):
+    user = tweet.get("core", {}).get("user_results", {}).get("result", {})
+    # Newer payloads moved name/screen_name from `legacy` to `core`
+    core = user.get("core") or {}
+    legacy = user.get("legacy") or {}
+    name = core.get("name") or legacy.get("name", "")
+    screen_name = core.get("screen_name") or legacy.get("screen_name", "")
+    return name, screen_name
+
+
+def _tweet_text(tweet, legacy):
+    note = (
+        tweet.get("note_tweet", {})
+        .get("note_tweet_results", {})
+        .get("result", {})
+        .get("text")
+    )
+    if note:
+        return html.unescape(note)
+
+    text = legacy.get("full_text", "")
+    display_range = legacy.get("display_text_range")
+    if display_range:
+        # Drops the leading @replies and trailing t.co media link, as rendered on the page
+        text = text[display_range[0] : display_range[1]]
+    for url in legacy.get("entities", {}).get("urls", []):
+        if url.get("url") and url.get("expanded_url"):
+            text = text.replace(url["url"], url["expanded_url"])
+    return html.unescape(text)
+
+
+def _media_type(media):
+    types = {item.get("type") for item in media}
+    if types & {"video", "animated_gif"}:
+        return "Video"
+    if "photo" in types:
+        return "Image"
+    return "No media"
+
+
+def _parse_created_at(created_at):
+    if not created_at:
+        return None
+    # e.g. "Fri Mar 01 17:33:51 +0000 2024"
+    return datetime.strptime(created_at, "%a %b %d %H:%M:%S %z %Y").astimezone(
+        timezone.utc
+    )
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+if __name__ == "__main__":
+    # Offline check against a recorded response, e.g.
+    # python twitter_graphql.py data/sample_graphql_likes_response.json
+    with open(sys.argv[1], encoding="utf-8") as file:
+        for row in parse_timeline_response(file.read()):
+            print(json.dumps(row, ensure_ascii=False))
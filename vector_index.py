@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+# Nearest-neighbor search over an EmbeddingMatrix (cosine similarity, the stored vectors
+# are normalized). ExactIndex scans every vector; IVFIndex (pure NumPy) and HNSWIndex
+# (hnswlib) are approximate, built once and saved next to the embeddings. Every index has
+# `file_paths` and `search(query_embeddings, top_k, candidates=None)`, which returns
+# (indices into file_paths, similarities), best first. `candidates` (sorted file indices,
+# e.g. from metadata_filter) restricts the search to those files: only they are scored,
+# and a small enough candidate set is scored exactly.
+import json
+import logging
+import os
+
+import numpy as np
+
+from embedding_store import normalize
+
+try:
+    import hnswlib
+except ImportError:  # optional, IVFIndex is used instead
+    hnswlib = None
+
+
+logger = logging.getLogger(__name__)
+
+# Up to this many images an exact scan takes tens of milliseconds, so "auto" uses it
+EXACT_MAX_SIZE = 20_000
+IVF_FILENAME = "vector_index.ivf.npz"
+HNSW_FILENAME = "vector_index.hnsw.bin"
+# A filtered search with up to this many candidates scores them exactly, above that the
+# approximate index skips the other vectors while it searches
+FILTERED_EXACT_MAX_SIZE = 5_000
+# Rows scored at a time when assigning vectors to IVF lists
+ASSIGN_CHUNK_ROWS = 16384
+
+
+def top_k_indices(scores, k):
+    # Indices and values of the k largest scores along the last axis, best first, without
+    # sorting all of them
+    k = min(k, scores.shape[-1])
+    if k == 0:
+        empty = np.empty(scores.shape[:-1] + (0,))
+        return empty.astype(np.int64), empty.astype(scores.dtype)
+    indices = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    top_scores = np.take_along_axis(scores, indices, axis=-1)
+    order = np.argsort(-top_scores, axis=-1)
+    return (
+        np.take_along_axis(indices, order, axis=-1),
+        np.take_along_axis(top_scores, order, axis=-1),
+    )
+
+
+def exact_search(embeddings, query_embeddings, top_k=10, candidates=None):
+    # Scores every file, or only the candidates
+    if candidates is None:
+        return top_k_indices(embeddings.similarities(query_embeddings), top_k)
+    queries = normalize(query_embeddings)
+    single = queries.ndim == 1
+    queries = queries.reshape(-1, embeddings.dim)
+    candidates = np.asarray(candidates, dtype=np.int64)
+    scores = np.empty((len(queries), len(candidates)), dtype=np.float32)
+    for start in range(0, len(candidates), ASSIGN_CHUNK_ROWS):
+        chunk = candidates[start : start + ASSIGN_CHUNK_ROWS]
+        scores[:, start : start + len(chunk)] = queries @ embeddings.vectors_of(chunk).T
+    positions, scores = top_k_indices(scores, top_k)
+    indices = candidates[positions]
+    return (indices[0], scores[0]) if single else (indices, scores)
+
+
+def _save_atomic(filename, save):
+    tmp_filename = f"{filename}.tmp"
+    save(tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+class ExactIndex:
+    name = "exact"
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.file_paths = embeddings.file_paths
+
+    def search(self, query_embeddings, top_k=10, candidates=None):
+        return exact_search(self.embeddings, query_embeddings, top_k, candidates)
+
+    def __len__(self):
+        return len(self.file_paths)
+
+
+class IVFIndex:
+    # Inverted file index: the vectors are clustered with spherical k-means into `nlist`
+    # lists, and a query only scores the vectors of its `nprobe` closest lists. Higher
+    # nprobe means better recall and slower queries.
+    name = "ivf"
+
+    def __init__(self, embeddings, centroids, order, offsets, nprobe=32):
+        self.embeddings = embeddings
+        self.file_paths = embeddings.file_paths
+        self.centroids = centroids
+        # order[offsets[i]:offsets[i + 1]] are the file indices of list i
+        self.order = order
+        self.offsets = offsets
+        self.nprobe = nprobe
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(
+        cls,
+        embeddings,
+        nlist=None,
+        nprobe=32,
+        num_iterations=10,
+        sample_per_list=64,
+        seed=0,
+    ):
+        size = len(embeddings)
+        nlist = min(nlist or max(1, int(4 * np.sqrt(size))), size)
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(size, min(size, nlist * sample_per_list), replace=False))
+        data = embeddings.vectors_of(sample)
+        centroids = data[rng.choice(len(data), nlist, replace=False)]
+        for _ in range(num_iterations):
+            order, offsets = _inverted_lists(_assign(data, centroids), nlist)
+            counts = np.diff(offsets)
+            sums = np.empty_like(centroids)
+            nonempty = counts > 0
+            sums[nonempty] = np.add.reduceat(data[order], offsets[:-1][nonempty])
+            # Empty lists are restarted from random sample vectors
+            sums[~nonempty] = data[rng.choice(len(data), int((~nonempty).sum()))]
+            centroids = normalize(sums)
+
+        assignments = np.concatenate(
+            [
+                _assign(embeddings.vectors_of(chunk), centroids)
+                for chunk in np.array_split(np.arange(size), -(-size // ASSIGN_CHUNK_ROWS))
+            ]
+        )
+        order, offsets = _inverted_lists(assignments, nlist)
+        return cls(embeddings, centroids, order, offsets, nprobe)
+
+    def search(self, query_embeddings, top_k=10, candidates=None):
+        if candidates is not None and len(candidates) <= FILTERED_EXACT_MAX_SIZE:
+            return exact_search(self.embeddings, query_embeddings, top_k, candidates)
+        queries = normalize(query_embeddings)
+        single = queries.ndim == 1
+        queries = queries.reshape(-1, self.centroids.shape[1])
+        # With candidates, the lists are filtered by a mask, sizes counts the candidates
+        # in each list, and proportionally more lists are probed so that about as many
+        # vectors are scored as without a filter
+        mask, sizes, nprobe = None, np.diff(self.offsets), self.nprobe
+        if candidates is not None:
+            mask = np.zeros(len(self.file_paths), dtype=bool)
+            mask[candidates] = True
+            lists = np.repeat(np.arange(self.nlist), sizes)
+            sizes = np.bincount(lists[mask[self.order]], minlength=self.nlist)
+            nprobe = int(np.ceil(nprobe * len(self.file_paths) / max(len(candidates), 1)))
+        results = [
+            self._search_one(query, centroid_scores, top_k, nprobe, mask, sizes)
+            for query, centroid_scores in zip(queries, queries @ self.centroids.T)
+        ]
+        indices = np.array([result[0] for result in results])
+        scores = np.array([result[1] for result in results])
+        return (indices[0], scores[0]) if single else (indices, scores)
+
+    def _search_one(self, query, centroid_scores, top_k, nprobe, mask, sizes):
+        lists, _ = top_k_indices(centroid_scores, nprobe)
+        if sizes[lists].sum() < top_k:
+            # The probed lists hold fewer than top_k vectors (rare without a mask), more
+            # lists are probed
+            lists = np.argsort(-centroid_scores)
+            lists = lists[: np.searchsorted(np.cumsum(sizes[lists]), top_k) + 1]
+        candidates = np.concatenate(
+            [self.order[self.offsets[i] : self.offsets[i + 1]] for i in lists]
+        )
+        if mask is not None:
+            candidates = candidates[mask[candidates]]
+        candidates.sort()
+        positions, scores = top_k_indices(self.embeddings.vectors_of(candidates) @ query, top_k)
+        return candidates[positions], scores
+
+    def save(self, filename):
+        def save(tmp_filename):
+            with open(tmp_filename, "wb") as f:
+                np.savez(
+                    f,
+                    fingerprint=np.array(self.embeddings.fingerprint()),
+                    centroids=self.centroids,
+                    order=self.order,
+                    offsets=self.offsets,
+                )
+
+        _save_atomic(filename, save)
+
+    @classmethod
+    def load(cls, filename, embeddings, nprobe=32):
+        # None when the file is missing or was built on other embeddings
+        if not os.path.exists(filename):
+            return None
+        with np.load(filename, allow_pickle=False) as data:
+            if str(data["fingerprint"]) != embeddings.fingerprint():
+                return None
+            return cls(embeddings, data["centroids"], data["order"], data["offsets"], nprobe)
+
+    def __len__(self):
+        return len(self.file_paths)
+
+
+def _assign(vectors, centroids):
+    return np.argmax(vectors @ centroids.T, axis=1)
+
+
+def _inverted_lists(assignments, nlist):
+    # (order, offsets): order[offsets[i]:offsets[i + 1]] are the positions assigned to i
+    order = np.argsort(assignments, kind="stable")
+    offsets = np.zeros(nlist + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assignments, minlength=nlist))
+    return order, offsets
+
+
+class HNSWIndex:
+    # HNSW graph from hnswlib: M and ef_construction set the graph quality at build time,
+    # ef the recall/latency trade-off of queries. hnswlib keeps its own float32 copy of
+    # the vectors.
+    name = "hnsw"
+
+    def __init__(self, embeddings, index, ef=64):
+        self.embeddings = embeddings
+        self.file_paths = embeddings.file_paths
+        self.index = index
+        self.ef = ef
+
+    @classmethod
+    def build(cls, embeddings, M=16, ef_construction=200, ef=64, chunk_rows=16384):
+        if hnswlib is None:
+            raise ImportError("HNSWIndex needs hnswlib: pip install hnswlib")
+        index = hnswlib.Index(space="ip", dim=embeddings.dim)
+        index.init_index(max_elements=len(embeddings), ef_construction=ef_construction, M=M)
+        for start in range(0, len(embeddings), chunk_rows):
+            indices = np.arange(start, min(start + chunk_rows, len(embeddings)))
+            index.add_items(embeddings.vectors_of(indices), indices)
+        return cls(embeddings, index, ef)
+
+    def search(self, query_embeddings, top_k=10, candidates=None):
+        if candidates is not None and len(candidates) <= FILTERED_EXACT_MAX_SIZE:
+            return exact_search(self.embeddings, query_embeddings, top_k, candidates)
+        queries = normalize(query_embeddings)
+        single = queries.ndim == 1
+        k = min(top_k, len(self.file_paths))
+        self.index.set_ef(max(self.ef, k))
+        # Non-candidates are skipped while the graph is searched
+        query_filter = None
+        if candidates is not None:
+            mask = np.zeros(len(self.file_paths), dtype=bool)
+            mask[candidates] = True
+            query_filter = mask.__getitem__
+        try:
+            labels, distances = self.index.knn_query(
+                queries.reshape(-1, self.embeddings.dim), k=k, filter=query_filter
+            )
+        except RuntimeError:
+            # hnswlib reached fewer than k candidates through the graph
+            return exact_search(self.embeddings, query_embeddings, top_k, candidates)
+        # The "ip" distance is 1 - inner product
+        indices, scores = labels.astype(np.int64), 1 - distances
+        return (indices[0], scores[0]) if single else (indices, scores)
+
+    def save(self, filename):
+        _save_atomic(filename, self.index.save_index)
+        with open(f"{filename}.json", "w", encoding="utf-8") as f:
+            json.dump({"fingerprint": self.embeddings.fingerprint()}, f)
+
+    @classmethod
+    def load(cls, filename, embeddings, ef=64):
+        if hnswlib is None or not os.path.exists(f"{filename}.json"):
+            return None
+        with open(f"{filename}.json", encoding="utf-8") as f:
+            if json.load(f)["fingerprint"] != embeddings.fingerprint():
+                return None
+        index = hnswlib.Index(space="ip", dim=embeddings.dim)
+        index.load_index(filename, max_elements=len(embeddings))
+        return cls(embeddings, index, ef)
+
+    def __len__(self):
+        return len(self.file_paths)
+
+
+BACKENDS = {"ivf": (IVFIndex, IVF_FILENAME), "hnsw": (HNSWIndex, HNSW_FILENAME)}
+
+
+def open_index(embeddings, folder_path, backend="auto", **options):
+    # Loads the saved approximate index of the folder, or builds and saves it when it is
+    # missing or stale. "auto" is exact for small collections, and HNSW when hnswlib is
+    # installed or IVF otherwise for large ones. `options` go to the backend, e.g. nprobe
+    # for IVF or ef for HNSW.
+    if backend == "auto":
+        if len(embeddings) <= EXACT_MAX_SIZE:
+            backend = "exact"
+        else:
+            backend = "hnsw" if hnswlib is not None else "ivf"
+    if backend == "exact" or not len(embeddings):
+        return ExactIndex(embeddings)
+    index_class, filename = BACKENDS[backend]
+    filename = os.path.join(folder_path, filename)
+    query_options = {key: options.pop(key) for key in ("nprobe", "ef") if key in options}
+    index = index_class.load(filename, embeddings, **query_options)
+    if index is None:
+        logger.info(f"Building the {backend} index of {len(embeddings)} images.")
+        index = index_class.build(embeddings, **options, **query_options)
+        index.save(filename)
+    return index
+
+
+def recall_at_k(index, exact_index, query_embeddings, k=10):
+    # Fraction of the exact top k that the index also returns in its top k
+    expected, _ = exact_index.search(query_embeddings, k)
+    found, _ = index.search(query_embeddings, k)
+    hits = [len(set(row) & set(expected_row)) for row, expected_row in zip(found, expected)]
+    return sum(hits) / expected.size